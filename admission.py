@@ -0,0 +1,283 @@
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from file_stream import READ_INLINE_LIMIT
+
+# Token buckets per role and command class, as (refill per second, burst).
+# Every user gets their own buckets; "total" is charged for every command.
+# Override with RATE_LIMITS, e.g. '{"user": {"read": [20, 40]}}' (a rate of 0 means
+# unlimited), or turn rate limiting off with RATE_LIMITS=off.
+RATE_LIMITS = {
+    'admin': {'total': (1000, 2000), 'read': (1000, 2000), 'write': (500, 1000), 'lock': (500, 1000),
+              'session': (50, 100)},
+    'user': {'total': (100, 200), 'read': (100, 200), 'write': (20, 40), 'lock': (20, 40), 'session': (10, 20)},
+}
+if os.environ.get('RATE_LIMITS') == 'off':
+    RATE_LIMITS = {}
+else:
+    for _role, _limits in json.loads(os.environ.get('RATE_LIMITS', '{}')).items():
+        RATE_LIMITS.setdefault(_role, {}).update({name: tuple(limit) for name, limit in _limits.items()})
+
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))  # Commands running at once in this process
+MAX_HEAVY = int(os.environ.get('ADMISSION_MAX_HEAVY', 4))  # Of which heavy (large transfers, bulk approvals, searches)
+MAX_QUEUED = int(os.environ.get('ADMISSION_MAX_QUEUED', 256))  # Commands waiting for a slot before new ones are turned away
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1.0))  # Seconds a command may wait for a slot
+HEAVY_BYTES = 1024 * 1024  # Content size that makes a write heavy
+
+COMMAND_CLASSES = {
+    'LIST': 'read', 'READ': 'read', 'READ_RANGE': 'read', 'READ_ENCODED': 'read', 'SEARCH': 'read',
+    'LIST_REQUESTS': 'read', 'STATS': 'read',
+    'CREATE': 'write', 'EDIT': 'write', 'DELETE': 'write', 'MAKE_REQUEST': 'write', 'HANDLE_REQUEST': 'write',
+    'HANDLE_REQUESTS': 'write', 'UPLOAD': 'write', 'UPLOAD_END': 'write',
+    'LOCK': 'lock', 'UNLOCK': 'lock',
+}
+# Part of a command already admitted, or needed to get out of trouble: never limited
+EXEMPT_COMMANDS = {'UPLOAD_CHUNK', 'UPLOAD_ABORT', 'LOGOUT'}
+# A single HANDLE_REQUEST is one write, served ahead of the apply backlog, so it is not
+# heavy: it would otherwise hold a heavy slot while it waits for its turn
+HEAVY_COMMANDS = {'HANDLE_REQUESTS', 'SEARCH', 'UPLOAD_END'}
+# Lower is served first: lock traffic, then writes, then reads; admins ahead of users within each
+CLASS_PRIORITY = {'lock': 0, 'session': 0, 'write': 1, 'read': 2}
+
+
+class Overloaded(Exception):
+    """A command turned away by admission control; ``retry_after`` is in seconds."""
+
+    def __init__(self, message, retry_after, reason='overloaded'):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason  # "rate_limited" or "overloaded"
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+    def to_dict(self):
+        return {"error": self.reason, "message": str(self), "retry_after": round(self.retry_after, 3)}
+
+
+def command_class(name):
+    return COMMAND_CLASSES.get(name, 'session')
+
+
+def is_heavy(name, args, catalog):
+    """Whether a parsed command moves enough data (or does enough work) to count against MAX_HEAVY."""
+    if name in HEAVY_COMMANDS:
+        return True
+    if name in ('READ', 'READ_RANGE', 'READ_ENCODED'):
+        info = catalog.info(args[0])
+        if info is None:
+            return False
+        if name == 'READ_RANGE' and args[2] is not None:
+            return args[2] > READ_INLINE_LIMIT
+        return info.size > READ_INLINE_LIMIT
+    if name in ('CREATE', 'EDIT', 'MAKE_REQUEST'):
+        return len(args[-1]) > HEAVY_BYTES
+    return False
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def shortfall(self, cost, now):
+        """Seconds until ``cost`` tokens are available (0 if they are now).
+
+        A cost above the burst only needs a full bucket; ``take`` then leaves
+        the bucket in debt, which later commands wait out.
+        """
+        self._refill(now)
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class _Waiter:
+    __slots__ = ('heavy', 'granted', 'wake')
+
+    def __init__(self, heavy, wake):
+        self.heavy = heavy
+        self.granted = False
+        self.wake = wake
+
+
+class AdmissionController:
+    """Per-user rate limits plus a prioritised cap on commands running at once.
+
+    ``enter`` first charges the command to the user's token buckets for its
+    class and in total; an empty bucket rejects it at once with the time
+    until enough tokens are back. It then takes one of ``max_in_flight``
+    slots (and one of ``max_heavy`` for heavy commands). When none is free
+    the command waits in a priority queue, so an admin's LOCK is served
+    before queued user reads; if it cannot get a slot within
+    ``queue_timeout``, or too many are already waiting, it is rejected
+    rather than left to pile up. Every rejection raises ``Overloaded``.
+
+    Threads use ``enter``/``admitted``; coroutines use ``enter_async``. Both
+    return a ticket for ``leave``.
+    """
+
+    def __init__(self, limits=RATE_LIMITS, max_in_flight=MAX_IN_FLIGHT, max_heavy=MAX_HEAVY,
+                 max_queued=MAX_QUEUED, queue_timeout=QUEUE_TIMEOUT):
+        self.limits = limits
+        self.max_in_flight = max_in_flight
+        self.max_heavy = max_heavy
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.heavy = 0
+        self.rate_limited = 0
+        self.rejected = 0
+        self._buckets = {}  # (username, class) -> TokenBucket
+        self._queue = []  # heap of (priority, arrival, waiter)
+        self._arrival = itertools.count()
+        self._lock = threading.Lock()
+
+    def _bucket(self, username, role, name):
+        key = (username, name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits.get(role, self.limits.get('user', {})).get(name, (0, 0))
+            if not rate:
+                return None
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _charge(self, username, role, cls, cost):
+        # Called with the lock held; takes from both buckets or neither
+        now = time.monotonic()
+        buckets = [bucket for bucket in (self._bucket(username, role, cls), self._bucket(username, role, 'total'))
+                   if bucket is not None]
+        wait = max((bucket.shortfall(cost, now) for bucket in buckets), default=0.0)
+        if wait:
+            self.rate_limited += 1
+            raise Overloaded(f"Rate limit exceeded for {cls} commands, retry in {wait:.2f}s", wait, 'rate_limited')
+        for bucket in buckets:
+            bucket.take(cost)
+
+    def _fits(self, heavy):
+        return self.in_flight < self.max_in_flight and (not heavy or self.heavy < self.max_heavy)
+
+    def _grant(self, heavy):
+        self.in_flight += 1
+        if heavy:
+            self.heavy += 1
+
+    def _try_enter(self, username, role, command, heavy, cost, wake):
+        """Charge and admit at once, or queue a waiter; returns ``(ticket, waiter)``."""
+        if command in EXEMPT_COMMANDS:
+            return (False, False), None
+        cls = command_class(command)
+        with self._lock:
+            self._charge(username, role, cls, cost)
+            if self._fits(heavy) and not self._queue:
+                self._grant(heavy)
+                return (True, heavy), None
+            if len(self._queue) >= self.max_queued:
+                self.rejected += 1
+                raise Overloaded("Server busy, too many commands waiting", self.queue_timeout)
+            waiter = _Waiter(heavy, wake)
+            priority = (CLASS_PRIORITY[cls], 0 if role == 'admin' else 1)
+            heapq.heappush(self._queue, (priority, next(self._arrival), waiter))
+            self._dispatch()  # Slots may be free for this command while heavy ones ahead of it wait
+            return (True, heavy), waiter
+
+    def _withdraw(self, waiter):
+        """Take a waiter out of the queue; False if it was granted a slot meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            return True
+
+    def _give_up(self, waiter):
+        if self._withdraw(waiter):
+            self.rejected += 1
+            raise Overloaded("Server busy, no capacity for this command", self.queue_timeout)
+
+    def _dispatch(self):
+        # Called with the lock held: hand freed slots to the best waiters that fit
+        skipped = []
+        while self._queue and self.in_flight < self.max_in_flight:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if not self._fits(waiter.heavy):
+                skipped.append(entry)  # Heavy slots full; lighter commands behind it may go
+                continue
+            self._grant(waiter.heavy)
+            waiter.granted = True
+            waiter.wake()
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def enter(self, username, role, command, heavy=False, cost=1):
+        event = threading.Event()
+        ticket, waiter = self._try_enter(username, role, command, heavy, cost, event.set)
+        if waiter is not None and not event.wait(self.queue_timeout):
+            self._give_up(waiter)
+        return ticket
+
+    async def enter_async(self, username, role, command, heavy=False, cost=1):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        ticket, waiter = self._try_enter(username, role, command, heavy, cost, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._give_up(waiter)
+            except asyncio.CancelledError:
+                if not self._withdraw(waiter):
+                    self.leave(ticket)
+                raise
+        return ticket
+
+    def leave(self, ticket):
+        admitted, heavy = ticket
+        if not admitted:
+            return
+        with self._lock:
+            self.in_flight -= 1
+            if heavy:
+                self.heavy -= 1
+            self._dispatch()
+
+    @contextmanager
+    def admitted(self, username, role, command, heavy=False, cost=1):
+        ticket = self.enter(username, role, command, heavy, cost)
+        try:
+            yield
+        finally:
+            self.leave(ticket)
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "heavy": self.heavy, "queued": self.queued,
+                "rate_limited": self.rate_limited, "rejected": self.rejected}
@@ -0,0 +1,85 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+APPLY_WORKERS = int(os.environ.get('APPLY_WORKERS', 4))  # Files written in parallel
+
+
+class ApplyQueue:
+    """Runs jobs on a fixed pool of worker threads, in submission order per key.
+
+    Jobs with the same key (a filename) never run concurrently and run in the
+    order they were submitted; jobs for different keys run in parallel on up
+    to ``workers`` threads. ``submit`` returns a Future for the job's result.
+
+    Keys are served first come, first served, except that an ``urgent`` job
+    (one a caller is waiting on) moves its key to the front of the line. It
+    still runs after the jobs already queued for the same key.
+    """
+
+    def __init__(self, workers=APPLY_WORKERS):
+        self._cond = threading.Condition()
+        self._jobs = {}  # key -> deque of (future, func, args) not yet started
+        self._ready = deque()  # Keys with jobs waiting and none running
+        self._running = set()
+        self._urgent = {}  # key -> urgent jobs queued for it
+        self.queued = 0
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'apply-{i}', daemon=True).start()
+
+    def submit(self, key, func, *args, urgent=False):
+        future = Future()
+        with self._cond:
+            jobs = self._jobs.get(key)
+            if jobs is None:
+                jobs = self._jobs[key] = deque()
+                if key not in self._running:
+                    self._ready.append(key)
+                    self._cond.notify()
+            jobs.append((future, func, args, urgent))
+            self.queued += 1
+            if urgent:
+                self._urgent[key] = self._urgent.get(key, 0) + 1
+                if key in self._ready and self._ready[0] != key:
+                    self._ready.remove(key)
+                    self._ready.appendleft(key)
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                jobs = self._jobs[key]
+                future, func, args, urgent = jobs.popleft()
+                if not jobs:
+                    del self._jobs[key]
+                if urgent:
+                    self._urgent[key] -= 1
+                    if not self._urgent[key]:
+                        del self._urgent[key]
+                self._running.add(key)
+                self.queued -= 1
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._cond:
+                self._running.discard(key)
+                if key in self._jobs:
+                    # The next job for this file goes to the back of the line,
+                    # or to the front while someone waits on a job for it
+                    if key in self._urgent:
+                        self._ready.appendleft(key)
+                    else:
+                        self._ready.append(key)
+                    self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {"queued": self.queued, "running": len(self._running)}
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+LAG_INTERVAL = 0.5  # Seconds between event-loop lag samples
+LAG_WARN = 0.1  # Lag in seconds worth reporting
+
+
+class IOExecutor:
+    """Runs blocking file-system calls on a bounded thread pool.
+
+    Each kind of operation has its own concurrency limit, so a burst of slow
+    writes cannot take every worker away from reads (and vice versa).
+    """
+
+    def __init__(self, max_workers, limits):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='io')
+        self._limits = dict(limits)
+        self._semaphores = {}
+        self.in_flight = {kind: 0 for kind in self._limits}
+        self.waiting = {kind: 0 for kind in self._limits}
+
+    def _semaphore(self, kind):
+        # Created lazily so they bind to the running loop
+        semaphore = self._semaphores.get(kind)
+        if semaphore is None:
+            semaphore = self._semaphores[kind] = asyncio.Semaphore(self._limits[kind])
+        return semaphore
+
+    async def run(self, kind, func, *args):
+        """Run ``func(*args)`` in the pool under the ``kind`` concurrency limit."""
+        semaphore = self._semaphore(kind)
+        self.waiting[kind] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[kind] -= 1
+        self.in_flight[kind] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+        finally:
+            self.in_flight[kind] -= 1
+            semaphore.release()
+
+    async def iterate(self, kind, chunks):
+        """Async iterator over a blocking generator, fetching each item in the pool."""
+        iterator = iter(chunks)
+        sentinel = object()
+        try:
+            while True:
+                chunk = await self.run(kind, next, iterator, sentinel)
+                if chunk is sentinel:
+                    return
+                yield chunk
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await self.run(kind, close)
+
+    def stats(self):
+        return {
+            kind: {"limit": limit, "in_flight": self.in_flight[kind], "waiting": self.waiting[kind]}
+            for kind, limit in self._limits.items()
+        }
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed-interval sleep."""
+
+    def __init__(self, interval=LAG_INTERVAL, warn=LAG_WARN):
+        self.interval = interval
+        self.warn = warn
+        self.last = 0.0
+        self.max = 0.0
+        self.average = 0.0  # Exponentially weighted
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - started - self.interval, 0.0)
+            self.last = lag
+            self.max = max(self.max, lag)
+            self.average = lag if not self.average else 0.9 * self.average + 0.1 * lag
+            if lag >= self.warn:
+                print(f"[WARN] Event loop lagged {lag * 1000:.0f} ms")
+
+    def stats(self):
+        return {"last_ms": round(self.last * 1000, 2), "max_ms": round(self.max * 1000, 2),
+                "avg_ms": round(self.average * 1000, 2)}
@@ -1,237 +1,830 @@
 import asyncio
+import contextvars
 import websockets
 import json
 import os
+import time
+import zlib
+from contextlib import asynccontextmanager
+from functools import partial
 from datetime import datetime
-from threading import Lock
+from request_store import parse_query, parse_selection
+from apply_queue import ApplyQueue
+from file_stream import READ_INLINE_LIMIT, resolve_range, decode_text_chunks
+from file_store import open_store
+from durability import Durability
+from uploads import Upload
+from state_backend import STATE_BACKEND, open_lock_manager, open_request_store, open_event_log, open_revocations
+from file_catalog import FileCatalog
+from content_cache import ContentCache
+from search_index import SearchIndex, parse_page
+from admission import AdmissionController, Overloaded, is_heavy
+from event_bus import EventBus, TOPICS
+from async_io import IOExecutor, LoopLagMonitor
+from sessions import SessionManager, load_secret, verify_password
+from metrics import ServerMetrics, CONTENT_TYPE, scrape_allowed
+from commands import (Dispatcher, CommandError, PermissionDenied, REPLY_TEXT, REPLY_BYTES, REPLY_JSON,
+                      TAG_PREFIX, SEPARATOR, reply_frame_header, split_tag, command_name)
 
 HOST = 'localhost'
 PORT = 5002
+# Lets several backend processes (STATE_BACKEND=sqlite) listen on PORT, the kernel spreading connections
+REUSE_PORT = os.environ.get('BACKEND_REUSE_PORT') == '1'
+# permessage-deflate is off by default: it recompresses every message, including file
+# bytes that are already compressed (READ_ENCODED) and READ_RANGE and upload chunks.
+# BACKEND_COMPRESSION=deflate turns it back on; READ_ENCODED then sends files as is.
+COMPRESSION = os.environ.get('BACKEND_COMPRESSION') or None
+FILES_DIR = 'files'
 
-file_lock = Lock()
-admin_file_locks = {}  # Track which admin has locked which file
-pending_requests = []  # Store user requests
-requests_lock = Lock()
+# Blocking file-system work runs on a bounded pool, with a concurrency cap per kind of operation
+IO_WORKERS = int(os.environ.get('BACKEND_IO_WORKERS', 16))
+IO_LIMITS = {
+    'read': int(os.environ.get('BACKEND_READ_LIMIT', 8)),
+    'write': int(os.environ.get('BACKEND_WRITE_LIMIT', 4)),
+    'meta': int(os.environ.get('BACKEND_META_LIMIT', 4)),  # stat, remove, temp files
+    'lock': int(os.environ.get('BACKEND_LOCK_WAIT_LIMIT', 4)),  # waiting on a busy file lock
+    'auth': int(os.environ.get('BACKEND_AUTH_LIMIT', 2)),  # password hashing at login
+    'state': int(os.environ.get('BACKEND_STATE_LIMIT', 8)),  # lock and request transactions in STATE_DB
+}
+# With STATE_BACKEND=sqlite every lock and request call is a database transaction
+# (often fsynced, and waiting on other processes' transactions), so it runs in the pool
+SHARED_STATE = STATE_BACKEND == 'sqlite'
+
+if not os.path.exists(FILES_DIR):
+    os.makedirs(FILES_DIR)
+
+durability = Durability()  # Temp file, fsync (grouped across writers by default), rename
+store = open_store(FILES_DIR, durability=durability)  # Plain, chunked or compressed files (FILE_STORAGE)
+catalog = FileCatalog(store)  # Directory index updated from our writes and inotify
+content_cache = ContentCache()  # Contents of recently read small files, checked against the catalog before use
+search_index = SearchIndex(catalog, durability=durability)  # Full-text index behind SEARCH, saved to search_index.json
+admission = AdmissionController()  # Per-user rate limits and a prioritised cap on commands running at once
+metrics = ServerMetrics()  # Served over HTTP at /metrics on the websocket port
+locks = open_lock_manager(observer=metrics)  # Per-file reader/writer locks; admins' LOCKs are leased write locks
+events = EventBus(open_event_log())  # Change notifications pushed to SUBSCRIBEd sessions, from every process sharing STATE_DB
+file_io = IOExecutor(IO_WORKERS, IO_LIMITS)
+lag_monitor = LoopLagMonitor()
+sessions = SessionManager(load_secret(), revocations=open_revocations())  # Accepts tokens issued by web_server.py /auth
+PIPELINE_DEPTH = int(os.environ.get('BACKEND_PIPELINE_DEPTH', 64))  # Tagged commands in flight per connection
+# Commands that change the session itself run one at a time even when tagged
+SERIAL_COMMANDS = {'PROTOCOL', 'LOGOUT', 'SUBSCRIBE', 'UNSUBSCRIBE',
+                   'UPLOAD', 'UPLOAD_CHUNK', 'UPLOAD_END', 'UPLOAD_ABORT'}
+REQUEST_FIELDS = ('status', 'username', 'action', 'filename')
+# Store user requests; kept in memory only, unless shared with other backend processes in STATE_DB
+request_store = open_request_store(snapshot_path=None, journal_path=None, table='backend_requests',
+                                   indexed_fields=REQUEST_FIELDS, durability=durability)
+# Approvals a stopped process had queued but not applied can be handled again
+for _req in request_store.release_orphaned():
+    print(f"[REQUESTS] Request #{_req['id']} was queued by a stopped process, back to pending")
+OPEN_REQUEST_STATUSES = ('pending', 'failed')  # Requests that may still be approved or rejected
+BULK_REQUEST_LIMIT = int(os.environ.get('BULK_REQUEST_LIMIT', 10000))  # Requests per HANDLE_REQUESTS
+apply_queue = ApplyQueue()  # Applies approved requests in the background, in order per file
+active_sessions = metrics.registry.gauge('fms_websocket_sessions', 'Authenticated websocket sessions')
+metrics.registry.gauge('fms_write_locks_held', 'Files currently write-locked',
+                       func=lambda: len(locks.write_locks()))
+metrics.registry.gauge('fms_file_readers', 'Active file readers',
+                       func=lambda: sum(locks.reader_counts().values()))
+metrics.registry.gauge('fms_content_cache_bytes', 'Memory held by cached file contents',
+                       func=lambda: content_cache.bytes)
+metrics.registry.gauge('fms_admission_in_flight', 'Admitted commands running', ('kind',),
+                       func=lambda: {'all': admission.in_flight, 'heavy': admission.heavy})
+metrics.registry.gauge('fms_admission_queued', 'Commands waiting for admission', func=lambda: admission.queued)
+metrics.registry.counter('fms_admission_rejected_total', 'Commands turned away by admission control', ('reason',),
+                         func=lambda: {'rate_limited': admission.rate_limited, 'overloaded': admission.rejected})
+metrics.registry.counter('fms_content_cache_lookups_total', 'Content cache lookups', ('result',),
+                         func=lambda: {'hit': content_cache.hits, 'miss': content_cache.misses})
+metrics.registry.gauge('fms_event_subscribers', 'Sessions subscribed to change events', func=lambda: len(events))
+metrics.registry.gauge('fms_event_loop_lag_seconds', 'Most recent event loop lag sample',
+                       func=lambda: lag_monitor.last)
 
 # Load users with roles from JSON
 with open('users.json', 'r') as f:
     USERS = json.load(f)
 
-class FileRequest:
-    def __init__(self, username, action, filename, content=None):
-        self.id = len(pending_requests) + 1
-        self.username = username
-        self.action = action
-        self.filename = filename
-        self.content = content
-        self.status = "pending"
-        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "username": self.username,
-            "action": self.action,
-            "filename": self.filename,
-            "content": self.content,
-            "status": self.status,
-            "timestamp": self.timestamp
-        }
-
 def get_file_list():
-    """Get list of files excluding system files"""
-    return [f for f in os.listdir('.')
-            if not f.startswith('.') and
-            f not in ['backend.py', 'users.json', '__pycache__', 'web_server.py', 'README.md', 'static', 'templates']]
+    """Get list of files excluding hidden files"""
+    return catalog.names()
+
+def is_valid_filename(filename):
+    return bool(filename) and not filename.startswith('.') and '/' not in filename and '\\' not in filename
+
+# Blocking helpers, only ever called through file_io.run
+def read_content(filename, version):
+    content = store.read_text(filename)
+    return content_cache.put(filename, version, content, catalog.sha256(filename))
+
+def open_transfer(filename, accepted):
+    """(encoding, size, length, sha256, chunks) of a file for READ_ENCODED; stored bytes if their codec is accepted"""
+    size = store.size(filename) or 0
+    encoded = store.open_encoded(filename)
+    if encoded is not None and encoded[0] not in accepted:
+        encoded[2].close()
+        encoded = None
+    encoding, length, chunks = encoded or ('identity', size, store.iter_range(filename, 0, size))
+    return encoding, size, length, catalog.sha256(filename), chunks
+
+def write_text(filename, content):
+    store.write_text(filename, content)
+    file_changed(filename)
+    metrics.bytes_written.inc(len(content))
+
+def remove_file(filename):
+    store.delete(filename)
+    file_changed(filename)
+
+def commit_upload(received, filename):
+    store.commit_upload(received, filename)
+    file_changed(filename, sha256=received.sha256)
+    metrics.bytes_written.inc(received.size)
+
+def file_changed(filename, sha256=None):
+    content_cache.invalidate(filename)
+    catalog.refresh(filename, sha256, written=True)
+    search_index.changed(filename)
+
+def file_size(filename):
+    """Size of a stored file, or None if it does not exist"""
+    return store.size(filename)
+
+class FileBusy(Exception):
+    pass
+
+async def state_call(func, *args, **kwargs):
+    """Call a lock manager or request store method: inline in memory, in the pool when shared through SQLite"""
+    if not SHARED_STATE:
+        return func(*args, **kwargs)
+    return await file_io.run('state', partial(func, *args, **kwargs))
+
+async def acquire_lock(acquire, filename, user):
+    # Uncontended in-memory locks are taken inline; a real wait (or any SQLite lock) is handed to a worker thread
+    success, message = (False, None) if SHARED_STATE else acquire(filename, user, timeout=0)
+    if not success:
+        success, message = await file_io.run('lock', acquire, filename, user)
+    if not success:
+        raise FileBusy(message)
+
+@asynccontextmanager
+async def write_access(filename, user):
+    """Hold the write lock on filename, unless user already holds it through LOCK"""
+    if await state_call(locks.holder, filename) == user:
+        yield
+        return
+    await acquire_lock(locks.acquire_write, filename, user)
+    try:
+        yield
+    finally:
+        await state_call(locks.release_write, filename, user)
+
+@asynccontextmanager
+async def read_access(filename, user):
+    await acquire_lock(locks.acquire_read, filename, user)
+    try:
+        yield
+    finally:
+        await state_call(locks.release_read, filename)
+
+async def process_request(connection, request):
+    # Plain HTTP GET /metrics on the websocket port, for admins or a scraper sending
+    # METRICS_TOKEN as a bearer token; the lock gauges query STATE_DB when shared
+    if request.path == '/metrics':
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else ''
+        identity = await state_call(sessions.validate, token) if token else None
+        if not scrape_allowed(token, identity[1] if identity else None):
+            if identity is None:
+                return connection.respond(401, "Not authenticated\n")
+            return connection.respond(403, "Admin access required\n")
+        response = connection.respond(200, await state_call(metrics.render))
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return response
+    return None
+
+# (opcode, tag) of the command being handled; each pipelined command runs in
+# its own task, so each sees its own value
+reply_to = contextvars.ContextVar('reply_to', default=(0, None))
+
+async def prefixed(header, chunks):
+    yield header
+    async for chunk in chunks:
+        yield chunk
+
+class Session:
+    """State of one authenticated websocket connection"""
+
+    def __init__(self, websocket, user, role):
+        self.websocket = websocket
+        self.user = user
+        self.role = role
+        self.upload = None  # (Upload, action, filename) while an UPLOAD is in progress
+        self.subscription = None
+        self.binary = False  # After PROTOCOL::binary, commands and replies are binary frames
+        self.closing = False
+        self.pipeline = asyncio.Semaphore(PIPELINE_DEPTH)
+        self.in_flight = set()  # Tasks running tagged commands
+
+    async def reply(self, body):
+        """Send text, a JSON-serialisable dict or list, or bytes"""
+        opcode, tag = reply_to.get()
+        if not self.binary:
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body)
+            if tag is not None:
+                # Tagged replies carry the same "#tag::" prefix as the command
+                prefix = f"{TAG_PREFIX}{tag}{SEPARATOR}"
+                body = (prefix.encode() + body) if isinstance(body, bytes) else prefix + body
+            await self.websocket.send(body)
+            return
+        if isinstance(body, bytes):
+            kind = REPLY_BYTES
+        elif isinstance(body, str):
+            kind, body = REPLY_TEXT, body.encode()
+        else:
+            kind, body = REPLY_JSON, json.dumps(body).encode()
+        await self.websocket.send(reply_frame_header(opcode, kind, len(body), tag) + body)
+
+    async def reply_stream(self, kind, length, chunks):
+        """Send length bytes from an async iterator as one fragmented message"""
+        if not length:
+            # websockets sends nothing at all for an empty iterator
+            await self.reply(b'' if kind == REPLY_BYTES else '')
+            return
+        opcode, tag = reply_to.get()
+        if self.binary:
+            chunks = prefixed(reply_frame_header(opcode, kind, length, tag), chunks)
+        elif tag is not None:
+            prefix = f"{TAG_PREFIX}{tag}{SEPARATOR}"
+            chunks = prefixed(prefix.encode() if kind == REPLY_BYTES else prefix, chunks)
+        await self.websocket.send(chunks)
+
+    async def pipeline_command(self, message, tag):
+        """Start a tagged command without waiting for it; replies may arrive out of order"""
+        await self.pipeline.acquire()
+        task = asyncio.create_task(serve_command(self, message, tag))
+        self.in_flight.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self.in_flight.discard(task)
+        self.pipeline.release()
+
+    async def drain(self):
+        """Wait for every pipelined command still running"""
+        if self.in_flight:
+            await asyncio.gather(*self.in_flight, return_exceptions=True)
+
+    async def cancel_pipeline(self):
+        for task in self.in_flight:
+            task.cancel()
+        await self.drain()
+
+    async def send_listing(self):
+        await self.reply({
+            "files": get_file_list(),
+            "locked_files": list(await state_call(locks.write_locks))
+        })
+
+# Command handlers, looked up in the command table shared with web_server.py.
+# Arguments arrive already checked and converted per commands.py.
+dispatcher = Dispatcher("Unknown command or insufficient permissions")
+
+@dispatcher.handler('PROTOCOL')
+async def protocol_command(session, mode):
+    # PROTOCOL::binary switches this connection to length-prefixed frames (see commands.py)
+    if mode not in ("text", "binary"):
+        await session.reply("Error: Protocol must be text or binary")
+        return
+    session.binary = mode == "binary"
+    await session.reply(f"Protocol {mode}")
+
+@dispatcher.handler('LOGOUT')
+async def logout_command(session):
+    for filename in await state_call(locks.release_all, session.user):
+        events.publish("lock_released", filename=filename, user=session.user)
+    await session.reply("Logged out successfully")
+    session.closing = True
+
+@dispatcher.handler('SUBSCRIBE')
+async def subscribe_command(session, topics):
+    # SUBSCRIBE[::file,lock,request] -> JSON {"event": ...} messages as things change
+    topics = topics.split(",") if topics else TOPICS
+    if any(topic not in TOPICS for topic in topics):
+        await session.reply(f"Error: Topics must be among {', '.join(TOPICS)}")
+        return
+    if session.subscription is not None:
+        events.unsubscribe(session.subscription)
+    session.subscription = events.subscribe(session.websocket, topics)
+    await session.reply(f"Subscribed to {', '.join(topics)}")
+
+@dispatcher.handler('UNSUBSCRIBE')
+async def unsubscribe_command(session):
+    if session.subscription is not None:
+        events.unsubscribe(session.subscription)
+        session.subscription = None
+    await session.reply("Unsubscribed")
+
+@dispatcher.handler('STATS')
+async def stats_command(session):
+    await session.reply({
+        "loop_lag": lag_monitor.stats(),
+        "io": file_io.stats(),
+        "apply": apply_queue.stats(),
+        "durability": durability.stats(),
+        "content_cache": content_cache.stats(),
+        "search": search_index.stats(),
+        "admission": admission.stats(),
+        "subscribers": len(events)
+    })
+
+@dispatcher.handler('LIST')
+async def list_command(session, etag_seen):
+    # LIST::<etag> answers "Not modified" if the listing is unchanged
+    locked_files = sorted(await state_call(locks.write_locks))
+    etag = f"{catalog.etag}-{zlib.crc32(json.dumps(locked_files).encode()):08x}"
+    if etag_seen == etag:
+        await session.reply({"not_modified": True, "etag": etag})
+        return
+    await session.reply({
+        "files": get_file_list(),
+        "locked_files": locked_files,
+        "etag": etag
+    })
+
+@dispatcher.handler('READ')
+async def read_command(session, filename, etag_seen):
+    # READ::name::<etag> replies with the content and its etag, or not_modified if unchanged
+    if not (is_valid_filename(filename) and catalog.info(filename) is not None):
+        await session.reply("File not found")
+        return
+    try:
+        async with read_access(filename, session.user):
+            size = await file_io.run('meta', file_size, filename)
+            if size is None:
+                await session.reply("File not found")
+            elif size > READ_INLINE_LIMIT:
+                # Sent as a fragmented message, one chunk in memory at a time
+                metrics.bytes_read.inc(size)
+                chunks = store.iter_range(filename, 0, size)
+                if not session.binary:
+                    chunks = decode_text_chunks(chunks)
+                await session.reply_stream(REPLY_TEXT, size, file_io.iterate('read', chunks))
+            else:
+                entry = await cached_content(filename)
+                if entry is None:
+                    await session.reply("File not found")
+                elif etag_seen is None:
+                    metrics.bytes_read.inc(len(entry.content))
+                    await session.reply(entry.content)
+                elif etag_seen == entry.etag:
+                    await session.reply({"not_modified": True, "etag": entry.etag})
+                else:
+                    metrics.bytes_read.inc(len(entry.content))
+                    await session.reply({"content": entry.content, "etag": entry.etag})
+    except FileBusy as e:
+        await session.reply(str(e))
+    except Exception as e:
+        await session.reply(f"Error reading file: {str(e)}")
+
+async def cached_content(filename):
+    """Content and ETag of a small file; only a cache miss touches the disk. Call with read access held."""
+    info = catalog.info(filename)
+    if info is None:
+        return None
+    version = info.version
+    entry = content_cache.get(filename, version)
+    if entry is None:
+        entry = await file_io.run('read', read_content, filename, version)
+    return entry
+
+@dispatcher.handler('READ_RANGE')
+async def read_range_command(session, filename, offset, length):
+    # READ_RANGE::filename::offset[::length] -> one binary message with the bytes
+    if not (is_valid_filename(filename) and catalog.info(filename) is not None):
+        await session.reply("File not found")
+        return
+    try:
+        async with read_access(filename, session.user):
+            size = await file_io.run('meta', file_size, filename)
+            start, end = resolve_range(size or 0, offset, length)
+            metrics.bytes_read.inc(end - start)
+            await session.reply_stream(REPLY_BYTES, end - start,
+                                       file_io.iterate('read', store.iter_range(filename, start, end)))
+    except (ValueError, FileBusy) as e:
+        await session.reply(f"Error: {e}")
+
+@dispatcher.handler('READ_ENCODED')
+async def read_encoded_command(session, filename, accept):
+    # READ_ENCODED::filename[::gzip,zstd] -> a JSON header naming the encoding, then one binary
+    # message with the file as stored if it is compressed with a codec the client accepts, else as is
+    if not (is_valid_filename(filename) and catalog.info(filename) is not None):
+        await session.reply("File not found")
+        return
+    accepted = {codec.strip() for codec in (accept or 'gzip').split(',')}
+    if session.websocket.protocol.extensions:
+        accepted = set()  # The connection deflates every message already; compressed bytes would be deflated again
+    try:
+        async with read_access(filename, session.user):
+            encoding, size, length, sha256, chunks = await file_io.run('read', open_transfer, filename, accepted)
+            metrics.bytes_read.inc(length)
+            await session.reply({"filename": filename, "encoding": encoding, "size": size, "length": length,
+                                 "sha256": sha256})
+            await session.reply_stream(REPLY_BYTES, length, file_io.iterate('read', chunks))
+    except (OSError, ValueError, FileBusy) as e:
+        await session.reply(f"Error: {e}")
+
+@dispatcher.handler('CREATE')
+async def create_command(session, filename, content):
+    if catalog.info(filename) is not None:
+        await session.reply(f"Error: File '{filename}' already exists")
+        return
+    if not is_valid_filename(filename):
+        await session.reply("Error: Invalid filename")
+        return
+    try:
+        async with write_access(filename, session.user):
+            # Checked again under the lock: a concurrent CREATE may have won the race
+            if await file_io.run('meta', store.exists, filename):
+                await session.reply(f"Error: File '{filename}' already exists")
+                return
+            await file_io.run('write', write_text, filename, content)
+    except FileBusy as e:
+        await session.reply(str(e))
+        return
+    events.publish("file_created", filename=filename, user=session.user)
+    await session.reply(f"File '{filename}' created successfully")
+    await session.send_listing()
+
+@dispatcher.handler('MAKE_REQUEST')
+async def make_request_command(session, action, filename, content):
+    request = await state_call(
+        request_store.add,
+        username=session.user,
+        action=action,
+        filename=filename,
+        content=content,
+        status="pending",
+        timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    events.publish("request_submitted", id=request['id'], username=session.user,
+                   action=action, filename=filename)
+    await session.reply(f"Request #{request['id']} submitted successfully")
+
+@dispatcher.handler('LIST_REQUESTS')
+async def list_requests_command(session, query):
+    try:
+        query = parse_query(query, REQUEST_FIELDS)
+    except ValueError as e:
+        await session.reply(f"Error: {e}")
+        return
+    requests_data, next_cursor = await state_call(request_store.query, **query)
+    await session.reply({"requests": requests_data, "next_cursor": next_cursor})
+
+@dispatcher.handler('SEARCH')
+async def search_command(session, query, options):
+    # SEARCH::<query>[::cursor=N][::limit=N]; the query takes words, "exact phrases" and name:<prefix>
+    try:
+        page = parse_page(options)
+        # Off the event loop: a search first indexes any files written since the last one
+        results, next_cursor, total = await file_io.run('read', partial(search_index.search, query, **page))
+    except ValueError as e:
+        await session.reply(f"Error: {e}")
+        return
+    await session.reply({"results": results, "total": total, "next_cursor": next_cursor})
+
+def apply_request(request, user):
+    """Carry out an approved request's file operation on an apply worker; returns the event to publish"""
+    filename = request['filename']
+    if not is_valid_filename(filename):
+        raise ValueError("Invalid filename")
+    holds_lock = locks.holder(filename) == user
+    if not holds_lock:
+        success, message = locks.acquire_write(filename, user)
+        if not success:
+            raise FileBusy(message)
+    try:
+        if request['action'] == "CREATE":
+            write_text(filename, request['content'])
+            return "file_created"
+        if request['action'] == "EDIT":
+            if catalog.info(filename) is None:
+                raise ValueError("File not found")
+            write_text(filename, request['content'])
+            return "file_edited"
+        if request['action'] == "DELETE":
+            if catalog.info(filename) is not None:
+                remove_file(filename)
+            return "file_deleted"
+        raise ValueError(f"Unknown action '{request['action']}'")
+    finally:
+        if not holds_lock:
+            locks.release_write(filename, user)
+
+def apply_and_record(request_id, user, loop):
+    request = request_store.get(request_id)
+    try:
+        event = apply_request(request, user)
+    except Exception as e:
+        record = request_store.update(request_id, status="failed", error=str(e))
+    else:
+        # Drop the error left by an earlier failed attempt
+        cleared = {'error': None} if request.get('error') else {}
+        record = request_store.update(request_id, status="approved", **cleared)
+        loop.call_soon_threadsafe(partial(events.publish, event, filename=request['filename'], user=user))
+    # Subscribers follow bulk approvals through these, one per request as it finishes
+    details = {'error': record['error']} if record['status'] == "failed" else {}
+    loop.call_soon_threadsafe(partial(events.publish, "request_handled", id=request_id,
+                                      status=record['status'], **details))
+    return record
+
+def queue_requests(requests_to_apply, user, urgent=False):
+    """Hand claimed requests to the apply workers; returns their futures"""
+    loop = asyncio.get_running_loop()
+    return [apply_queue.submit(request['filename'], apply_and_record, request['id'], user, loop, urgent=urgent)
+            for request in requests_to_apply]
+
+@dispatcher.handler('HANDLE_REQUEST')
+async def handle_request_command(session, request_id, decision):
+    approve = decision.lower() == "approve"
+    request = await state_call(request_store.get, request_id)
+    if request is None:
+        await session.reply("Error: Request not found")
+        return
+    claimed = await state_call(request_store.update_many, [request_id], if_status=OPEN_REQUEST_STATUSES,
+                               status="queued" if approve else "rejected",
+                               queued_by=os.getpid() if approve else None)
+    if not claimed:
+        await session.reply(f"Error: Request #{request_id} is already {request['status']}")
+        return
+    if approve:
+        # Served ahead of bulk approvals, after any already queued for the same file
+        record = await asyncio.wrap_future(queue_requests(claimed, session.user, urgent=True)[0])
+        if record['status'] == "failed":
+            await session.reply(f"Error handling request: {record['error']}")
+            return
+        await session.send_listing()
+    else:
+        events.publish("request_handled", id=request_id, status="rejected")
+    await session.reply(f"Request #{request_id} {'approved' if approve else 'rejected'}")
+
+@dispatcher.handler('HANDLE_REQUESTS')
+async def handle_requests_command(session, decision, selector):
+    # HANDLE_REQUESTS::approve|reject::ids=1,2,3 or ::key=value filters (pending requests only)
+    decision = decision.lower()
+    if decision not in ("approve", "reject"):
+        await session.reply("Error: Decision must be approve or reject")
+        return
+    try:
+        ids, filters = parse_selection(selector, REQUEST_FIELDS)
+    except ValueError as e:
+        await session.reply(f"Error: {e}")
+        return
+    if ids is None:
+        if filters.get('status', 'pending') not in OPEN_REQUEST_STATUSES:
+            await session.reply("Error: Only pending or failed requests can be handled")
+            return
+        ids = await state_call(request_store.matching_ids, {'status': 'pending', **filters}, BULK_REQUEST_LIMIT)
+    elif len(ids) > BULK_REQUEST_LIMIT:
+        await session.reply(f"Error: At most {BULK_REQUEST_LIMIT} requests can be handled at once")
+        return
+
+    if decision == "reject":
+        handled = [request['id'] for request in
+                   await state_call(request_store.update_many, ids, if_status=OPEN_REQUEST_STATUSES,
+                                    status="rejected")]
+        for request_id in handled:
+            events.publish("request_handled", id=request_id, status="rejected")
+        await session.reply({"message": f"{len(handled)} requests rejected", "rejected": handled})
+        return
+
+    # Applied in the background; "request_handled" events (or LIST_REQUESTS::status=queued) report progress
+    claimed = await state_call(request_store.update_many, ids, if_status=OPEN_REQUEST_STATUSES, status="queued",
+                               queued_by=os.getpid())
+    queue_requests(claimed, session.user)
+    handled = [request['id'] for request in claimed]
+    await session.reply({"message": f"{len(handled)} requests queued", "queued": handled})
+
+@dispatcher.handler('LOCK')
+async def lock_command(session, filename):
+    # Locking a file again renews the lease on it
+    if await state_call(locks.renew, filename, session.user):
+        await session.reply(f"Lock on '{filename}' renewed")
+        return
+    try:
+        await acquire_lock(locks.acquire_write, filename, session.user)
+    except FileBusy as e:
+        await session.reply(str(e))
+        return
+    events.publish("lock_acquired", filename=filename, user=session.user)
+    await session.reply(f"File '{filename}' locked for editing")
+
+@dispatcher.handler('UNLOCK')
+async def unlock_command(session, filename):
+    if await state_call(locks.release_write, filename, session.user):
+        events.publish("lock_released", filename=filename, user=session.user)
+        await session.reply(f"File '{filename}' unlocked")
+    else:
+        await session.reply("You don't have the lock for this file")
+
+@dispatcher.handler('DELETE')
+async def delete_command(session, filename):
+    # A LOCK the admin holds on the file goes with it; otherwise write_access releases the lock it took
+    locked = await state_call(locks.holder, filename) == session.user
+    try:
+        async with write_access(filename, session.user):
+            if is_valid_filename(filename) and catalog.info(filename) is not None:
+                await file_io.run('meta', remove_file, filename)
+                if locked:
+                    await state_call(locks.release_write, filename, session.user)
+                events.publish("file_deleted", filename=filename, user=session.user)
+                await session.reply(f"File '{filename}' deleted")
+                await session.send_listing()
+            else:
+                await session.reply("File not found")
+    except FileBusy as e:
+        await session.reply(str(e))
+    except Exception as e:
+        await session.reply(f"Error deleting file: {str(e)}")
+
+@dispatcher.handler('UPLOAD')
+async def upload_command(session, action, filename):
+    # UPLOAD::CREATE|EDIT::filename, then the content (binary messages in the
+    # text protocol, UPLOAD_CHUNK frames in the binary one), then UPLOAD_END
+    if action not in ("CREATE", "EDIT"):
+        await session.reply("Error: Invalid UPLOAD command format")
+        return
+    if not is_valid_filename(filename):
+        await session.reply("Error: Invalid filename")
+        return
+    if session.upload is not None:
+        await file_io.run('meta', session.upload[0].abort)
+    session.upload = (await file_io.run('meta', Upload, FILES_DIR), action, filename)
+    await session.reply(f"Ready to receive '{filename}'")
+
+@dispatcher.handler('UPLOAD_CHUNK')
+async def upload_chunk_command(session, data):
+    if session.upload is None:
+        await session.reply("Error: No upload in progress")
+    else:
+        await file_io.run('write', session.upload[0].write, data)
+
+@dispatcher.handler('UPLOAD_ABORT')
+async def upload_abort_command(session):
+    if session.upload is None:
+        await session.reply("Error: No upload in progress")
+        return
+    await file_io.run('meta', session.upload[0].abort)
+    session.upload = None
+    await session.reply("Upload aborted")
+
+@dispatcher.handler('UPLOAD_END')
+async def upload_end_command(session):
+    if session.upload is None:
+        await session.reply("Error: No upload in progress")
+        return
+    received, action, filename = session.upload
+    session.upload = None
+    exists = catalog.info(filename) is not None
+    if action == "CREATE" and exists:
+        await file_io.run('meta', received.abort)
+        await session.reply(f"Error: File '{filename}' already exists")
+        return
+    if action == "EDIT" and not exists:
+        await file_io.run('meta', received.abort)
+        await session.reply("File not found")
+        return
+    try:
+        async with write_access(filename, session.user):
+            await file_io.run('meta', commit_upload, received, filename)
+        events.publish("file_created" if action == "CREATE" else "file_edited",
+                       filename=filename, user=session.user, sha256=received.sha256)
+        await session.reply({
+            "message": f"File '{filename}' uploaded",
+            "size": received.size,
+            "sha256": received.sha256
+        })
+    except FileBusy as e:
+        await file_io.run('meta', received.abort)
+        await session.reply(str(e))
+    except Exception as e:
+        await file_io.run('meta', received.abort)
+        await session.reply(f"Error uploading file: {str(e)}")
+
+@dispatcher.handler('EDIT')
+async def edit_command(session, filename, content):
+    if not is_valid_filename(filename):
+        await session.reply("Error: Invalid filename")
+        return
+    try:
+        async with write_access(filename, session.user):
+            await file_io.run('write', write_text, filename, content)
+        events.publish("file_edited", filename=filename, user=session.user)
+        await session.reply(f"File '{filename}' edited")
+    except FileBusy as e:
+        await session.reply(str(e))
+    except Exception as e:
+        await session.reply(f"Error editing file: {str(e)}")
+
+async def run_command(session, message, tag):
+    """Parse and run one text or binary command message; returns its name"""
+    reply_to.set((0, tag))
+    if isinstance(message, bytes) and not session.binary:
+        # In the text protocol, binary messages carry the content of the upload in progress
+        await upload_chunk_command(session, message)
+        return 'UPLOAD_CHUNK'
+    try:
+        spec, handler, args = dispatcher.parse(message, session.role)
+    except PermissionDenied as e:
+        await session.reply(str(e))
+        return None
+    except CommandError as e:
+        await session.reply(f"Error: {e}")
+        return None
+    reply_to.set((spec.opcode, tag))
+    try:
+        ticket = await admission.enter_async(session.user, session.role, spec.name,
+                                             is_heavy(spec.name, args, catalog))
+    except Overloaded as e:
+        await session.reply(e.to_dict())
+        return spec.name
+    try:
+        await handler(session, *args)
+    finally:
+        admission.leave(ticket)
+    return spec.name
+
+async def serve_command(session, message, tag=None):
+    started = time.perf_counter()
+    try:
+        command = await run_command(session, message, tag)
+    except Exception as e:
+        if tag is None:
+            raise
+        # A failed pipelined command must not take the connection down, and its
+        # tag still gets a reply (reply_to is still set for it)
+        command = None
+        await session.reply(f"Error: {e}")
+    metrics.observe_command(command, time.perf_counter() - started)
 
 async def handle_client(websocket):
-    current_user = None
-    current_role = None
+    session = None
     
     try:
-        # Handle authentication
+        # Handle authentication: TOKEN::<session token> or username::password
         auth_data = await websocket.recv()
         username, password = auth_data.strip().split("::")
 
-        if username in USERS and USERS[username]["password"] == password:
-            current_user = username
-            current_role = USERS[username]["role"]
-            await websocket.send(f"Authentication successful::{current_role}")
+        identity = None
+        if username == "TOKEN":
+            identity = await state_call(sessions.validate, password)
+        elif username in USERS and await file_io.run('auth', verify_password, USERS[username], password):
+            identity = (username, USERS[username]["role"])
+
+        if identity is not None:
+            session = Session(websocket, *identity)
+            active_sessions.inc()
+            await websocket.send(f"Authentication successful::{session.role}")
         else:
             await websocket.send("Authentication failed")
             return
 
-        # Handle commands
+        # Handle commands. "#tag::COMMAND..." (or a TAG_OPCODE frame) is
+        # pipelined: it starts at once and its replies carry the tag. An
+        # untagged command first waits for every pipelined one to finish.
         async for message in websocket:
-            parts = message.split("::")
-            command = parts[0]
-
-            if command == "LOGOUT":
-                if current_user in admin_file_locks.values():
-                    locked_files = [f for f, u in admin_file_locks.items() if u == current_user]
-                    for f in locked_files:
-                        del admin_file_locks[f]
-                await websocket.send("Logged out successfully")
+            try:
+                # Raw binary messages in the text protocol are upload content, never tagged frames
+                tag, message = split_tag(message) if session.binary or isinstance(message, str) else (None, message)
+            except CommandError as e:
+                await session.reply(f"Error: {e}")
+                continue
+            if tag is not None and command_name(message) not in SERIAL_COMMANDS:
+                await session.pipeline_command(message, tag)
+                continue
+            await session.drain()
+            await serve_command(session, message, tag)
+            if session.closing:
                 break
 
-            elif command == "LIST":
-                files = get_file_list()
-                response = {
-                    "files": files,
-                    "locked_files": list(admin_file_locks.keys())
-                }
-                await websocket.send(json.dumps(response))
-
-            elif command == "READ":
-                if len(parts) == 2:
-                    filename = parts[1]
-                    if os.path.exists(filename):
-                        try:
-                            with open(filename, 'r') as f:
-                                content = f.read()
-                            await websocket.send(content)
-                        except Exception as e:
-                            await websocket.send(f"Error reading file: {str(e)}")
-                    else:
-                        await websocket.send("File not found")
-
-            elif command == "CREATE" and current_role == "admin":
-                if len(parts) >= 3:
-                    filename = parts[1]
-                    content = "::".join(parts[2:])
-                    if os.path.exists(filename):
-                        await websocket.send(f"Error: File '{filename}' already exists")
-                        continue
-                    if not filename or filename.startswith('.') or '/' in filename or '\\' in filename:
-                        await websocket.send("Error: Invalid filename")
-                        continue
-                    with file_lock:
-                        with open(filename, 'w') as f:
-                            f.write(content)
-                    await websocket.send(f"File '{filename}' created successfully")
-                    files = get_file_list()
-                    response = {
-                        "files": files,
-                        "locked_files": list(admin_file_locks.keys())
-                    }
-                    await websocket.send(json.dumps(response))
-                else:
-                    await websocket.send("Error: Invalid CREATE command format")
-
-            elif command == "MAKE_REQUEST" and current_role == "user":
-                if len(parts) >= 4:
-                    action = parts[1]
-                    filename = parts[2]
-                    content = "::".join(parts[3:]) if len(parts) > 3 else None
-                    request = FileRequest(current_user, action, filename, content)
-                    with requests_lock:
-                        pending_requests.append(request)
-                    await websocket.send(f"Request #{request.id} submitted successfully")
-
-            elif command == "LIST_REQUESTS" and current_role == "admin":
-                with requests_lock:
-                    requests_data = [req.to_dict() for req in pending_requests]
-                await websocket.send(json.dumps({"requests": requests_data}))
-
-            elif command == "HANDLE_REQUEST" and current_role == "admin":
-                if len(parts) == 3:
-                    request_id = int(parts[1])
-                    approve = parts[2].lower() == "approve"
-                    with requests_lock:
-                        for request in pending_requests:
-                            if request.id == request_id:
-                                if approve:
-                                    try:
-                                        if request.action == "CREATE":
-                                            with file_lock:
-                                                with open(request.filename, 'w') as f:
-                                                    f.write(request.content)
-                                        request.status = "approved"
-                                        files = get_file_list()
-                                        response = {
-                                            "files": files,
-                                            "locked_files": list(admin_file_locks.keys())
-                                        }
-                                        await websocket.send(json.dumps(response))
-                                    except Exception as e:
-                                        await websocket.send(f"Error handling request: {str(e)}")
-                                        continue
-                                else:
-                                    request.status = "rejected"
-                                await websocket.send(f"Request #{request_id} {'approved' if approve else 'rejected'}")
-                                break
-
-            elif command == "LOCK" and current_role == "admin":
-                if len(parts) == 2:
-                    filename = parts[1]
-                    if filename not in admin_file_locks:
-                        admin_file_locks[filename] = current_user
-                        await websocket.send(f"File '{filename}' locked for editing")
-                    else:
-                        await websocket.send(f"File is already locked by {admin_file_locks[filename]}")
-
-            elif command == "UNLOCK" and current_role == "admin":
-                if len(parts) == 2:
-                    filename = parts[1]
-                    if filename in admin_file_locks and admin_file_locks[filename] == current_user:
-                        del admin_file_locks[filename]
-                        await websocket.send(f"File '{filename}' unlocked")
-                    else:
-                        await websocket.send("You don't have the lock for this file")
-
-            elif command == "DELETE" and current_role == "admin":
-                if len(parts) == 2:
-                    filename = parts[1]
-                    if filename in admin_file_locks and admin_file_locks[filename] != current_user:
-                        await websocket.send(f"File is locked by {admin_file_locks[filename]}")
-                        continue
-                    try:
-                        with file_lock:
-                            if os.path.exists(filename):
-                                os.remove(filename)
-                                if filename in admin_file_locks:
-                                    del admin_file_locks[filename]
-                                await websocket.send(f"File '{filename}' deleted")
-                                files = get_file_list()
-                                response = {
-                                    "files": files,
-                                    "locked_files": list(admin_file_locks.keys())
-                                }
-                                await websocket.send(json.dumps(response))
-                            else:
-                                await websocket.send("File not found")
-                    except Exception as e:
-                        await websocket.send(f"Error deleting file: {str(e)}")
-
-            elif command == "EDIT" and current_role == "admin":
-                if len(parts) >= 3:
-                    filename = parts[1]
-                    content = "::".join(parts[2:])
-                    if filename in admin_file_locks and admin_file_locks[filename] != current_user:
-                        await websocket.send(f"File is locked by {admin_file_locks[filename]}")
-                        continue
-                    try:
-                        with file_lock:
-                            with open(filename, 'w') as f:
-                                f.write(content)
-                        await websocket.send(f"File '{filename}' edited")
-                    except Exception as e:
-                        await websocket.send(f"Error editing file: {str(e)}")
-                else:
-                    await websocket.send("Invalid EDIT command format")
-            else:
-                await websocket.send("Unknown command or insufficient permissions")
-
     except Exception as e:
         print(f"[ERROR] {e}")
     finally:
-        if current_user in admin_file_locks.values():
-            locked_files = [f for f, u in admin_file_locks.items() if u == current_user]
-            for f in locked_files:
-                del admin_file_locks[f]
+        if session is not None:
+            await session.cancel_pipeline()
+            active_sessions.dec()
+            if session.subscription is not None:
+                events.unsubscribe(session.subscription)
+            if session.upload is not None:
+                await file_io.run('meta', session.upload[0].abort)
+            for filename in await state_call(locks.release_all, session.user):
+                events.publish("lock_released", filename=filename, user=session.user)
 
 async def start_server():
-    async with websockets.serve(handle_client, HOST, PORT):
+    if REUSE_PORT and not SHARED_STATE:
+        # Each process would have its own locks, requests, events and revoked sessions
+        raise SystemExit("BACKEND_REUSE_PORT=1 needs STATE_BACKEND=sqlite")
+    lag_monitor.start()
+    events.start(partial(file_io.run, 'state'))
+    async with websockets.serve(handle_client, HOST, PORT, process_request=process_request,
+                                reuse_port=REUSE_PORT, compression=COMPRESSION):
         print(f"[SERVER STARTED] Listening on {HOST}:{PORT}")
         await asyncio.Future()
 
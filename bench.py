@@ -0,0 +1,546 @@
+"""Load-test harness for web_server.py and backend.py.
+
+Starts both servers in a scratch directory with their own users and files,
+replays each workload against /command and the websocket protocol, and
+prints one JSON report (ops/sec, latency percentiles, error rate, RSS) so
+runs can be compared:
+
+    python bench.py --workloads read_heavy,lock_contention --ops 2000 -o bench.json
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import websockets
+
+from sessions import hash_password
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-password'
+SEED_FILES = 50
+SEED_FILE_SIZE = 1024
+UPLOAD_CHUNK = 256 * 1024
+LONG_TIMEOUT = 120  # Seconds for a single large-file operation
+
+WEB_BOOT = """
+import logging, sys, web_server
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+web_server.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)
+"""
+BACKEND_BOOT = """
+import asyncio, sys, backend
+backend.HOST, backend.PORT = '127.0.0.1', int(sys.argv[1])
+asyncio.run(backend.start_server())
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_proc_status(pid, field):
+    """A /proc/<pid>/status memory field (e.g. VmHWM) in KiB, or None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 3)
+
+
+class Recorder:
+    """Latencies and error count for one workload against one server."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._finished = None
+
+    def record(self, latency, ok, nbytes=0):
+        with self._lock:
+            self.latencies.append(latency)
+            self.bytes += nbytes
+            if not ok:
+                self.errors += 1
+
+    def finish(self):
+        self._finished = time.perf_counter()
+
+    def report(self):
+        elapsed = (self._finished or time.perf_counter()) - self._started
+        ordered = sorted(self.latencies)
+        ops = len(ordered)
+        result = {
+            "ops": ops,
+            "errors": self.errors,
+            "error_rate": round(self.errors / ops, 4) if ops else 0.0,
+            "seconds": round(elapsed, 3),
+            "ops_per_sec": round(ops / elapsed, 1) if elapsed else None,
+            "p50_ms": percentile(ordered, 0.50),
+            "p95_ms": percentile(ordered, 0.95),
+            "p99_ms": percentile(ordered, 0.99),
+        }
+        if self.bytes:
+            result["mib_per_sec"] = round(self.bytes / elapsed / 2 ** 20, 2) if elapsed else None
+        return result
+
+
+class WebClient:
+    """Keeps one HTTP connection per worker thread."""
+
+    def __init__(self, port, token=None):
+        self.port = port
+        self.token = token
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=LONG_TIMEOUT)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            raise
+
+    def login(self, username):
+        status, body = self.request('POST', '/auth', json.dumps({"username": username, "password": PASSWORD}),
+                                    {'Content-Type': 'application/json'})
+        data = json.loads(body)
+        if data.get('status') != 'success':
+            raise RuntimeError(f"Login as {username} failed: {data.get('message')}")
+        self.token = data['token']
+        return self.token
+
+    def command(self, command):
+        status, body = self.request('POST', '/command', json.dumps({"command": command}),
+                                    {'Content-Type': 'application/json'})
+        if status == 304:
+            return {"status": "success"}
+        return json.loads(body)
+
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+        self.workdir = tempfile.mkdtemp(prefix='fms-bench-')
+        self.admins = [f'bench-admin-{i}' for i in range(options.concurrency)]
+        self.users = [f'bench-user-{i}' for i in range(options.concurrency)]
+        self.tokens = {}
+        self.web = None
+        self.backend = None
+        self._log = None
+
+    # Setup and teardown
+
+    def prepare(self):
+        password_hash = hash_password(PASSWORD)
+        users = {}
+        for name in self.admins + self.users:
+            users[name] = {
+                "password_hash": password_hash,
+                "role": "admin" if name in self.admins else "user",
+                "2fa_secret": base64.b32encode(os.urandom(10)).decode()
+            }
+        with open(os.path.join(self.workdir, 'users.json'), 'w') as f:
+            json.dump(users, f)
+        files_dir = os.path.join(self.workdir, 'files')
+        os.makedirs(files_dir)
+        for i in range(SEED_FILES):
+            with open(os.path.join(files_dir, f'bench-{i}.txt'), 'w') as f:
+                f.write('x' * SEED_FILE_SIZE)
+
+    def start(self):
+        # Measure the servers, not the per-user rate limits
+        env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''), RATE_LIMITS='off')
+        self.web_port, self.backend_port = free_port(), free_port()
+        log = self._log = open(os.path.join(self.workdir, 'servers.log'), 'w')
+        self.web = subprocess.Popen([sys.executable, '-c', WEB_BOOT, str(self.web_port)],
+                                    cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # Started second, so the session secret file already exists and both servers share it
+        self._wait_for_port(self.web_port)
+        self.backend = subprocess.Popen([sys.executable, '-c', BACKEND_BOOT, str(self.backend_port)],
+                                        cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self._wait_for_port(self.backend_port)
+        login = WebClient(self.web_port)
+        for name in self.admins + self.users:
+            self.tokens[name] = login.login(name)
+
+    def _wait_for_port(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for process in (self.web, self.backend):
+                if process is not None and process.poll() is not None:
+                    raise RuntimeError(f"Server exited early; see {self.workdir}/servers.log")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server on port {port} did not start")
+
+    def memory(self):
+        return {
+            name: {"rss_kb": read_proc_status(process.pid, 'VmRSS'),
+                   "peak_rss_kb": read_proc_status(process.pid, 'VmHWM')}
+            for name, process in (('web', self.web), ('backend', self.backend))
+        }
+
+    def stop(self):
+        for process in (self.web, self.backend):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        if self._log is not None:
+            self._log.close()
+        if not self.options.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # Drivers
+
+    def run_web(self, op, ops, users):
+        """Run ``op(client, worker, i)`` ``ops`` times over one thread per user."""
+        recorder = Recorder()
+        counter = iter(range(ops))
+        counter_lock = threading.Lock()
+
+        def worker(index, username):
+            client = WebClient(self.web_port, self.tokens[username])
+            while True:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                started = time.perf_counter()
+                try:
+                    ok, nbytes = op(client, index, i)
+                except Exception:
+                    ok, nbytes = False, 0
+                recorder.record(time.perf_counter() - started, ok, nbytes)
+
+        threads = [threading.Thread(target=worker, args=(index, name)) for index, name in enumerate(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        recorder.finish()
+        return recorder.report()
+
+    async def connect(self, username):
+        websocket = await websockets.connect(f'ws://127.0.0.1:{self.backend_port}', max_size=None,
+                                             open_timeout=LONG_TIMEOUT)
+        await websocket.send(f'TOKEN::{self.tokens[username]}')
+        reply = await websocket.recv()
+        if not reply.startswith('Authentication successful'):
+            raise RuntimeError(f"Websocket login as {username} failed: {reply}")
+        return websocket
+
+    async def run_ws(self, op, ops, users):
+        """Run ``await op(websocket, worker, i)`` ``ops`` times over one connection per user."""
+        recorder = Recorder()
+        counter = iter(range(ops))
+
+        async def worker(index, username):
+            websocket = await self.connect(username)
+            try:
+                for i in counter:
+                    started = time.perf_counter()
+                    try:
+                        ok, nbytes = await op(websocket, index, i)
+                    except websockets.ConnectionClosed:
+                        recorder.record(time.perf_counter() - started, False)
+                        return
+                    except Exception:
+                        ok, nbytes = False, 0
+                    recorder.record(time.perf_counter() - started, ok, nbytes)
+            finally:
+                await websocket.close()
+
+        await asyncio.gather(*(worker(index, name) for index, name in enumerate(users)))
+        recorder.finish()
+        return recorder.report()
+
+    def both(self, web_op, ws_op, ops, users):
+        return {
+            "web": self.run_web(web_op, ops, users),
+            "backend": asyncio.run(self.run_ws(ws_op, ops, users)),
+        }
+
+
+WORKLOADS = {}
+
+
+def workload(func):
+    WORKLOADS[func.__name__] = func
+    return func
+
+
+def ok_json(data):
+    return data.get('status') == 'success'
+
+
+def ok_text(reply):
+    return isinstance(reply, str) and not reply.startswith(('Error', 'Unknown', 'File not found', 'Timed out'))
+
+
+@workload
+def read_heavy(bench):
+    """90% READ of small files, 10% LIST, from regular users."""
+    def web_op(client, worker, i):
+        if i % 10 == 0:
+            return ok_json(client.command('LIST')), 0
+        data = client.command(f'READ::bench-{i % SEED_FILES}.txt')
+        return ok_json(data), len(data.get('content', ''))
+
+    async def ws_op(websocket, worker, i):
+        await websocket.send('LIST' if i % 10 == 0 else f'READ::bench-{i % SEED_FILES}.txt')
+        reply = await websocket.recv()
+        return ok_text(reply), len(reply)
+
+    return bench.both(web_op, ws_op, bench.options.ops, bench.users)
+
+
+@workload
+def write_heavy(bench):
+    """EDIT spread over the seed files by admins."""
+    content = 'y' * SEED_FILE_SIZE
+
+    def web_op(client, worker, i):
+        return ok_json(client.command(f'EDIT::bench-{i % SEED_FILES}.txt::{content}')), len(content)
+
+    async def ws_op(websocket, worker, i):
+        await websocket.send(f'EDIT::bench-{i % SEED_FILES}.txt::{content}')
+        return ok_text(await websocket.recv()), len(content)
+
+    return bench.both(web_op, ws_op, bench.options.ops, bench.admins)
+
+
+@workload
+def lock_contention(bench):
+    """Every admin repeatedly LOCKs, EDITs and UNLOCKs one hot file."""
+    hot = 'bench-0.txt'
+
+    def web_op(client, worker, i):
+        if not ok_json(client.command(f'LOCK::{hot}')):
+            return False, 0
+        try:
+            return ok_json(client.command(f'EDIT::{hot}::{worker}-{i}')), 0
+        finally:
+            client.command(f'UNLOCK::{hot}')
+
+    async def ws_op(websocket, worker, i):
+        await websocket.send(f'LOCK::{hot}')
+        if 'locked' not in await websocket.recv():
+            return False, 0
+        try:
+            await websocket.send(f'EDIT::{hot}::{worker}-{i}')
+            return ok_text(await websocket.recv()), 0
+        finally:
+            await websocket.send(f'UNLOCK::{hot}')
+            await websocket.recv()
+
+    return bench.both(web_op, ws_op, bench.options.ops // 4 or 1, bench.admins)
+
+
+@workload
+def large_files(bench):
+    """Alternate uploading and reading back one large file per admin."""
+    size = bench.options.large_mib * 2 ** 20
+    payload = os.urandom(size)
+
+    created = set()  # Each worker's file is CREATEd by its first upload, then EDITed
+
+    def web_op(client, worker, i):
+        name = f'large-web-{worker}.bin'
+        if i % 2 == 0 or name not in created:
+            action = 'EDIT' if name in created else 'CREATE'
+            status, body = client.request('PUT', f'/upload/{name}?action={action}', payload,
+                                          {'Content-Type': 'application/octet-stream'})
+            created.add(name)
+            return status == 200, size
+        status, body = client.request('GET', f'/files/{name}')
+        return status == 200 and len(body) == size, len(body)
+
+    async def ws_op(websocket, worker, i):
+        name = f'large-ws-{worker}.bin'
+        if i % 2 == 0 or name not in created:
+            await websocket.send(f"UPLOAD::{'EDIT' if name in created else 'CREATE'}::{name}")
+            if not ok_text(await websocket.recv()):
+                return False, 0
+            for offset in range(0, size, UPLOAD_CHUNK):
+                await websocket.send(payload[offset:offset + UPLOAD_CHUNK])
+            await websocket.send('UPLOAD_END')
+            created.add(name)
+            return (await websocket.recv()).startswith('{'), size
+        await websocket.send(f'READ_RANGE::{name}::0')
+        reply = await websocket.recv()
+        return isinstance(reply, bytes) and len(reply) == size, len(reply)
+
+    return bench.both(web_op, ws_op, bench.options.large_ops, bench.admins)
+
+
+@workload
+def request_queue(bench):
+    """Grow the request queue to N entries, then page through all of it."""
+    n = bench.options.requests
+
+    def web_submit(client, worker, i):
+        return ok_json(client.command(f'MAKE_REQUEST::CREATE::queued-{i}.txt::content {i}')), 0
+
+    async def ws_submit(websocket, worker, i):
+        await websocket.send(f'MAKE_REQUEST::CREATE::queued-{i}.txt::content {i}')
+        return 'submitted' in await websocket.recv(), 0
+
+    result = {
+        "web": {"submit": bench.run_web(web_submit, n, bench.users)},
+        "backend": {"submit": asyncio.run(bench.run_ws(ws_submit, n, bench.users))},
+    }
+
+    # One admin pages through the whole queue, 50 at a time
+    pages = {"web": Recorder(), "backend": Recorder()}
+    client = WebClient(bench.web_port, bench.tokens[bench.admins[0]])
+    cursor = ''
+    while True:
+        started = time.perf_counter()
+        data = client.command(f'LIST_REQUESTS::status=pending::limit=50{cursor}')
+        pages["web"].record(time.perf_counter() - started, ok_json(data))
+        if not ok_json(data) or data.get('next_cursor') is None:
+            break
+        cursor = f"::cursor={data['next_cursor']}"
+
+    async def page_backend():
+        websocket = await bench.connect(bench.admins[0])
+        cursor = ''
+        try:
+            while True:
+                started = time.perf_counter()
+                await websocket.send(f'LIST_REQUESTS::status=pending::limit=50{cursor}')
+                reply = await websocket.recv()
+                ok = reply.startswith('{')
+                pages["backend"].record(time.perf_counter() - started, ok)
+                next_cursor = json.loads(reply).get('next_cursor') if ok else None
+                if next_cursor is None:
+                    break
+                cursor = f'::cursor={next_cursor}'
+        finally:
+            await websocket.close()
+
+    asyncio.run(page_backend())
+    for server, recorder in pages.items():
+        recorder.finish()
+        result[server]["list_pages"] = recorder.report()
+    return result
+
+
+@workload
+def idle_websockets(bench):
+    """Hold many idle authenticated connections while one client keeps issuing LIST."""
+    n = bench.options.idle
+
+    async def run():
+        rss_before = read_proc_status(bench.backend.pid, 'VmRSS')
+        started = time.perf_counter()
+        idle = []
+        failed = 0
+        for i in range(n):
+            try:
+                idle.append(await bench.connect(bench.users[i % len(bench.users)]))
+            except Exception:
+                failed += 1
+        connect_seconds = time.perf_counter() - started
+        rss_after = read_proc_status(bench.backend.pid, 'VmRSS')
+
+        async def list_op(websocket, worker, i):
+            await websocket.send('LIST')
+            return ok_text(await websocket.recv()), 0
+
+        active = await bench.run_ws(list_op, bench.options.ops // 4 or 1, bench.users[:1])
+        await asyncio.gather(*(websocket.close() for websocket in idle), return_exceptions=True)
+        per_connection = None
+        if rss_before is not None and rss_after is not None and idle:
+            per_connection = round((rss_after - rss_before) / len(idle), 2)
+        return {
+            "connections": len(idle),
+            "connect_errors": failed,
+            "connect_seconds": round(connect_seconds, 3),
+            "rss_kb_per_connection": per_connection,
+            "active_list": active,
+        }
+
+    return {"backend": asyncio.run(run())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help=f"comma-separated subset of: {', '.join(WORKLOADS)}")
+    parser.add_argument('--ops', type=int, default=1000, help='operations per workload and server')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--large-mib', type=int, default=8, help='size of large_files payloads')
+    parser.add_argument('--large-ops', type=int, default=40, help='operations in large_files')
+    parser.add_argument('--requests', type=int, default=2000, help='queue size for request_queue')
+    parser.add_argument('--idle', type=int, default=500, help='connections for idle_websockets')
+    parser.add_argument('-o', '--output', help='also write the JSON report here')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    options = parser.parse_args()
+
+    names = [name for name in options.workloads.split(',') if name]
+    unknown = [name for name in names if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(unknown)}")
+
+    bench = Bench(options)
+    report = {
+        "started": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "options": {key: value for key, value in vars(options).items() if key not in ('output', 'keep')},
+        "workloads": {},
+    }
+    try:
+        bench.prepare()
+        bench.start()
+        for name in names:
+            result = WORKLOADS[name](bench)
+            result["memory"] = bench.memory()
+            report["workloads"][name] = result
+        report["memory"] = bench.memory()
+    finally:
+        bench.stop()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
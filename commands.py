@@ -0,0 +1,255 @@
+import struct
+
+SEPARATOR = '::'
+FRAME_MAGIC = 0xFB  # First byte of every binary frame
+FRAME_MIMETYPE = 'application/x-fms-frame'
+FRAME_HEADER = struct.Struct('>BBH')  # magic, opcode, number of fields
+FIELD_LENGTH = struct.Struct('>I')
+TAG_PREFIX = '#'  # "#tag::NAME::..." is a tagged (pipelined) text command
+TAG_OPCODE = 0  # A frame with fields [tag, command frame] is a tagged binary command
+
+# Kinds of reply body in a binary reply frame
+REPLY_TEXT = b't'
+REPLY_JSON = b'j'
+REPLY_BYTES = b'b'
+
+
+class CommandError(ValueError):
+    """A command that cannot be run as sent; the message is shown to the client."""
+
+
+class PermissionDenied(CommandError):
+    """An unknown command, or one the user's role may not run."""
+
+
+class Arg:
+    """One declared argument of a command.
+
+    ``rest`` takes everything after the previous arguments as one value (so
+    file content may contain the separator); ``variadic`` takes the remaining
+    fields as a list. ``choices`` limits the value to the ones listed.
+    """
+    __slots__ = ('name', 'type', 'required', 'rest', 'variadic', 'choices')
+
+    def __init__(self, name, type=str, required=True, rest=False, variadic=False, choices=None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.rest = rest
+        self.variadic = variadic
+        self.choices = tuple(choices) if choices else None
+
+    def convert(self, value):
+        if self.type is bytes:
+            return value if isinstance(value, bytes) else value.encode()
+        if isinstance(value, bytes):
+            value = value.decode()
+        if self.type is int:
+            try:
+                return int(value)
+            except ValueError:
+                raise CommandError(f"{self.name} must be a number") from None
+        if self.choices is not None and value not in self.choices:
+            raise CommandError(f"{self.name} must be one of {', '.join(self.choices)}")
+        return value
+
+
+class Command:
+    """Name, opcode, argument schema and permitted roles of one command."""
+    __slots__ = ('name', 'opcode', 'args', 'roles')
+
+    def __init__(self, name, opcode, args=(), roles=None):
+        self.name = name
+        self.opcode = opcode
+        self.args = tuple(args)
+        self.roles = frozenset(roles) if roles else None  # None: any logged-in user
+
+    @property
+    def usage(self):
+        parts = [self.name]
+        for arg in self.args:
+            label = f"{arg.name}..." if arg.variadic else arg.name
+            parts.append(label if arg.required else f"[{label}]")
+        return SEPARATOR.join(parts)
+
+    def allows(self, role):
+        return self.roles is None or role in self.roles
+
+    def bind(self, fields, joined=False):
+        """Convert raw fields to argument values, checking them against the schema.
+
+        ``joined`` is set for the text format, where a ``rest`` argument was
+        split on the separator and has to be put back together.
+        """
+        values = []
+        index = 0
+        for arg in self.args:
+            if arg.variadic:
+                values.append([arg.convert(field) for field in fields[index:]])
+                index = len(fields)
+                continue
+            if index >= len(fields):
+                if arg.required:
+                    raise CommandError(f"Usage: {self.usage}")
+                values.append(None)
+                continue
+            if arg.rest and joined:
+                values.append(arg.convert(SEPARATOR.join(fields[index:])))
+                index = len(fields)
+            else:
+                values.append(arg.convert(fields[index]))
+                index += 1
+        if index < len(fields):
+            raise CommandError(f"Usage: {self.usage}")
+        return values
+
+
+COMMANDS = {}  # name -> Command
+OPCODES = {}  # opcode -> Command
+
+
+def register(name, opcode, *args, roles=None):
+    spec = Command(name, opcode, args, roles)
+    if name in COMMANDS or opcode in OPCODES:
+        raise ValueError(f"Command {name} or opcode {opcode} registered twice")
+    COMMANDS[name] = OPCODES[opcode] = spec
+    return spec
+
+
+ADMIN = ('admin',)
+USER = ('user',)
+REQUEST_TYPES = ('CREATE', 'EDIT', 'DELETE')  # File operations a user may ask an admin to approve
+
+register('LIST', 1, Arg('option', required=False))  # "details" (web) or a previous etag (websocket)
+register('READ', 2, Arg('filename'), Arg('etag', required=False))  # etag: answer unchanged content with not_modified
+register('READ_RANGE', 3, Arg('filename'), Arg('offset', int), Arg('length', int, required=False))
+register('CREATE', 4, Arg('filename'), Arg('content', rest=True), roles=ADMIN)
+register('EDIT', 5, Arg('filename'), Arg('content', rest=True), roles=ADMIN)
+register('DELETE', 6, Arg('filename'), roles=ADMIN)
+register('LOCK', 7, Arg('filename'), roles=ADMIN)
+register('UNLOCK', 8, Arg('filename'), roles=ADMIN)
+register('MAKE_REQUEST', 9, Arg('action', choices=REQUEST_TYPES), Arg('filename'), Arg('content', rest=True), roles=USER)
+register('LIST_REQUESTS', 10, Arg('query', variadic=True), roles=ADMIN)
+register('HANDLE_REQUEST', 11, Arg('request_id', int), Arg('decision'), roles=ADMIN)
+register('LOGOUT', 12)
+register('SUBSCRIBE', 13, Arg('topics', required=False))
+register('UNSUBSCRIBE', 14)
+register('STATS', 15, roles=ADMIN)
+register('UPLOAD', 16, Arg('action'), Arg('filename'), roles=ADMIN)
+register('UPLOAD_CHUNK', 17, Arg('data', bytes), roles=ADMIN)
+register('UPLOAD_END', 18, roles=ADMIN)
+register('UPLOAD_ABORT', 19, roles=ADMIN)
+register('PROTOCOL', 20, Arg('mode'))
+register('HANDLE_REQUESTS', 21, Arg('decision'), Arg('selector', variadic=True), roles=ADMIN)
+register('SEARCH', 22, Arg('query'), Arg('options', variadic=True))  # options: cursor=N, limit=N
+register('READ_ENCODED', 23, Arg('filename'), Arg('accept', required=False))  # accept: codecs, e.g. "gzip,zstd"
+
+
+def encode_frame(opcode, fields):
+    """Length-prefixed binary frame: header, then a 4-byte length before each field."""
+    out = [FRAME_HEADER.pack(FRAME_MAGIC, opcode, len(fields))]
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode()
+        elif isinstance(field, int):
+            field = str(field).encode()
+        out.append(FIELD_LENGTH.pack(len(field)))
+        out.append(field)
+    return b''.join(out)
+
+
+def decode_frame(data):
+    """Split a binary frame into (opcode, list of raw byte fields)."""
+    view = memoryview(data)
+    if len(view) < FRAME_HEADER.size:
+        raise CommandError("Truncated frame")
+    magic, opcode, count = FRAME_HEADER.unpack_from(view)
+    if magic != FRAME_MAGIC:
+        raise CommandError("Not a command frame")
+    offset = FRAME_HEADER.size
+    fields = []
+    for _ in range(count):
+        if offset + FIELD_LENGTH.size > len(view):
+            raise CommandError("Truncated frame")
+        (length,) = FIELD_LENGTH.unpack_from(view, offset)
+        offset += FIELD_LENGTH.size
+        if offset + length > len(view):
+            raise CommandError("Truncated frame")
+        fields.append(bytes(view[offset:offset + length]))
+        offset += length
+    if offset != len(view):
+        raise CommandError("Trailing bytes after frame")
+    return opcode, fields
+
+
+def split_tag(message):
+    """Separate a pipelining tag from a command -> (tag or None, command message)."""
+    if isinstance(message, str):
+        if message.startswith(TAG_PREFIX):
+            tag, _, message = message[len(TAG_PREFIX):].partition(SEPARATOR)
+            return tag, message
+        return None, message
+    if len(message) >= 2 and message[0] == FRAME_MAGIC and message[1] == TAG_OPCODE:
+        _, fields = decode_frame(message)
+        if len(fields) != 2:
+            raise CommandError("Tagged frame must hold a tag and a command frame")
+        return fields[0].decode(), fields[1]
+    return None, message
+
+
+def command_name(message):
+    """Name of the command in an untagged text or binary message, without parsing its arguments."""
+    if isinstance(message, str):
+        return message.split(SEPARATOR, 1)[0]
+    spec = OPCODES.get(message[1]) if len(message) >= 2 and message[0] == FRAME_MAGIC else None
+    return spec.name if spec is not None else None
+
+
+def reply_frame_header(opcode, kind, length, tag=None):
+    """Header of a reply frame whose body (``length`` bytes) is sent after it.
+
+    A reply frame's fields are the kind of body (REPLY_TEXT, REPLY_JSON or
+    REPLY_BYTES) and the body itself, preceded by the tag for a tagged command.
+    """
+    fields = [kind] if tag is None else [tag.encode(), kind]
+    header = [FRAME_HEADER.pack(FRAME_MAGIC, opcode, len(fields) + 1)]
+    for field in fields:
+        header.append(FIELD_LENGTH.pack(len(field)))
+        header.append(field)
+    header.append(FIELD_LENGTH.pack(length))
+    return b''.join(header)
+
+
+class Dispatcher:
+    """Binds the shared command table to one server's handler functions."""
+
+    def __init__(self, denied_message):
+        self.denied_message = denied_message
+        self.handlers = {}
+
+    def handler(self, name):
+        spec = COMMANDS[name]
+
+        def decorator(func):
+            self.handlers[spec.name] = func
+            return func
+        return decorator
+
+    def parse(self, message, role):
+        """Text (``NAME::arg::arg``) or binary frame -> (Command, handler, argument values).
+
+        Raises CommandError for unknown commands, commands this role may not
+        run, and arguments that do not fit the command's schema.
+        """
+        if isinstance(message, str):
+            fields = message.split(SEPARATOR)
+            spec = COMMANDS.get(fields.pop(0))
+            joined = True
+        else:
+            opcode, fields = decode_frame(message)
+            spec = OPCODES.get(opcode)
+            joined = False
+        handler = self.handlers.get(spec.name) if spec is not None else None
+        if handler is None or not spec.allows(role):
+            raise PermissionDenied(self.denied_message)
+        return spec, handler, spec.bind(fields, joined)
@@ -0,0 +1,75 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+CONTENT_CACHE_BYTES = int(os.environ.get('CONTENT_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+class CachedContent:
+    __slots__ = ('version', 'content', 'etag', 'cost')
+
+    def __init__(self, version, content, etag, cost):
+        self.version = version
+        self.content = content
+        self.etag = etag
+        self.cost = cost
+
+
+class ContentCache:
+    """LRU of file contents keyed by filename, bounded by the memory they take.
+
+    Every entry records the version of the file it was read at (the catalog
+    entry's size, mtime and generation); ``get`` only returns an entry whose
+    version is still current. Writers in this process ``invalidate`` the file
+    they changed, so their own edits are never served stale. A change made
+    behind our back (by the other server or by hand) is only noticed once the
+    catalog has seen it, through inotify or its next rescan, so until then the
+    old content may still be served.
+    """
+
+    def __init__(self, max_bytes=CONTENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # filename -> CachedContent, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, name, version):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return entry
+
+    def put(self, name, version, content, etag):
+        """Cache ``content`` as read at ``version``; returns the entry (kept only if it fits)."""
+        entry = CachedContent(version, content, etag, sys.getsizeof(content) + sys.getsizeof(name))
+        if entry.cost > self.max_bytes:
+            return entry
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.bytes -= old.cost
+            self._entries[name] = entry
+            self.bytes += entry.cost
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.cost
+        return entry
+
+    def invalidate(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self.bytes -= entry.cost
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
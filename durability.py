@@ -0,0 +1,221 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future
+
+# "none": rename into place, leave flushing to the OS; "fsync": every writer
+# fsyncs its own file and directory; "group": concurrent writers share fsyncs
+DURABILITY = os.environ.get('DURABILITY', 'group')
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 0)) / 1000  # Extra wait for writers to join a batch; batches also form while a flush runs
+MODES = ('none', 'fsync', 'group')
+
+
+def _load_syncfs():
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    try:
+        syncfs = ctypes.CDLL(libc_name, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+    def call(fd):
+        if syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    return call
+
+
+_syncfs = _load_syncfs()  # Flushes a whole filesystem in one call (Linux)
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_temp(directory, text=False):
+    """New hidden temp file in ``directory``, where a rename into place is atomic -> (file, path)."""
+    path = os.path.join(directory, f'.tmp-{uuid.uuid4().hex}')
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    return os.fdopen(fd, 'w' if text else 'wb'), path
+
+
+def _fsync(target):
+    if isinstance(target, int):
+        os.fsync(target)
+    else:
+        _fsync_path(target)
+
+
+def _flush(targets):
+    """fsync every target (an fd or a path), with one syncfs for several on one filesystem."""
+    if _syncfs is None:
+        for target in targets:
+            _fsync(target)
+        return
+    by_device = defaultdict(list)
+    for target in targets:
+        st = os.fstat(target) if isinstance(target, int) else os.stat(target)
+        by_device[st.st_dev].append(target)
+    for group in by_device.values():
+        if len(group) == 1:
+            _fsync(group[0])
+            continue
+        target = group[0]
+        if isinstance(target, int):
+            _syncfs(target)
+        else:
+            fd = os.open(target, os.O_RDONLY)
+            try:
+                _syncfs(fd)
+            finally:
+                os.close(fd)
+
+
+class _Commit:
+    __slots__ = ('fd', 'tmp_path', 'dest_path', 'after', 'future')
+
+    def __init__(self, fd, tmp_path, dest_path, after):
+        self.fd = fd
+        self.tmp_path = tmp_path
+        self.dest_path = dest_path
+        self.after = after
+        self.future = Future()
+
+
+class Durability:
+    """How far a write is pushed to disk before the writer carries on.
+
+    ``replace`` puts a finished temp file in place of its destination, so
+    readers and a crash see either the old or the new content, never a torn
+    file; ``sync`` makes appended data durable. In "group" mode the calls of
+    concurrent writers are collected by one committer thread. Each round it
+    flushes a whole batch with one syncfs per filesystem (instead of one
+    fsync per file and per directory), renames the batch into place, and
+    lets the next round's flush make those renames durable too, so under
+    load every flush serves two batches.
+    """
+
+    def __init__(self, mode=DURABILITY, window=GROUP_COMMIT_WINDOW):
+        if mode not in MODES:
+            raise ValueError(f"Unknown DURABILITY '{mode}', expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.window = window
+        self.batches = 0
+        self.commits = 0
+        self._cond = threading.Condition()
+        self._pending = []
+        self._committer = None
+
+    @property
+    def syncs(self):
+        return self.mode != 'none'
+
+    def sync(self, fd):
+        """Make what was written (and flushed) to ``fd`` durable."""
+        if self.mode == 'none':
+            return
+        if self.mode == 'fsync':
+            os.fsync(fd)
+            return
+        self._submit(_Commit(fd, None, None, ()))
+
+    def replace(self, tmp_path, dest_path, fd=None, after=()):
+        """Rename ``tmp_path`` over ``dest_path`` once its content is durable.
+
+        ``fd`` is the temp file, still open and flushed, if the caller has it;
+        ``after`` lists other files that must be durable first (e.g. data a
+        manifest refers to).
+        """
+        if self.mode == 'none':
+            os.replace(tmp_path, dest_path)
+            return
+        if self.mode == 'fsync':
+            for path in after:
+                _fsync_path(path)
+            for directory in {os.path.dirname(path) for path in after}:
+                _fsync_path(directory)
+            _fsync(tmp_path if fd is None else fd)
+            os.replace(tmp_path, dest_path)
+            _fsync_path(os.path.dirname(dest_path) or '.')
+            return
+        self._submit(_Commit(fd, tmp_path, dest_path, after))
+
+    def write(self, dest_path, data, after=()):
+        """Replace ``dest_path`` with ``data`` (str or bytes) through a temp file."""
+        f, tmp_path = open_temp(os.path.dirname(dest_path) or '.', text=isinstance(data, str))
+        try:
+            with f:
+                f.write(data)
+                f.flush()
+                self.replace(tmp_path, dest_path, f.fileno(), after)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _submit(self, commit):
+        with self._cond:
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._committer.start()
+            self._pending.append(commit)
+            self._cond.notify()
+        commit.future.result()
+
+    def _run(self):
+        # Each round makes one flush cover the data of newly submitted commits
+        # and the renames done at the end of the previous round
+        renamed = []
+        while True:
+            with self._cond:
+                while not self._pending and not renamed:
+                    self._cond.wait()
+            if self.window and not renamed:
+                time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            renamed = self._commit(batch, renamed)
+
+    def _commit(self, batch, renamed):
+        """Flush, acknowledge ``renamed``, then rename ``batch``; returns the commits now awaiting a flush."""
+        targets = {os.path.dirname(commit.dest_path) or '.' for commit in renamed}
+        for commit in batch:
+            targets.add(commit.tmp_path if commit.fd is None else commit.fd)
+            targets.update(commit.after)
+            targets.update(os.path.dirname(path) for path in commit.after)
+        try:
+            _flush(targets)
+        except OSError as e:
+            for commit in batch + renamed:
+                commit.future.set_exception(e)
+            return []
+
+        self.batches += 1
+        self.commits += len(renamed)
+        for commit in renamed:
+            commit.future.set_result(None)
+        waiting = []
+        for commit in batch:
+            if commit.dest_path is None:
+                self.commits += 1
+                commit.future.set_result(None)
+                continue
+            try:
+                os.replace(commit.tmp_path, commit.dest_path)
+            except OSError as e:
+                commit.future.set_exception(e)
+                continue
+            waiting.append(commit)
+        return waiting
+
+    def stats(self):
+        return {"mode": self.mode, "batches": self.batches, "commits": self.commits}
@@ -0,0 +1,117 @@
+import asyncio
+import json
+from collections import OrderedDict
+
+SEND_QUEUE_SIZE = 256  # Pending events per subscriber before the oldest are dropped
+RELAY_INTERVAL = 0.1  # Seconds between exchanges with a shared event log
+TOPICS = ('file', 'lock', 'request')
+
+
+class Subscription:
+    """One websocket's queue of pending events, drained by its own sender task.
+
+    Events about the same object (e.g. the same file) replace each other while
+    they wait, so a slow client receives the latest state rather than every
+    intermediate step. If the queue still overflows, the oldest events are
+    dropped and the client is told to resync.
+    """
+
+    def __init__(self, websocket, topics, maxsize=SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.topics = set(topics)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    def offer(self, key, event):
+        if key in self._pending:
+            self._pending[key] = event
+        else:
+            if len(self._pending) >= self.maxsize:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+                self._pending.pop(('resync',), None)
+                self._pending[('resync',)] = {"event": "resync"}
+            self._pending[key] = event
+        self._ready.set()
+
+    async def _pump(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self._pending:
+                    _, event = self._pending.popitem(last=False)
+                    await self.websocket.send(json.dumps(event))
+        except Exception:
+            pass  # Connection closed; the handler unsubscribes us
+
+    def close(self):
+        self._task.cancel()
+
+
+class EventBus:
+    """Broadcasts change events to every subscribed websocket session.
+
+    ``publish`` only enqueues, so it never waits on a client; it must be called
+    from the event loop thread. With a shared ``log`` (see state_backend.py),
+    ``start`` relays events to and from the other processes using it every
+    ``relay_interval`` seconds.
+    """
+
+    def __init__(self, log=None, relay_interval=RELAY_INTERVAL):
+        self.log = log
+        self.relay_interval = relay_interval
+        self._subscriptions = set()
+        self._outgoing = []
+        self._relay = None
+
+    def subscribe(self, websocket, topics=TOPICS):
+        subscription = Subscription(websocket, topics)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.discard(subscription)
+            subscription.close()
+
+    def publish(self, event_type, **fields):
+        event = {"event": event_type, **fields}
+        self._deliver(event)
+        if self.log is not None:
+            self._outgoing.append(event)
+
+    def _deliver(self, event):
+        topic = event['event'].split('_', 1)[0]
+        # Requests are coalesced per request, files and locks per file
+        key = (topic, event.get('id') if topic == 'request' else event.get('filename'))
+        for subscription in self._subscriptions:
+            if topic in subscription.topics:
+                subscription.offer(key, event)
+
+    def start(self, run):
+        """Start relaying through the shared log, if any.
+
+        ``run(func, *args)`` is awaited to call the log's blocking methods off the loop.
+        """
+        if self.log is not None and self._relay is None:
+            self._relay = asyncio.create_task(self._run_relay(run))
+
+    async def _run_relay(self, run):
+        after = await run(self.log.latest)
+        while True:
+            await asyncio.sleep(self.relay_interval)
+            outgoing, self._outgoing = self._outgoing, []
+            try:
+                received, after = await run(self.log.exchange, outgoing, after)
+            except Exception as e:
+                print(f"[EVENTS] Relay failed, {len(outgoing)} events not shared: {e}")
+                continue
+            for event in received:
+                self._deliver(event)
+
+    def __len__(self):
+        return len(self._subscriptions)
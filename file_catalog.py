@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+import uuid
+
+POLL_INTERVAL = 2.0  # Seconds between rescans when inotify is unavailable
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class FileInfo:
+    __slots__ = ('size', 'mtime', 'sha256', 'generation')
+
+    def __init__(self, size, mtime, sha256=None, generation=0):
+        self.size = size
+        self.mtime = mtime
+        self.sha256 = sha256  # Computed on first request unless supplied by a write
+        self.generation = generation  # Catalog version this entry was recorded at
+
+    @property
+    def version(self):
+        """Identifies this content, even across writes that keep size and mtime."""
+        return (self.size, self.mtime, self.generation)
+
+    def to_dict(self):
+        return {"size": self.size, "mtime": self.mtime, "sha256": self.sha256}
+
+
+class FileCatalog:
+    """In-memory index of the files held by a store (see file_store.py).
+
+    The store is scanned once; after that the index is updated from the
+    server's own writes (``refresh``) and from inotify events on the store's
+    ``watch_dir``, or a periodic rescan where inotify is not available. Every
+    change bumps ``version``, so ``etag`` identifies one exact listing.
+    """
+
+    def __init__(self, store, watch=True, poll_interval=POLL_INTERVAL):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._names = None  # Sorted listing, rebuilt after a change
+        self._instance = uuid.uuid4().hex[:8]  # Keeps ETags unique across restarts
+        self.rescan()
+        if watch:
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    @property
+    def etag(self):
+        return f"{self._instance}-{self.version}"
+
+    def names(self):
+        with self._lock:
+            if self._names is None:
+                self._names = sorted(self._entries)
+            return self._names
+
+    def info(self, name):
+        return self._entries.get(name)
+
+    def details(self):
+        """Map of every file to its size, mtime and content hash."""
+        result = {}
+        for name in self.names():
+            self.sha256(name)
+            info = self._entries.get(name)
+            if info is not None:
+                result[name] = info.to_dict()
+        return result
+
+    def sha256(self, name):
+        info = self._entries.get(name)
+        if info is None:
+            return None
+        if info.sha256 is None:
+            try:
+                info.sha256 = self.store.sha256(name)
+            except OSError:
+                return None
+        return info.sha256
+
+    def entry_tag(self, name):
+        """Tag of the current entry for ``name``, new for every change this catalog records; None if unknown."""
+        info = self._entries.get(name)
+        return None if info is None else f"{self._instance}-{info.generation}"
+
+    def refresh(self, name, sha256=None, written=False):
+        """Re-read one file's metadata after it was created, changed or removed.
+
+        ``written`` means this server just wrote the file: it has changed even
+        if size and mtime have not (a same-size edit within one timestamp
+        tick), so the old hash is dropped and the version bumped regardless.
+        """
+        st = self.store.stat(name)
+        with self._lock:
+            old = self._entries.get(name)
+            if st is None:
+                if old is None:
+                    return
+                del self._entries[name]
+            else:
+                size, mtime, stored_sha256 = st
+                sha256 = sha256 or stored_sha256
+                if (not written and old is not None and sha256 in (None, old.sha256)
+                        and old.size == size and old.mtime == mtime):
+                    return
+            self.version += 1
+            if st is not None:
+                self._entries[name] = FileInfo(size, mtime, sha256, self.version)
+            if old is None or st is None:
+                self._names = None
+
+    def rescan(self):
+        """Rebuild the index from a full scan of the store."""
+        entries = self.store.scan()
+        with self._lock:
+            changed = entries.keys() != self._entries.keys()
+            for name, (size, mtime) in entries.items():
+                old = self._entries.get(name)
+                if old is None or old.size != size or old.mtime != mtime:
+                    self._entries[name] = FileInfo(size, mtime, generation=self.version + 1)
+                    changed = True
+            for name in self._entries.keys() - entries.keys():
+                del self._entries[name]
+            if changed:
+                self._names = None
+                self.version += 1
+
+    def _watch(self):
+        fd = self._inotify_fd()
+        if fd is None:
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    self.rescan()
+                except OSError:
+                    pass
+        buf_size = 64 * 1024
+        while True:
+            data = os.read(fd, buf_size)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped; only a full scan can tell what changed
+                    try:
+                        self.rescan()
+                    except OSError:
+                        pass
+                elif name:
+                    self.refresh(name)
+
+    def _inotify_fd(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            return None
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(self.store.watch_dir), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
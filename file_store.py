@@ -0,0 +1,879 @@
+import bisect
+import hashlib
+import io
+import mmap
+import os
+import random
+import shutil
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import partial
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from durability import Durability, open_temp
+from file_stream import CHUNK_SIZE, iter_file_range
+
+# "plain", "chunked" or "compressed". Switching to chunked or compressed storage
+# does not touch the plain files already in the directory; they are copied in
+# with "python file_store.py import chunked|compressed [directory] [--remove]".
+FILE_STORAGE = os.environ.get('FILE_STORAGE', 'plain')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Content-defined chunking: a cut is made where the gear hash of the bytes
+# since the last cut has its top CHUNK_MASK_BITS bits clear, giving chunks of
+# about CHUNK_MIN + 2**CHUNK_MASK_BITS bytes
+CHUNK_MIN = 1024
+CHUNK_MAX = 32 * 1024
+CHUNK_MASK_BITS = 12
+_HASH_BITS = 31
+_HASH_LIMIT = (1 << _HASH_BITS) - 1
+_CUT_MASK = ((1 << CHUNK_MASK_BITS) - 1) << (_HASH_BITS - CHUNK_MASK_BITS)
+_gear_seed = random.Random(0x6D5A)  # Fixed, so chunk boundaries match across runs
+_GEAR = [_gear_seed.getrandbits(_HASH_BITS) for _ in range(256)]
+# With numpy the hash is computed SCAN_BLOCK bytes at a time. Without it the
+# hash runs in pure Python (a few MB/s), so files larger than CHUNK_SCAN_LIMIT
+# are cut every CHUNK_MAX bytes instead: edits still reuse the chunks around
+# them, but inserting bytes shifts every chunk after the insertion.
+SCAN_BLOCK = 1024 * 1024
+CHUNK_SCAN_LIMIT = int(os.environ.get('CHUNK_SCAN_LIMIT', 4 * 1024 * 1024))
+
+CHUNK_CACHE_BYTES = int(os.environ.get('CHUNK_CACHE_BYTES', 64 * 1024 * 1024))
+GC_INTERVAL = 6 * 3600.0  # Seconds between sweeps for unreferenced chunks
+GC_GRACE = 3600.0  # Chunks younger than this are never swept, so in-flight writes keep theirs
+
+# Compressed storage: files of at least COMPRESS_MIN_BYTES whose first
+# COMPRESS_SAMPLE bytes shrink to COMPRESS_MAX_RATIO or less are compressed
+# with COMPRESSION_CODEC ("gzip", or "zstd" if the zstandard package is installed)
+COMPRESSION_CODEC = os.environ.get('COMPRESSION_CODEC', 'gzip')
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_SAMPLE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.9
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _find_cut(data, start, end):
+    """End of the chunk starting at ``start``; depends only on the chunk's own bytes."""
+    limit = min(start + CHUNK_MAX, end)
+    pos = start + CHUNK_MIN
+    if pos >= limit:
+        return limit
+    h = 0
+    gear = _GEAR
+    for byte in data[pos:limit]:
+        h = ((h << 1) + gear[byte]) & _HASH_LIMIT
+        pos += 1
+        if not h & _CUT_MASK:
+            return pos
+    return limit
+
+
+class _GearScanner:
+    """``_find_cut`` over one buffer, with the hash vectorised by numpy.
+
+    Once a chunk is ``_HASH_BITS - 1`` bytes past its minimum length, the
+    hash covers exactly the last ``_HASH_BITS`` bytes (older ones have been
+    shifted out), so it can be computed for every position of a block at
+    once. Only those first few bytes of each chunk are hashed one by one,
+    which keeps the cuts identical to ``_find_cut``'s.
+    """
+
+    def __init__(self, data, block=SCAN_BLOCK):
+        self.data = data
+        self.block = block
+        # Twice the gear values: uint32 sums then wrap exactly where the hash
+        # wraps, and a cut is wherever twice the hash is below _cut_below
+        self._gear = numpy.array(_GEAR, dtype=numpy.uint32) << numpy.uint32(1)
+        self._cut_below = numpy.uint32(1 << (_HASH_BITS - CHUNK_MASK_BITS + 1))
+        self._start = self._end = 0
+        self._cuts = None  # Positions in [_start, _end) where a full-window hash allows a cut
+
+    def find_cut(self, start, end):
+        limit = min(start + CHUNK_MAX, end)
+        pos = start + CHUNK_MIN
+        if pos >= limit:
+            return limit
+        full = min(pos + _HASH_BITS - 1, limit)
+        h = 0
+        gear = _GEAR
+        for byte in self.data[pos:full]:
+            h = ((h << 1) + gear[byte]) & _HASH_LIMIT
+            pos += 1
+            if not h & _CUT_MASK:
+                return pos
+        while pos < limit:
+            if not self._start <= pos < self._end:
+                self._scan(pos, min(pos + self.block, len(self.data)))
+            cuts = self._cuts
+            index = numpy.searchsorted(cuts, pos)
+            if index < len(cuts) and cuts[index] < limit:
+                return int(cuts[index]) + 1
+            pos = self._end
+        return limit
+
+    def _scan(self, start, end):
+        # Hash of the window ending at each position in [start, end). Windows
+        # of 1, 2, 4, ... bytes are built by doubling, then the full window is
+        # summed from them.
+        first = start - _HASH_BITS + 1
+        count = end - first
+        windows = {1: numpy.take(self._gear, numpy.frombuffer(self.data, numpy.uint8, count, first))}
+        width = 1
+        while width * 2 <= _HASH_BITS:
+            doubled = windows[width].copy()
+            doubled[width:] += windows[width][:-width] << numpy.uint32(width)
+            width *= 2
+            windows[width] = doubled
+        hashes = None
+        offset = 0  # Bytes of the window, counted back from its end, already summed
+        for width in sorted(windows, reverse=True):
+            if offset + width > _HASH_BITS:
+                continue
+            part = windows[width][_HASH_BITS - 1 - offset:count - offset] << numpy.uint32(offset)
+            hashes = part if hashes is None else hashes + part
+            offset += width
+        self._cuts = numpy.flatnonzero(hashes < self._cut_below) + start
+        self._start, self._end = start, end
+
+
+def _fixed_cut(data, start, end):
+    return min(start + CHUNK_MAX, end)
+
+
+def _cut_finder(data):
+    if numpy is not None:
+        return _GearScanner(data).find_cut
+    if len(data) > CHUNK_SCAN_LIMIT:
+        return partial(_fixed_cut, data)
+    return partial(_find_cut, data)
+
+
+def split_chunks(data, previous=()):
+    """Split ``data`` into content-defined chunks -> list of ``(digest, start, end)``.
+
+    ``previous`` is the ``(digest, length)`` list of an earlier version of the
+    same file. A chunk's cut point depends only on its own bytes, so wherever
+    the new data lines up with an earlier chunk and hashes the same, that
+    chunk and its cut are reused without rescanning: only the edited regions
+    go through the rolling hash.
+    """
+    with memoryview(data) as view:
+        return _split(data, view, list(previous), _cut_finder(data))
+
+
+def _split(data, view, previous, find_cut):
+    size = len(data)
+    starts = {}  # Offset of each earlier chunk -> its index
+    following = {}  # Digest of each earlier chunk -> index of the chunk after it
+    offset = 0
+    for index, (digest, length) in enumerate(previous):
+        starts[offset] = index
+        following.setdefault(digest, index + 1)
+        offset += length
+    shift = size - offset  # Where the unchanged tail of an edited file starts over
+    chunks = []
+
+    def reuse(index, pos):
+        # Walk earlier chunks from ``index`` while the data at ``pos`` matches them.
+        # The last earlier chunk only fits if it still ends the file.
+        while index < len(previous):
+            digest, length = previous[index]
+            end = pos + length
+            last = index == len(previous) - 1
+            if end > size or (last and end != size) or hashlib.sha256(view[pos:end]).hexdigest() != digest:
+                break
+            chunks.append((digest, pos, end))
+            pos = end
+            index += 1
+        return pos
+
+    pos = reuse(0, 0)
+    while pos < size:
+        end = find_cut(pos, size)
+        digest = hashlib.sha256(view[pos:end]).hexdigest()
+        chunks.append((digest, pos, end))
+        pos = end
+        # Back in step with the earlier version once a cut chunk matches one of
+        # its chunks, or a cut lands where the unchanged tail would begin
+        index = following.get(digest)
+        if index is None:
+            index = starts.get(pos - shift)
+        if index is not None:
+            pos = reuse(index, pos)
+    return chunks
+
+
+def _decode_text(data):
+    # Same decoding and newline handling as open(path, 'r')
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def _encode_text(content):
+    buffer = io.BytesIO()
+    wrapper = io.TextIOWrapper(buffer)
+    wrapper.write(content)
+    wrapper.flush()
+    return buffer.getvalue()
+
+
+class PlainStore:
+    """Each file stored as itself in ``directory``; what the servers have always done.
+
+    Writes go to a temp file that replaces the file once it is as durable as
+    ``durability`` requires, so a crash never leaves a torn file.
+    """
+
+    def __init__(self, directory, durability=None):
+        self.directory = directory
+        self.watch_dir = directory
+        self.durability = durability or Durability()
+
+    def path(self, name):
+        """Path of the file on disk, for serving it directly."""
+        return os.path.join(self.directory, name)
+
+    def stat(self, name):
+        """``(size, mtime, sha256 or None)`` of a stored file, or None."""
+        if name.startswith('.'):
+            return None
+        try:
+            st = os.stat(self.path(name))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime, None) if stat.S_ISREG(st.st_mode) else None
+
+    def scan(self):
+        """Map of every stored file to ``(size, mtime)``."""
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.name.startswith('.') or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue  # Removed while scanning
+                entries[entry.name] = (st.st_size, st.st_mtime)
+        return entries
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def size(self, name):
+        path = self.path(name)
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def sha256(self, name):
+        digest = hashlib.sha256()
+        with open(self.path(name), 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def read_text(self, name):
+        with open(self.path(name), 'r') as f:
+            return f.read()
+
+    def write_text(self, name, content):
+        self.durability.write(self.path(name), content)
+
+    def iter_range(self, name, start=0, end=None, chunk_size=CHUNK_SIZE):
+        return iter_file_range(self.path(name), start, end, chunk_size)
+
+    def open_encoded(self, name):
+        return None  # Stored as is; there is no encoded form to send
+
+    def delete(self, name):
+        os.remove(self.path(name))
+
+    def commit_upload(self, upload, name):
+        upload.commit(self.path(name), self.durability)
+
+    def backup(self, name):
+        """Set the current content aside so ``restore`` can put it back; None if missing."""
+        path = self.path(name)
+        if not os.path.isfile(path):
+            return None
+        fd, backup = tempfile.mkstemp(prefix='.batch-', dir=self.directory)
+        os.close(fd)
+        shutil.copy2(path, backup)
+        return backup
+
+    def restore(self, name, backup):
+        path = self.path(name)
+        if backup is not None:
+            self.durability.replace(backup, path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def discard(self, backup):
+        if backup is not None and os.path.exists(backup):
+            os.remove(backup)
+
+
+class ChunkStore:
+    """Files stored as deduplicated, content-addressed chunks plus a manifest per filename.
+
+    Chunks live under ``.chunks/objects`` named by their SHA-256, so identical
+    content (in one file or across near-identical files) is stored once.
+    Boundaries are content-defined (fixed for files over CHUNK_SCAN_LIMIT
+    when numpy is not installed), so an edit changes only the chunks it
+    touches: writing a new version stores just those chunks and a new
+    manifest. Reads reassemble files from an in-memory LRU of chunks.
+
+    A manifest, ``.chunks/manifests/<name>``, holds the size and SHA-256 of
+    the whole file on its first line and one ``digest length`` line per
+    chunk. It is replaced atomically on every write. Chunks no manifest
+    refers to are swept by ``collect_garbage``. Plain files already in
+    ``directory`` are left alone; see ``import_plain_files``.
+    """
+
+    def __init__(self, directory, cache_bytes=CHUNK_CACHE_BYTES, gc_interval=GC_INTERVAL, durability=None):
+        self.directory = directory
+        self.durability = durability or Durability()
+        root = os.path.join(directory, '.chunks')
+        self.objects_dir = os.path.join(root, 'objects')
+        self.manifest_dir = os.path.join(root, 'manifests')
+        self.watch_dir = self.manifest_dir
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()  # digest -> chunk bytes, least recently used first
+        self._cached = 0
+        self._lock = threading.Lock()
+        if gc_interval:
+            threading.Thread(target=self._sweep, args=(gc_interval,), daemon=True).start()
+
+    def path(self, name):
+        return None  # No file on disk holds the content as a whole
+
+    def _manifest_path(self, name):
+        return os.path.join(self.manifest_dir, name)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _read_manifest(self, name):
+        """``(size, sha256, [(digest, length), ...])``; raises FileNotFoundError."""
+        with open(self._manifest_path(name), 'r') as f:
+            size, sha256 = f.readline().split()
+            chunks = []
+            for line in f:
+                digest, length = line.split()
+                chunks.append((digest, int(length)))
+        return int(size), sha256, chunks
+
+    def stat(self, name):
+        if name.startswith('.'):
+            return None
+        try:
+            with open(self._manifest_path(name), 'r') as f:
+                size, sha256 = f.readline().split()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None
+        return int(size), mtime, sha256
+
+    def scan(self):
+        entries = {}
+        for name in os.listdir(self.manifest_dir):
+            info = self.stat(name)
+            if info is not None:
+                entries[name] = info[:2]
+        return entries
+
+    def exists(self, name):
+        return os.path.isfile(self._manifest_path(name))
+
+    def size(self, name):
+        info = self.stat(name)
+        return info[0] if info is not None else None
+
+    def sha256(self, name):
+        info = self.stat(name)
+        if info is None:
+            raise FileNotFoundError(name)
+        return info[2]
+
+    def _chunk(self, digest):
+        with self._lock:
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+                return data
+        with open(self._object_path(digest), 'rb') as f:
+            data = f.read()
+        if len(data) <= self.cache_bytes:
+            with self._lock:
+                if digest not in self._cache:
+                    self._cache[digest] = data
+                    self._cached += len(data)
+                while self._cached > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached -= len(evicted)
+        return data
+
+    def iter_range(self, name, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """Yield ``name[start:end]``, reassembled from chunks into pieces of about ``chunk_size``."""
+        size, _, chunks = self._read_manifest(name)
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        offsets = []
+        offset = 0
+        for _, length in chunks:
+            offsets.append(offset)
+            offset += length
+        index = bisect.bisect_right(offsets, start) - 1
+        pending = []
+        pending_size = 0
+        pos = start
+        while pos < end:
+            digest, length = chunks[index]
+            data = self._chunk(digest)
+            piece = data[pos - offsets[index]:min(length, end - offsets[index])]
+            pending.append(piece)
+            pending_size += len(piece)
+            pos += len(piece)
+            index += 1
+            if pending_size >= chunk_size:
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield b''.join(pending)
+
+    def read(self, name):
+        return b''.join(self.iter_range(name))
+
+    def read_text(self, name):
+        return _decode_text(self.read(name))
+
+    def _put_object(self, digest, data):
+        """Store one chunk unless it is already there; returns its path if it was written."""
+        path = self._object_path(digest)
+        try:
+            # Already stored: touch it so a concurrent sweep leaves it alone
+            os.utime(path)
+            return None
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def _write_manifest(self, name, size, sha256, chunks, written=()):
+        # New chunks are made durable with the manifest, before it can refer to them
+        lines = [f"{size} {sha256}\n"]
+        lines.extend(f"{digest} {end - start}\n" for digest, start, end in chunks)
+        self.durability.write(self._manifest_path(name), ''.join(lines), after=written)
+
+    def write(self, name, data):
+        """Store ``data`` as the new content of ``name``; only chunks not already stored are written."""
+        try:
+            previous = self._read_manifest(name)[2]
+        except (OSError, ValueError):
+            previous = ()
+        chunks = split_chunks(data, previous)
+        written = []
+        with memoryview(data) as view:
+            for digest, start, end in chunks:
+                path = self._put_object(digest, view[start:end])
+                if path is not None:
+                    written.append(path)
+            sha256 = hashlib.sha256(view).hexdigest()
+        self._write_manifest(name, len(data), sha256, chunks, written)
+
+    def write_text(self, name, content):
+        self.write(name, _encode_text(content))
+
+    def _write_file(self, name, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self.write(name, b'')
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.write(name, mm)
+
+    def commit_upload(self, upload, name):
+        upload.close()
+        try:
+            self._write_file(name, upload.tmp_path)
+        finally:
+            upload.abort()
+
+    def open_encoded(self, name):
+        return None
+
+    def delete(self, name):
+        # The chunks stay until a sweep finds nothing else refers to them
+        os.remove(self._manifest_path(name))
+
+    def backup(self, name):
+        try:
+            with open(self._manifest_path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def restore(self, name, backup):
+        if backup is None:
+            if self.exists(name):
+                self.delete(name)
+            return
+        self.durability.write(self._manifest_path(name), backup)
+
+    def discard(self, backup):
+        pass
+
+    def collect_garbage(self, grace=GC_GRACE):
+        """Remove chunks no manifest refers to; returns how many were removed."""
+        referenced = set()
+        for name in os.listdir(self.manifest_dir):
+            try:
+                referenced.update(digest for digest, _ in self._read_manifest(name)[2])
+            except (OSError, ValueError):
+                continue
+        cutoff = time.time() - grace
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for digest in os.listdir(prefix_dir):
+                if digest in referenced:
+                    continue
+                path = os.path.join(prefix_dir, digest)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+    def _sweep(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.collect_garbage()
+            except OSError:
+                pass
+
+
+class _Gzip:
+    name = 'gzip'
+    id = 1
+
+    @staticmethod
+    def compressor():
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip framing, as HTTP expects
+
+    @staticmethod
+    def decompressor():
+        return zlib.decompressobj(31)
+
+
+class _Zstd:
+    name = 'zstd'
+    id = 2
+
+    @staticmethod
+    def compressor():
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    @staticmethod
+    def decompressor():
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {codec.name: codec for codec in (_Gzip, _Zstd) if codec is not _Zstd or zstandard is not None}
+_CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
+_HEADER = struct.Struct('>4sBQ32s')  # magic, codec id (0: stored as is), size, SHA-256
+_MAGIC = b'FMSZ'
+
+
+class CompressedStore:
+    """Each file stored once under ``.compressed``, compressed when that pays off.
+
+    A stored file starts with a fixed header recording the codec, the
+    original size and the SHA-256 of the content, followed by the content,
+    compressed or as is. Files smaller than ``min_bytes``, or whose first
+    ``COMPRESS_SAMPLE`` bytes do not shrink enough, are kept as is, so
+    already-compressed data costs no CPU on either side. ``open_encoded``
+    hands out the compressed bytes unchanged, for clients that accept the
+    codec. Plain files already in ``directory`` are left alone; see
+    ``import_plain_files``.
+    """
+
+    def __init__(self, directory, codec=COMPRESSION_CODEC, min_bytes=COMPRESS_MIN_BYTES, durability=None):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown or unavailable COMPRESSION_CODEC '{codec}', expected one of {', '.join(CODECS)}")
+        self.directory = directory
+        self.codec = CODECS[codec]
+        self.min_bytes = min_bytes
+        self.durability = durability or Durability()
+        self.store_dir = os.path.join(directory, '.compressed')
+        self.watch_dir = self.store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def path(self, name):
+        return None  # The file on disk carries a header, and may be compressed
+
+    def _stored_path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def _open(self, name):
+        """Open a stored file positioned after its header -> ``(file, codec or None, size, sha256)``."""
+        f = open(self._stored_path(name), 'rb')
+        try:
+            magic, codec_id, size, digest = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or (codec_id and codec_id not in _CODEC_IDS):
+                raise ValueError(f"Unreadable stored file '{name}'")
+        except (struct.error, ValueError):
+            f.close()
+            raise ValueError(f"Unreadable stored file '{name}'") from None
+        return f, _CODEC_IDS.get(codec_id), size, digest.hex()
+
+    def stat(self, name):
+        if name.startswith('.'):
+            return None
+        try:
+            f, _, size, sha256 = self._open(name)
+        except (OSError, ValueError):
+            return None
+        with f:
+            return size, os.fstat(f.fileno()).st_mtime, sha256
+
+    def scan(self):
+        entries = {}
+        for name in os.listdir(self.store_dir):
+            info = self.stat(name)
+            if info is not None:
+                entries[name] = info[:2]
+        return entries
+
+    def exists(self, name):
+        return os.path.isfile(self._stored_path(name))
+
+    def size(self, name):
+        info = self.stat(name)
+        return info[0] if info is not None else None
+
+    def sha256(self, name):
+        info = self.stat(name)
+        if info is None:
+            raise FileNotFoundError(name)
+        return info[2]
+
+    def iter_range(self, name, start=0, end=None, chunk_size=CHUNK_SIZE):
+        """Yield ``name[start:end]``; a compressed file is decompressed from the start up to ``end``."""
+        f, codec, size, _ = self._open(name)
+        with f:
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+            if codec is None:
+                f.seek(_HEADER.size + start)
+                for pos in range(start, end, chunk_size):
+                    yield f.read(min(chunk_size, end - pos))
+                return
+            decompressor = codec.decompressor()
+            pos = 0
+            # Compressed input is read in smaller pieces, since each may expand many times over
+            for block in iter(lambda: f.read(max(chunk_size // 8, 4096)), b''):
+                data = decompressor.decompress(block)
+                if pos + len(data) > start:
+                    yield data[max(start - pos, 0):end - pos]
+                pos += len(data)
+                if pos >= end:
+                    return
+
+    def read(self, name):
+        return b''.join(self.iter_range(name))
+
+    def read_text(self, name):
+        return _decode_text(self.read(name))
+
+    def open_encoded(self, name):
+        """The stored bytes of a compressed file, to send as is -> ``(codec name, length, chunks)``.
+
+        None if the file is stored uncompressed. The file is opened here, so
+        the bytes stay those of this version even if it is replaced meanwhile.
+        """
+        f, codec, _, _ = self._open(name)
+        if codec is None:
+            f.close()
+            return None
+        length = os.fstat(f.fileno()).st_size - _HEADER.size
+
+        def chunks():
+            with f:
+                yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+        return codec.name, length, chunks()
+
+    def _choose_codec(self, size, sample):
+        if size < self.min_bytes:
+            return None
+        compressor = self.codec.compressor()
+        compressed = len(compressor.compress(bytes(sample))) + len(compressor.flush())
+        return self.codec if compressed <= len(sample) * COMPRESS_MAX_RATIO else None
+
+    def _write_stream(self, name, size, sha256, blocks, codec):
+        f, tmp_path = open_temp(self.store_dir)
+        try:
+            with f:
+                f.write(_HEADER.pack(_MAGIC, codec.id if codec else 0, size, bytes.fromhex(sha256)))
+                compressor = codec.compressor() if codec else None
+                for block in blocks:
+                    f.write(compressor.compress(block) if compressor else block)
+                if compressor:
+                    f.write(compressor.flush())
+                f.flush()
+                self.durability.replace(tmp_path, self._stored_path(name), f.fileno())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def write(self, name, data):
+        with memoryview(data) as view:
+            codec = self._choose_codec(len(view), view[:COMPRESS_SAMPLE])
+            sha256 = hashlib.sha256(view).hexdigest()
+            blocks = (view[pos:pos + CHUNK_SIZE] for pos in range(0, len(view), CHUNK_SIZE))
+            self._write_stream(name, len(view), sha256, blocks, codec)
+
+    def write_text(self, name, content):
+        self.write(name, _encode_text(content))
+
+    def _write_file(self, name, path, sha256=None):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if sha256 is None:
+                digest = hashlib.sha256()
+                for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(block)
+                sha256 = digest.hexdigest()
+                f.seek(0)
+            codec = self._choose_codec(size, f.read(COMPRESS_SAMPLE))
+            f.seek(0)
+            self._write_stream(name, size, sha256, iter(lambda: f.read(CHUNK_SIZE), b''), codec)
+
+    def commit_upload(self, upload, name):
+        upload.close()
+        try:
+            self._write_file(name, upload.tmp_path, upload.sha256)
+        finally:
+            upload.abort()
+
+    def delete(self, name):
+        os.remove(self._stored_path(name))
+
+    def backup(self, name):
+        path = self._stored_path(name)
+        if not os.path.isfile(path):
+            return None
+        fd, backup = tempfile.mkstemp(prefix='.batch-', dir=self.store_dir)
+        os.close(fd)
+        shutil.copy2(path, backup)
+        return backup
+
+    def restore(self, name, backup):
+        path = self._stored_path(name)
+        if backup is not None:
+            self.durability.replace(backup, path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def discard(self, backup):
+        if backup is not None and os.path.exists(backup):
+            os.remove(backup)
+
+
+def plain_files(store):
+    """Names of the plain files in ``store.directory`` that ``store`` does not hold."""
+    with os.scandir(store.directory) as it:
+        return sorted(entry.name for entry in it
+                      if not entry.name.startswith('.') and entry.is_file() and not store.exists(entry.name))
+
+
+def import_plain_files(store, remove=False):
+    """Copy the plain files in ``store.directory`` into a chunked or compressed ``store``.
+
+    Names the store already holds are not copied again, so running it twice
+    only picks up what is left. With ``remove``, an original is deleted
+    once it matches the stored copy's SHA-256. Returns the imported names.
+    """
+    with os.scandir(store.directory) as it:
+        names = sorted(entry.name for entry in it if not entry.name.startswith('.') and entry.is_file())
+    imported = []
+    for name in names:
+        path = os.path.join(store.directory, name)
+        try:
+            if not store.exists(name):
+                store._write_file(name, path)
+                imported.append(name)
+            if remove:
+                if store.stat(name)[2] != _file_sha256(path):
+                    print(f"[STORE] '{name}' differs from its stored copy; original kept")
+                    continue
+                os.remove(path)
+        except FileNotFoundError:
+            continue  # Removed meanwhile
+    return imported
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def open_store(directory, kind=FILE_STORAGE, durability=None):
+    """The storage engine for ``directory``: "plain" files, "chunked" content-addressed storage or "compressed"."""
+    if kind == 'chunked':
+        store = ChunkStore(directory, durability=durability)
+    elif kind == 'compressed':
+        store = CompressedStore(directory, durability=durability)
+    elif kind != 'plain':
+        raise ValueError(f"Unknown FILE_STORAGE '{kind}'")
+    else:
+        return PlainStore(directory, durability)
+    waiting = plain_files(store)
+    if waiting:
+        print(f"[STORE] {len(waiting)} plain files in {directory} are not in the {kind} store; "
+              f"copy them in with: python file_store.py import {kind} {directory}")
+    return store
+
+
+if __name__ == '__main__':
+    # Copy plain files into chunked or compressed storage, ideally with the servers stopped
+    import argparse
+    parser = argparse.ArgumentParser(description="Import the plain files in a directory into chunked or compressed storage")
+    parser.add_argument('command', choices=['import'])
+    parser.add_argument('kind', choices=['chunked', 'compressed'])
+    parser.add_argument('directory', nargs='?', default='files')
+    parser.add_argument('--remove', action='store_true',
+                        help="delete each original once its stored copy is verified")
+    options = parser.parse_args()
+    store = (ChunkStore(options.directory, gc_interval=0) if options.kind == 'chunked'
+             else CompressedStore(options.directory))
+    names = import_plain_files(store, remove=options.remove)
+    print(f"Imported {len(names)} files into {options.kind} storage" + (", originals removed" if options.remove else ""))
@@ -0,0 +1,71 @@
+import codecs
+import io
+import mmap
+import os
+
+CHUNK_SIZE = 256 * 1024  # Bytes per streamed chunk
+READ_INLINE_LIMIT = 1024 * 1024  # Larger files are streamed instead of inlined in a reply
+
+
+def resolve_range(size, offset=0, length=None):
+    """Turn an offset/length request into a ``(start, end)`` slice of a file of ``size`` bytes.
+
+    ``length`` of None means "to the end of the file". Raises ValueError if the
+    range does not start inside the file; offset 0 of an empty file is the
+    empty range ``(0, 0)``.
+    """
+    if offset < 0 or (length is not None and length <= 0):
+        raise ValueError("Offset must not be negative and length must be positive")
+    if offset >= size and offset > 0:
+        raise ValueError(f"Offset {offset} is beyond the end of the file ({size} bytes)")
+    end = size if length is None else min(size, offset + length)
+    return offset, end
+
+
+def iter_file_range(path, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Yield ``path[start:end]`` in chunks of at most ``chunk_size`` bytes.
+
+    The file is memory-mapped, so only the chunk being sent is ever copied
+    out of the page cache.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos in range(start, end, chunk_size):
+                yield mm[pos:min(pos + chunk_size, end)]
+
+
+class ReleasingFile(io.FileIO):
+    """A file opened for reading that calls ``on_close`` once, when it is closed.
+
+    Handed to ``send_file``, it keeps the server's ``wsgi.file_wrapper``
+    (sendfile) path while still releasing a lock once the body has been
+    sent: the server closes the file wrapper, and so this file, itself.
+    """
+
+    def __init__(self, path, on_close):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            self._on_close()
+
+
+def decode_text_chunks(chunks):
+    """Decode a stream of byte chunks as UTF-8, never splitting a multi-byte character."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
@@ -0,0 +1,249 @@
+import threading
+import time
+from collections import deque
+
+LOCK_STRIPES = 64  # Independent mutexes the file table is spread over
+LOCK_WAIT_TIMEOUT = 2.0  # Default seconds to queue for a busy file
+WRITE_LEASE = 300.0  # Seconds a write lock lives unless renewed or released
+
+
+class _FileState:
+    __slots__ = ('readers', 'writer', 'lease_expires', 'queue', 'read_since', 'write_since')
+
+    def __init__(self):
+        self.readers = 0
+        self.writer = None
+        self.lease_expires = None
+        self.read_since = None  # When the current run of readers began
+        self.write_since = None
+        self.queue = deque()  # Waiting (kind, ticket) pairs in arrival order
+
+    def idle(self):
+        return self.readers == 0 and self.writer is None and not self.queue
+
+
+class _Stripe:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.files = {}
+
+
+class LockManager:
+    """Per-file reader/writer locks with fair queueing and expiring write leases.
+
+    Files hash onto a fixed set of stripes, so lock traffic on different
+    files rarely contends on the same mutex. Waiters on a file are served in
+    arrival order; a reader never overtakes a queued writer, which keeps a
+    steady stream of readers from starving writers. A write lock taken with a
+    lease is dropped automatically once the lease runs out, so a client that
+    disappears cannot hold a file forever.
+
+    ``acquire_*`` return ``(True, None)`` or ``(False, reason)``.
+
+    An optional ``observer`` is told how long each acquire waited
+    (``lock_waited(mode, filename, seconds, acquired)``) and how long a file
+    stayed locked (``lock_held(mode, filename, seconds)``); read hold time
+    runs from the first reader in to the last reader out.
+    """
+
+    def __init__(self, stripes=LOCK_STRIPES, observer=None):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self.observer = observer
+
+    def _stripe(self, filename):
+        return self._stripes[hash(filename) % len(self._stripes)]
+
+    def _expire(self, state, now, filename):
+        if state.writer is not None and state.lease_expires is not None and now >= state.lease_expires:
+            self._clear_writer(state, now, filename)
+            return True
+        return False
+
+    def _clear_writer(self, state, now, filename):
+        if self.observer is not None:
+            self.observer.lock_held('write', filename, now - state.write_since)
+        state.writer = None
+        state.lease_expires = None
+        state.write_since = None
+
+    def _busy_message(self, kind, state):
+        if state.writer is not None:
+            if kind == 'read':
+                return f"File is being edited by {state.writer}"
+            return f"File is locked by {state.writer}"
+        if state.readers:
+            return f"File is currently being read by {state.readers} users"
+        return "File is busy"
+
+    def _can_grant(self, kind, state, ticket):
+        if kind == 'write':
+            if state.writer is not None or state.readers:
+                return False
+            return not state.queue or state.queue[0][1] is ticket
+        if state.writer is not None:
+            return False
+        for queued_kind, queued_ticket in state.queue:
+            if queued_ticket is ticket:
+                return True
+            if queued_kind == 'write':
+                return False
+        return True
+
+    def _acquire(self, kind, filename, owner, timeout, lease):
+        started = time.monotonic()
+        result = self._wait_for(kind, filename, owner, timeout, lease)
+        # A failed zero-timeout try is a probe, not a wait that timed out
+        if self.observer is not None and (result[0] or timeout):
+            self.observer.lock_waited(kind, filename, time.monotonic() - started, result[0])
+        return result
+
+    def _wait_for(self, kind, filename, owner, timeout, lease):
+        stripe = self._stripe(filename)
+        ticket = object()
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is None:
+                state = stripe.files[filename] = _FileState()
+            now = time.monotonic()
+            self._expire(state, now, filename)
+            deadline = now + (timeout or 0)
+            queued = False
+            while True:
+                if self._can_grant(kind, state, ticket):
+                    if queued:
+                        state.queue.remove((kind, ticket))
+                    granted = time.monotonic()
+                    if kind == 'write':
+                        state.writer = owner
+                        state.lease_expires = granted + lease if lease else None
+                        state.write_since = granted
+                    else:
+                        if not state.readers:
+                            state.read_since = granted
+                        state.readers += 1
+                    if queued:
+                        # The next waiters in line may be readers that can now join us
+                        stripe.cond.notify_all()
+                    return True, None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    message = self._busy_message(kind, state)
+                    if queued:
+                        state.queue.remove((kind, ticket))
+                        stripe.cond.notify_all()
+                    if state.idle():
+                        del stripe.files[filename]
+                    return False, message
+
+                if not queued:
+                    state.queue.append((kind, ticket))
+                    queued = True
+                if state.lease_expires is not None:
+                    remaining = min(remaining, max(state.lease_expires - time.monotonic(), 0.001))
+                stripe.cond.wait(remaining)
+                if self._expire(state, time.monotonic(), filename):
+                    stripe.cond.notify_all()
+
+    def acquire_read(self, filename, owner=None, timeout=LOCK_WAIT_TIMEOUT):
+        return self._acquire('read', filename, owner, timeout, None)
+
+    def acquire_write(self, filename, owner, timeout=LOCK_WAIT_TIMEOUT, lease=WRITE_LEASE):
+        return self._acquire('write', filename, owner, timeout, lease)
+
+    def release_read(self, filename):
+        stripe = self._stripe(filename)
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is None or state.readers == 0:
+                return
+            state.readers -= 1
+            if not state.readers and self.observer is not None:
+                self.observer.lock_held('read', filename, time.monotonic() - state.read_since)
+            if state.idle():
+                del stripe.files[filename]
+            else:
+                stripe.cond.notify_all()
+
+    def release_write(self, filename, owner):
+        """Release a write lock held by ``owner``; returns False if they do not hold it."""
+        stripe = self._stripe(filename)
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is None:
+                return False
+            now = time.monotonic()
+            self._expire(state, now, filename)
+            if state.writer is None or state.writer != owner:
+                return False
+            self._clear_writer(state, now, filename)
+            if state.idle():
+                del stripe.files[filename]
+            else:
+                stripe.cond.notify_all()
+            return True
+
+    def renew(self, filename, owner, lease=WRITE_LEASE):
+        """Extend the lease on a write lock held by ``owner``."""
+        stripe = self._stripe(filename)
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is None or self._expire(state, time.monotonic(), filename) or state.writer != owner:
+                return False
+            state.lease_expires = time.monotonic() + lease if lease else None
+            return True
+
+    def release_all(self, owner):
+        """Drop every write lock held by ``owner``, e.g. when their session ends."""
+        released = []
+        for stripe in self._stripes:
+            with stripe.cond:
+                now = time.monotonic()
+                for filename, state in list(stripe.files.items()):
+                    if state.writer == owner:
+                        self._clear_writer(state, now, filename)
+                        released.append(filename)
+                        if state.idle():
+                            del stripe.files[filename]
+                stripe.cond.notify_all()
+        return released
+
+    def holder(self, filename):
+        """Owner of the write lock on ``filename``, or None."""
+        stripe = self._stripe(filename)
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is None:
+                return None
+            if self._expire(state, time.monotonic(), filename):
+                if state.idle():
+                    del stripe.files[filename]
+                else:
+                    stripe.cond.notify_all()
+            return state.writer
+
+    def write_locks(self):
+        """Map of filename -> owner for every live write lock."""
+        locks = {}
+        now = time.monotonic()
+        for stripe in self._stripes:
+            with stripe.cond:
+                for filename, state in list(stripe.files.items()):
+                    if self._expire(state, now, filename):
+                        if state.idle():
+                            del stripe.files[filename]
+                        else:
+                            stripe.cond.notify_all()
+                    elif state.writer is not None:
+                        locks[filename] = state.writer
+        return locks
+
+    def reader_counts(self):
+        """Map of filename -> number of active readers."""
+        counts = {}
+        for stripe in self._stripes:
+            with stripe.cond:
+                for filename, state in stripe.files.items():
+                    if state.readers:
+                        counts[filename] = state.readers
+        return counts
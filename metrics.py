@@ -0,0 +1,243 @@
+import bisect
+import hmac
+import os
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bearer token a scraper may send to /metrics instead of an admin session token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+COMMANDS = ('LIST', 'READ', 'READ_RANGE', 'CREATE', 'EDIT', 'DELETE', 'LOCK', 'UNLOCK', 'UPLOAD',
+            'UPLOAD_END', 'MAKE_REQUEST', 'LIST_REQUESTS', 'HANDLE_REQUEST', 'HANDLE_REQUESTS', 'SEARCH',
+            'READ_ENCODED')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base of all metrics; a counter or gauge may be read from ``func`` at scrape time.
+
+    ``func`` returns a number, or for a labelled metric a mapping of label
+    value tuples to numbers.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """The series for one set of label values; keep it to record without a lookup."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        if self.func is not None:
+            values = self.func()
+            if not self.labelnames:
+                values = {(): values}
+            for labels, value in sorted(values.items()):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+            return lines
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}']
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from ``func`` at scrape time."""
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        names = self.labelnames + ('le',)
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(names, values + (_format_value(bound),))} {cumulative}')
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self.register(Counter(name, help, labelnames, func))
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self.register(Gauge(name, help, labelnames, func))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def scrape_allowed(token, role):
+    """Whether a /metrics request may be answered: an admin session, or the METRICS_TOKEN."""
+    if role == 'admin':
+        return True
+    return bool(METRICS_TOKEN) and bool(token) and hmac.compare_digest(token, METRICS_TOKEN)
+
+
+class ServerMetrics:
+    """Command, byte and lock metrics recorded by either server.
+
+    Series for the known commands are created up front, so recording a
+    command is one dict lookup and a bucket increment. Passed to
+    ``LockManager`` as its observer to time lock waits and holds. Labels are
+    kept to commands and lock modes: file names and users are not exposed.
+    """
+
+    def __init__(self, registry=None, commands=COMMANDS):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.command_duration = r.histogram(
+            'fms_command_duration_seconds', 'Time spent handling a command', ('command',))
+        self._commands = {command: self.command_duration.labels(command) for command in commands}
+        self._other_command = self.command_duration.labels('OTHER')
+        self.bytes_read = r.counter('fms_bytes_read_total', 'File content bytes sent to clients').labels()
+        self.bytes_written = r.counter('fms_bytes_written_total', 'File content bytes written').labels()
+        self.lock_wait = r.histogram('fms_lock_wait_seconds', 'Time spent waiting for a file lock', ('mode',))
+        self.lock_hold = r.histogram('fms_lock_hold_seconds', 'Time a file lock was held', ('mode',))
+        self.lock_timeouts = r.counter('fms_lock_timeouts_total', 'Lock requests that gave up waiting', ('mode',))
+        self._modes = {
+            mode: (self.lock_wait.labels(mode), self.lock_hold.labels(mode), self.lock_timeouts.labels(mode))
+            for mode in ('read', 'write')
+        }
+
+    def observe_command(self, command, seconds):
+        self._commands.get(command, self._other_command).observe(seconds)
+
+    # LockManager observer interface
+
+    def lock_waited(self, mode, filename, seconds, acquired):
+        wait, _, timeouts = self._modes[mode]
+        wait.observe(seconds)
+        if not acquired:
+            timeouts.inc()
+
+    def lock_held(self, mode, filename, seconds):
+        self._modes[mode][1].observe(seconds)
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,366 @@
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from itertools import islice
+
+from durability import Durability
+
+SNAPSHOT_FILE = 'requests.json'
+JOURNAL_FILE = 'requests.log'
+COMPACT_THRESHOLD = 1000  # Journal entries before a background compaction
+INDEXED_FIELDS = ('status', 'username', 'type', 'filename')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class RequestStore:
+    """User requests held in memory, persisted as a snapshot plus an append-only journal.
+
+    Every change is appended to the journal as one JSON line, so submitting or
+    handling a request costs O(1) I/O no matter how many requests exist, and
+    is synced as ``durability`` requires before the call returns. Once
+    the journal grows past ``compact_threshold`` entries it is folded into the
+    snapshot by a background thread.
+
+    Secondary indexes over ``indexed_fields`` are kept current on every change
+    so that filtered listings only touch matching requests. Every index holds
+    its ids in order, so a page starts from its cursor by bisection. Passing
+    ``snapshot_path=None`` keeps the store purely in memory.
+    """
+
+    def __init__(self, snapshot_path=SNAPSHOT_FILE, journal_path=JOURNAL_FILE,
+                 compact_threshold=COMPACT_THRESHOLD, indexed_fields=INDEXED_FIELDS, durability=None):
+        self.snapshot_path = snapshot_path
+        self.durability = durability or Durability()
+        self.journal_path = journal_path
+        self.compact_threshold = compact_threshold
+        self.indexed_fields = tuple(indexed_fields)
+        self._lock = threading.RLock()
+        self._records = {}  # request id -> record dict (replaced, never mutated)
+        self._ids = []  # Every request id, ascending
+        self._indexes = {field: defaultdict(list) for field in self.indexed_fields}  # value -> ascending ids
+        self._next_id = 1
+        self._journal = None
+        self._journal_entries = 0
+        self._compactor = None
+        self._load()
+
+    def _load(self):
+        if self.snapshot_path is None:
+            return
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                for record in json.load(f):
+                    self._put(record)
+
+        # A journal left over from an interrupted compaction is replayed before
+        # the live one; replaying events already in the snapshot is harmless.
+        if os.path.exists(self._rotated_path()):
+            self._replay(self._rotated_path())
+        if os.path.exists(self.journal_path):
+            valid = self._replay(self.journal_path)
+            if valid < os.path.getsize(self.journal_path):
+                # Cut a torn final line off, or new events would be appended
+                # after it and lost at the next replay
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(valid)
+                    self.durability.sync(f.fileno())
+
+        if self._records:
+            self._next_id = max(self._records) + 1
+        if os.path.exists(self._rotated_path()):
+            self._write_snapshot(self.all())
+            os.remove(self._rotated_path())
+        self._journal = open(self.journal_path, 'a')
+
+    def _replay(self, path):
+        """Apply the events in a journal; returns the offset just past the last complete one."""
+        valid = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Torn final line from a crash mid-append
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(event)
+                self._journal_entries += 1
+                valid += len(line)
+        return valid
+
+    def _apply(self, event):
+        if event['op'] == 'add':
+            self._put(event['request'])
+        elif event['op'] == 'update':
+            record = self._records.get(event['id'])
+            if record is not None:
+                self._put({**record, **event['changes']})
+
+    def _put(self, record):
+        request_id = record['id']
+        old = self._records.get(request_id)
+        if old is None:
+            _insert_id(self._ids, request_id)
+        for field, index in self._indexes.items():
+            if old is not None:
+                if old.get(field) == record.get(field):
+                    continue
+                ids = index[old.get(field)]
+                del ids[bisect_left(ids, request_id)]
+                if not ids:
+                    del index[old.get(field)]
+            _insert_id(index[record.get(field)], request_id)
+        self._records[request_id] = record
+
+    def _rotated_path(self):
+        return self.journal_path + '.old'
+
+    def _append(self, *events):
+        """Write events to the journal under the lock.
+
+        Returns a duplicate of the journal's descriptor for ``_commit`` to
+        make durable once the lock is released (None if nothing needs it),
+        so concurrent writers can share one group-committed fsync.
+        """
+        if self._journal is None or not events:
+            return None
+        self._journal.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+        self._journal.flush()
+        self._journal_entries += len(events)
+        if self._journal_entries >= self.compact_threshold and self._compactor is None:
+            self._compactor = threading.Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+        # A duplicate stays valid even if compaction rotates the journal meanwhile
+        return os.dup(self._journal.fileno()) if self.durability.syncs else None
+
+    def _commit(self, fd):
+        if fd is None:
+            return
+        try:
+            self.durability.sync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot.
+
+        Only the journal rotation happens under the store lock; serializing and
+        writing the snapshot runs concurrently with new appends.
+        """
+        with self._lock:
+            if os.path.exists(self._rotated_path()):
+                # A previous compaction failed part way; settle it first so
+                # its journal is not overwritten by this rotation.
+                self._write_snapshot(self.all())
+                os.remove(self._rotated_path())
+            self._journal.close()
+            os.replace(self.journal_path, self._rotated_path())
+            self._journal = open(self.journal_path, 'a')
+            self._journal_entries = 0
+            records = [self._records[i] for i in self._ids]
+
+        try:
+            self._write_snapshot(records)
+            os.remove(self._rotated_path())
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def _write_snapshot(self, records):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(records, f, indent=2)
+            f.flush()
+            # Always synced: once it is in place the journal it replaces is deleted
+            os.fsync(f.fileno())
+        self.durability.replace(tmp_path, self.snapshot_path)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def add(self, **fields):
+        """Store a new request, assigning it the next id, and return it."""
+        with self._lock:
+            record = {'id': self._next_id, **fields}
+            self._next_id += 1
+            self._put(record)
+            pending = self._append({'op': 'add', 'request': record})
+        self._commit(pending)
+        return record
+
+    def update(self, request_id, **changes):
+        """Apply ``changes`` to a request; returns the new record or None if unknown."""
+        with self._lock:
+            record = self._records.get(request_id)
+            if record is None:
+                return None
+            record = {**record, **changes}
+            self._put(record)
+            pending = self._append({'op': 'update', 'id': request_id, 'changes': changes})
+        self._commit(pending)
+        return record
+
+    def update_many(self, request_ids, if_status=None, **changes):
+        """Apply the same ``changes`` to many requests with one journal write.
+
+        With ``if_status``, only requests whose status is currently one of
+        those values are changed, which lets concurrent callers claim
+        requests without handling one twice. Returns the updated records;
+        unknown and skipped ids are left out.
+        """
+        with self._lock:
+            updated = []
+            for request_id in request_ids:
+                record = self._records.get(request_id)
+                if record is None or (if_status is not None and record.get('status') not in if_status):
+                    continue
+                record = {**record, **changes}
+                self._put(record)
+                updated.append(record)
+            pending = self._append(*({'op': 'update', 'id': record['id'], 'changes': changes} for record in updated))
+        self._commit(pending)
+        return updated
+
+    def release_orphaned(self):
+        """Put requests left "queued" by an earlier run back to "pending"; returns them.
+
+        The apply queue is in memory, so requests claimed by a process that
+        stopped before applying them would otherwise never be handled. Only
+        this process uses the journal, so every claim not made by it is orphaned.
+        """
+        ids = [request_id for request_id in self.matching_ids({'status': 'queued'})
+               if self._records[request_id].get('queued_by') != os.getpid()]
+        return self.update_many(ids, if_status=('queued',), status='pending', queued_by=None)
+
+    def get(self, request_id):
+        return self._records.get(request_id)
+
+    def all(self):
+        with self._lock:
+            return [self._records[i] for i in self._ids]
+
+    def query(self, filters=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Return one page of requests matching ``filters``, oldest first.
+
+        ``filters`` maps indexed fields to the value they must equal, plus the
+        optional ``since``/``until`` timestamp bounds (``until`` is exclusive).
+        ``cursor`` is the ``next_cursor`` of the previous page. Returns
+        ``(records, next_cursor)``; ``next_cursor`` is None on the last page.
+        """
+        with self._lock:
+            page = []
+            next_cursor = None
+            for record in self._matching(filters, cursor):
+                if len(page) == limit:
+                    next_cursor = page[-1]['id']
+                    break
+                page.append(record)
+            return page, next_cursor
+
+    def matching_ids(self, filters=None, limit=None):
+        """Ids of up to ``limit`` requests matching ``filters`` (as for ``query``), oldest first."""
+        with self._lock:
+            return [record['id'] for record in islice(self._matching(filters, None), limit)]
+
+    def _matching(self, filters, cursor):
+        # Called with the lock held
+        filters = dict(filters or {})
+        since = filters.pop('since', None)
+        until = filters.pop('until', None)
+        # Start from the smallest matching index and check the remaining
+        # filters per record, so a narrow filter never scans the history.
+        candidates = None
+        for field, value in filters.items():
+            ids = self._indexes[field].get(value, ())
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        if candidates is None:
+            candidates = self._ids
+
+        start = 0 if cursor is None else bisect_right(candidates, cursor)
+        for i in range(start, len(candidates)):
+            record = self._records[candidates[i]]
+            if any(record.get(field) != value for field, value in filters.items()):
+                continue
+            timestamp = record.get('timestamp')
+            if since is not None and (timestamp is None or timestamp < since):
+                continue
+            if until is not None and (timestamp is None or timestamp >= until):
+                continue
+            yield record
+
+    def __len__(self):
+        return len(self._records)
+
+
+def _insert_id(ids, request_id):
+    # New requests have the highest id, so this is nearly always an append
+    if not ids or ids[-1] < request_id:
+        ids.append(request_id)
+    else:
+        insort(ids, request_id)
+
+
+def _int_arg(key, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{key} must be an integer") from None
+
+
+def parse_query(args, indexed_fields=INDEXED_FIELDS):
+    """Parse ``key=value`` command arguments into ``query()`` keyword arguments.
+
+    Raises ValueError for unknown keys or malformed values.
+    """
+    filters = {}
+    cursor = None
+    limit = DEFAULT_PAGE_SIZE
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise ValueError(f"Expected key=value, got '{arg}'")
+        if key == 'cursor':
+            cursor = _int_arg(key, value)
+        elif key == 'limit':
+            limit = max(1, min(_int_arg(key, value), MAX_PAGE_SIZE))
+        elif key in indexed_fields or key in ('since', 'until'):
+            filters[key] = value
+        else:
+            raise ValueError(f"Unknown filter '{key}'")
+    return {'filters': filters, 'cursor': cursor, 'limit': limit}
+
+
+def parse_selection(args, indexed_fields=INDEXED_FIELDS):
+    """Parse the arguments selecting requests to handle in bulk.
+
+    Either ``ids=1,2,3`` or one or more ``key=value`` filters as for
+    ``parse_query`` (without ``cursor``/``limit``). Returns ``(ids, filters)``
+    with ``ids`` None when selecting by filter. Raises ValueError.
+    """
+    ids = None
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise ValueError(f"Expected key=value, got '{arg}'")
+        if key == 'ids':
+            try:
+                ids = [int(i) for i in value.split(',') if i]
+            except ValueError:
+                raise ValueError("ids must be a comma-separated list of numbers") from None
+        elif key in indexed_fields or key in ('since', 'until'):
+            filters[key] = value
+        else:
+            raise ValueError(f"Unknown filter '{key}'")
+    if ids is not None and filters:
+        raise ValueError("Select requests by ids or by filters, not both")
+    if ids is None and not filters:
+        raise ValueError("Select requests with ids=... or at least one filter")
+    return ids, filters
@@ -0,0 +1,259 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from durability import Durability
+
+SEARCH_INDEX_FILE = os.environ.get('SEARCH_INDEX_FILE', 'search_index.json')
+SEARCH_MAX_FILE_BYTES = int(os.environ.get('SEARCH_MAX_FILE_BYTES', 8 * 1024 * 1024))  # Larger files are found by name only
+SAVE_INTERVAL = 5.0  # Seconds between writes of a changed index to disk
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+MAX_TERM_LENGTH = 64
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN = re.compile(r'\w+')
+_QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    """Lowercased word tokens of ``text``, in order."""
+    return [token for token in _TOKEN.findall(text.lower()) if len(token) <= MAX_TERM_LENGTH]
+
+
+def parse_search(query):
+    """Split a SEARCH query into ``(clauses, prefixes)``.
+
+    Bare words and "quoted phrases" become clauses (lists of terms) that a
+    file must all contain; ``name:<prefix>`` restricts results to file names
+    starting with the prefix. Raises ValueError for an empty query.
+    """
+    clauses = []
+    prefixes = []
+    for phrase, word in _QUERY_PART.findall(query):
+        if word.startswith('name:'):
+            if word[5:]:
+                prefixes.append(word[5:])
+            continue
+        terms = tokenize(phrase or word)
+        if phrase:
+            if terms:
+                clauses.append(terms)
+        else:
+            clauses.extend([term] for term in terms)
+    if not clauses and not prefixes:
+        raise ValueError("Empty search query")
+    return clauses, prefixes
+
+
+def parse_page(args):
+    """Parse ``cursor=N``/``limit=N`` command arguments into ``search()`` keyword arguments."""
+    offset = 0
+    limit = DEFAULT_PAGE_SIZE
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            raise ValueError(f"Expected key=value, got '{arg}'")
+        if key == 'cursor':
+            offset = max(0, int(value))
+        elif key == 'limit':
+            limit = max(1, min(int(value), MAX_PAGE_SIZE))
+        else:
+            raise ValueError(f"Unknown option '{key}'")
+    return {'offset': offset, 'limit': limit}
+
+
+class SearchIndex:
+    """Positional inverted index over the files in a ``FileCatalog``, ranked with BM25.
+
+    Every indexed file records the catalog version (size and mtime) it was
+    read at. ``changed`` queues a file written by this server, and a
+    background thread re-reads only the queued files and any whose catalog
+    entry moved since (e.g. written by another process), so the index is
+    built once and then kept current incrementally. It is saved to ``path``
+    at most every ``save_interval`` seconds and reloaded on start; files
+    changed while the server was down are picked up the same way. A search
+    first applies whatever is still queued, so it sees every finished write.
+    """
+
+    def __init__(self, catalog, path=SEARCH_INDEX_FILE, durability=None, save_interval=SAVE_INTERVAL,
+                 max_file_bytes=SEARCH_MAX_FILE_BYTES):
+        self.catalog = catalog
+        self.path = path
+        self.durability = durability or Durability()
+        self.save_interval = save_interval
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._docs = {}  # filename -> [size, mtime, length in tokens]
+        self._postings = defaultdict(dict)  # term -> {filename: [positions]}
+        self._doc_terms = {}  # filename -> terms it is listed under
+        self._total_length = 0
+        self._pending = set()
+        self._updating = threading.Lock()  # One catch-up at a time, so a search waits for one in progress
+        self._catalog_version = None
+        self._dirty = False
+        self.indexed = 0  # Files (re)indexed since start
+        self._load()
+        threading.Thread(target=self._run, name='search-index', daemon=True).start()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Rebuilt from the files
+        self._docs = data['docs']
+        for term, docs in data['postings'].items():
+            self._postings[term] = docs
+            for name in docs:
+                self._doc_terms.setdefault(name, []).append(term)
+        self._total_length = sum(doc[2] for doc in self._docs.values())
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            data = json.dumps({'docs': self._docs, 'postings': self._postings}, separators=(',', ':'))
+            self._dirty = False
+        self.durability.write(self.path, data)
+
+    def changed(self, name):
+        """Queue ``name`` for re-indexing after it was created, changed or deleted."""
+        with self._cond:
+            self._pending.add(name)
+            self._cond.notify()
+
+    def _run(self):
+        last_save = time.monotonic()
+        while True:
+            with self._cond:
+                self._cond.wait(self.save_interval)
+            try:
+                self._catch_up()
+                if self._dirty and time.monotonic() - last_save >= self.save_interval:
+                    self.save()
+                    last_save = time.monotonic()
+            except Exception as e:
+                print(f"[SEARCH INDEX] {e}")
+
+    def _catch_up(self):
+        """Re-index queued files, and files whose catalog entry changed since the last check."""
+        with self._updating:
+            version = self.catalog.version
+            if version != self._catalog_version:
+                names = set(self.catalog.names())
+                stale = [name for name in self._docs if name not in names]
+                for name in names:
+                    info = self.catalog.info(name)
+                    doc = self._docs.get(name)
+                    if info is not None and (doc is None or doc[0] != info.size or doc[1] != info.mtime):
+                        stale.append(name)
+                with self._cond:
+                    self._pending.update(stale)
+                self._catalog_version = version
+            while True:
+                with self._cond:
+                    if not self._pending:
+                        return
+                    name = self._pending.pop()
+                self._reindex(name)
+
+    def _reindex(self, name):
+        info = self.catalog.info(name)
+        terms = ()
+        if info is not None and info.size <= self.max_file_bytes:
+            try:
+                terms = tokenize(self.catalog.store.read_text(name))
+            except (OSError, UnicodeDecodeError):
+                pass  # Gone meanwhile, or not text: found by name only
+        positions = defaultdict(list)
+        for position, term in enumerate(terms):
+            positions[term].append(position)
+        with self._lock:
+            self._remove(name)
+            if info is not None:
+                self._docs[name] = [info.size, info.mtime, len(terms)]
+                self._doc_terms[name] = list(positions)
+                self._total_length += len(terms)
+                for term, at in positions.items():
+                    self._postings[term][name] = at
+            self._dirty = True
+            self.indexed += 1
+
+    def _remove(self, name):
+        # Called with the lock held
+        doc = self._docs.pop(name, None)
+        if doc is None:
+            return
+        self._total_length -= doc[2]
+        for term in self._doc_terms.pop(name, ()):
+            docs = self._postings.get(term)
+            if docs is not None:
+                docs.pop(name, None)
+                if not docs:
+                    del self._postings[term]
+
+    def _matches(self, clause):
+        """Files containing the terms of ``clause`` in sequence -> number of occurrences."""
+        postings = [self._postings.get(term) for term in clause]
+        if not all(postings):
+            return {}
+        if len(clause) == 1:
+            return {name: len(at) for name, at in postings[0].items()}
+        matches = {}
+        for name in set(postings[0]).intersection(*postings[1:]):
+            following = [set(docs[name]) for docs in postings[1:]]
+            count = sum(1 for start in postings[0][name]
+                        if all(start + i + 1 in at for i, at in enumerate(following)))
+            if count:
+                matches[name] = count
+        return matches
+
+    def search(self, query, offset=0, limit=DEFAULT_PAGE_SIZE):
+        """Rank the files matching ``query`` (see ``parse_search``).
+
+        Returns ``(results, next_cursor, total)``: one page of
+        ``{"filename", "score", "hits"}`` dicts, best first, the offset of
+        the next page (None on the last) and the number of matching files.
+        """
+        clauses, prefixes = parse_search(query)
+        self._catch_up()
+        with self._lock:
+            count = len(self._docs) or 1
+            average = self._total_length / count or 1
+            scores = defaultdict(float)
+            hits = defaultdict(int)
+            candidates = None
+            for clause in clauses:
+                matches = self._matches(clause)
+                idf = math.log(1 + (count - len(matches) + 0.5) / (len(matches) + 0.5))
+                for name, tf in matches.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._docs[name][2] / average)
+                    scores[name] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    hits[name] += tf
+                candidates = set(matches) if candidates is None else candidates & matches.keys()
+                if not candidates:
+                    break
+            if candidates is None:
+                candidates = self._docs.keys()
+            if prefixes:
+                candidates = [name for name in candidates if name.startswith(tuple(prefixes))]
+            ranked = sorted(candidates, key=lambda name: (-scores[name], name))
+
+        page = [{"filename": name, "score": round(scores[name], 4), "hits": hits[name]}
+                for name in ranked[offset:offset + limit]]
+        next_cursor = offset + limit if offset + limit < len(ranked) else None
+        return page, next_cursor, len(ranked)
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._docs), "terms": len(self._postings), "pending": len(self._pending),
+                    "indexed": self.indexed}
@@ -0,0 +1,164 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+SECRET_FILE = '.session_secret'
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 8 * 3600))  # Seconds a login stays valid
+SESSION_CACHE_SIZE = 10000  # Validated tokens kept for O(1) lookups
+PASSWORD_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 200000))
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    """Salted PBKDF2-SHA256 hash in the form ``pbkdf2_sha256$iterations$salt$hash``."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def verify_password(user, password):
+    """Check a password against a users.json entry.
+
+    Entries still holding a plaintext ``password`` are accepted so an old
+    users.json keeps working until it is migrated.
+    """
+    if password is None:
+        return False
+    stored = user.get('password_hash')
+    if stored is None:
+        return 'password' in user and hmac.compare_digest(user['password'], password)
+    try:
+        scheme, iterations, salt, expected = stored.split('$')
+    except ValueError:
+        return False
+    if scheme != 'pbkdf2_sha256':
+        return False
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), _b64decode(salt), int(iterations))
+    return hmac.compare_digest(digest, _b64decode(expected))
+
+
+def load_secret(path=SECRET_FILE):
+    """Signing key shared by every server process started from this directory."""
+    if os.environ.get('SESSION_SECRET'):
+        return os.environ['SESSION_SECRET'].encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+class RevocationList:
+    """Tokens logged out before they expired, kept until they would have."""
+
+    def __init__(self):
+        self._revoked = {}  # token -> expires
+        self._lock = threading.Lock()
+
+    def revoke(self, token, expires, now):
+        with self._lock:
+            self._revoked[token] = expires
+            for stale in [t for t, exp in self._revoked.items() if exp <= now]:
+                del self._revoked[stale]
+
+    def is_revoked(self, token, now):
+        with self._lock:
+            return token in self._revoked
+
+
+class SessionManager:
+    """Issues and validates signed, expiring session tokens.
+
+    A token carries the username, role and expiry, signed with HMAC-SHA256, so
+    any process holding the secret can validate it. Validated tokens are kept
+    in an LRU cache; a cache hit costs one dict lookup and an expiry check,
+    plus a check of ``revocations``. Pass a shared revocation list (see
+    state_backend.py) so a logout is honoured by every process.
+    """
+
+    def __init__(self, secret, ttl=SESSION_TTL, cache_size=SESSION_CACHE_SIZE, revocations=None):
+        self._secret = secret
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.revocations = revocations if revocations is not None else RevocationList()
+        self._cache = OrderedDict()  # token -> (username, role, expires)
+        self._lock = threading.Lock()
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self._secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, username, role):
+        expires = int(time.time()) + self.ttl
+        payload = _b64encode(json.dumps(
+            {"u": username, "r": role, "exp": expires, "n": secrets.token_hex(4)},
+            separators=(',', ':')).encode())
+        token = f"{payload}.{self._sign(payload)}"
+        self._remember(token, (username, role, expires))
+        return token
+
+    def _remember(self, token, entry):
+        with self._lock:
+            self._cache[token] = entry
+            self._cache.move_to_end(token)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def validate(self, token):
+        """Return ``(username, role)`` for a live token, or None."""
+        if not token:
+            return None
+        now = time.time()
+        if self.revocations.is_revoked(token, now):
+            return None
+        with self._lock:
+            entry = self._cache.get(token)
+            if entry is not None:
+                if entry[2] > now:
+                    self._cache.move_to_end(token)
+                    return entry[0], entry[1]
+                del self._cache[token]
+                return None
+
+        payload, _, signature = token.partition('.')
+        if not signature or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+            entry = (claims['u'], claims['r'], claims['exp'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if entry[2] <= now:
+            return None
+        self._remember(token, entry)
+        return entry[0], entry[1]
+
+    def revoke(self, token):
+        if not token:
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._cache.pop(token, None)
+        self.revocations.revoke(token, entry[2] if entry else now + self.ttl, now)
+
+
+if __name__ == '__main__':
+    # Print a password_hash value for users.json
+    from getpass import getpass
+    print(hash_password(getpass('Password: ')))
@@ -0,0 +1,582 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from durability import Durability
+from lock_manager import LockManager, LOCK_WAIT_TIMEOUT, WRITE_LEASE
+from request_store import RequestStore, SNAPSHOT_FILE, JOURNAL_FILE, INDEXED_FIELDS, DEFAULT_PAGE_SIZE
+from sessions import RevocationList
+from two_fa import UsedCodes
+
+# "memory": locks and requests live in this process (one server process per
+# files directory); "sqlite": they live in STATE_DB, shared by every process
+# on the host, so both servers can run several workers
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_DB = os.environ.get('STATE_DB', 'state.db')
+LOCK_POLL_INTERVAL = 0.005  # First wait between retries for a busy lock; doubles up to LOCK_POLL_MAX
+LOCK_POLL_MAX = 0.05
+QUEUE_HEARTBEAT = 1.0  # A queued waiter not seen for this long is dropped (its process went away)
+EVENT_RETENTION = 60.0  # Seconds relayed change events are kept for processes that poll late
+BACKENDS = ('memory', 'sqlite')
+
+
+class _Database:
+    """One SQLite database in WAL mode, with a connection per thread."""
+
+    def __init__(self, path, synchronous='NORMAL'):
+        self.path = path
+        self.synchronous = synchronous
+        self._local = threading.local()
+
+    def connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(f'PRAGMA synchronous={self.synchronous}')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction; takes the database's write lock up front so reads in it stay current."""
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SqliteLockManager:
+    """``LockManager`` with its lock table in SQLite, shared by all processes on the host.
+
+    Each holder and each queued waiter is one row; row ids give the arrival
+    order, so waiters are served as fairly as in memory (a reader never
+    overtakes a queued writer). Waiters poll with a short backoff instead of
+    sleeping on a condition. Write leases use wall-clock time so every
+    process agrees on when they run out, and rows left by a process that
+    died are dropped the next time they stand in someone's way.
+
+    Reads are released per process (``release_read`` takes no owner), and
+    ``release_all`` only drops the write locks taken by this process, like a
+    per-process ``LockManager`` would. Read hold times reported to the
+    observer are per reader rather than per run of readers.
+    """
+
+    def __init__(self, path=STATE_DB, observer=None):
+        self.observer = observer
+        # Lock state does not need to survive a crash, only to be shared
+        self._db = _Database(path, synchronous='OFF')
+        with self._db.transaction() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS file_locks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                owner TEXT,
+                granted INTEGER NOT NULL,
+                since REAL NOT NULL,
+                expires REAL,
+                pid INTEGER NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS file_locks_filename ON file_locks (filename, id)')
+
+    def _expire(self, db, filename, now):
+        """Drop lapsed leases and forgotten waiters on ``filename``; returns the remaining rows."""
+        rows = db.execute('SELECT id, kind, owner, granted, since, expires, pid FROM file_locks '
+                          'WHERE filename = ? ORDER BY id', (filename,)).fetchall()
+        live = []
+        for row in rows:
+            if row[5] is not None and now >= row[5]:
+                db.execute('DELETE FROM file_locks WHERE id = ?', (row[0],))
+                if row[3] and self.observer is not None:
+                    self.observer.lock_held(row[1], filename, now - row[4])
+            else:
+                live.append(row)
+        return live
+
+    def _reap(self, db, rows):
+        """Drop rows held by processes that no longer exist; returns the rest."""
+        me = os.getpid()
+        alive = {}
+        live = []
+        for row in rows:
+            pid = row[6]
+            if pid != me and alive.setdefault(pid, _process_alive(pid)) is False:
+                db.execute('DELETE FROM file_locks WHERE id = ?', (row[0],))
+            else:
+                live.append(row)
+        return live
+
+    @staticmethod
+    def _can_grant(kind, rows, ticket):
+        granted = [row for row in rows if row[3]]
+        queued = [row for row in rows if not row[3]]
+        if kind == 'write':
+            if granted:
+                return False
+            return not queued or queued[0][0] == ticket
+        if any(row[1] == 'write' for row in granted):
+            return False
+        for row in queued:
+            if row[0] == ticket:
+                return True
+            if row[1] == 'write':
+                return False
+        return True
+
+    @staticmethod
+    def _busy_message(kind, rows):
+        granted = [row for row in rows if row[3]]
+        for row in granted:
+            if row[1] == 'write':
+                if kind == 'read':
+                    return f"File is being edited by {row[2]}"
+                return f"File is locked by {row[2]}"
+        if granted:
+            return f"File is currently being read by {len(granted)} users"
+        return "File is busy"
+
+    def _acquire(self, kind, filename, owner, timeout, lease):
+        started = time.monotonic()
+        result = self._wait_for(kind, filename, owner, timeout, lease)
+        # A failed zero-timeout try is a probe, not a wait that timed out
+        if self.observer is not None and (result[0] or timeout):
+            self.observer.lock_waited(kind, filename, time.monotonic() - started, result[0])
+        return result
+
+    def _wait_for(self, kind, filename, owner, timeout, lease):
+        deadline = time.monotonic() + (timeout or 0)
+        ticket = None
+        delay = LOCK_POLL_INTERVAL
+        while True:
+            with self._db.transaction() as db:
+                now = time.time()
+                rows = self._expire(db, filename, now)
+                if ticket is not None and all(row[0] != ticket for row in rows):
+                    ticket = None  # Dropped as forgotten while this thread was held up
+                if not self._can_grant(kind, rows, ticket):
+                    rows = self._reap(db, rows)
+                if self._can_grant(kind, rows, ticket):
+                    expires = now + lease if kind == 'write' and lease else None
+                    if ticket is None:
+                        db.execute('INSERT INTO file_locks (filename, kind, owner, granted, since, expires, pid) '
+                                   'VALUES (?, ?, ?, 1, ?, ?, ?)', (filename, kind, owner, now, expires, os.getpid()))
+                    else:
+                        db.execute('UPDATE file_locks SET granted = 1, since = ?, expires = ? WHERE id = ?',
+                                   (now, expires, ticket))
+                    return True, None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if ticket is not None:
+                        db.execute('DELETE FROM file_locks WHERE id = ?', (ticket,))
+                    return False, self._busy_message(kind, rows)
+
+                if ticket is None:
+                    ticket = db.execute(
+                        'INSERT INTO file_locks (filename, kind, owner, granted, since, expires, pid) '
+                        'VALUES (?, ?, ?, 0, ?, ?, ?)',
+                        (filename, kind, owner, now, now + QUEUE_HEARTBEAT, os.getpid())).lastrowid
+                else:
+                    db.execute('UPDATE file_locks SET expires = ? WHERE id = ?', (now + QUEUE_HEARTBEAT, ticket))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, LOCK_POLL_MAX)
+
+    def acquire_read(self, filename, owner=None, timeout=LOCK_WAIT_TIMEOUT):
+        return self._acquire('read', filename, owner, timeout, None)
+
+    def acquire_write(self, filename, owner, timeout=LOCK_WAIT_TIMEOUT, lease=WRITE_LEASE):
+        return self._acquire('write', filename, owner, timeout, lease)
+
+    def release_read(self, filename):
+        with self._db.transaction() as db:
+            row = db.execute("SELECT id, since FROM file_locks WHERE filename = ? AND kind = 'read' "
+                             "AND granted = 1 AND pid = ? LIMIT 1", (filename, os.getpid())).fetchone()
+            if row is None:
+                return
+            db.execute('DELETE FROM file_locks WHERE id = ?', (row[0],))
+        if self.observer is not None:
+            self.observer.lock_held('read', filename, time.time() - row[1])
+
+    def _write_lock(self, db, filename, owner, now):
+        return db.execute("SELECT id, since FROM file_locks WHERE filename = ? AND kind = 'write' AND granted = 1 "
+                          "AND owner = ? AND (expires IS NULL OR expires > ?)", (filename, owner, now)).fetchone()
+
+    def release_write(self, filename, owner):
+        """Release a write lock held by ``owner``; returns False if they do not hold it."""
+        with self._db.transaction() as db:
+            now = time.time()
+            row = self._write_lock(db, filename, owner, now)
+            if row is None:
+                return False
+            db.execute('DELETE FROM file_locks WHERE id = ?', (row[0],))
+        if self.observer is not None:
+            self.observer.lock_held('write', filename, now - row[1])
+        return True
+
+    def renew(self, filename, owner, lease=WRITE_LEASE):
+        """Extend the lease on a write lock held by ``owner``."""
+        with self._db.transaction() as db:
+            now = time.time()
+            row = self._write_lock(db, filename, owner, now)
+            if row is None:
+                return False
+            db.execute('UPDATE file_locks SET expires = ? WHERE id = ?', (now + lease if lease else None, row[0]))
+            return True
+
+    def release_all(self, owner):
+        """Drop every write lock this process took for ``owner``, e.g. when their session ends."""
+        with self._db.transaction() as db:
+            now = time.time()
+            rows = db.execute("SELECT id, filename, since FROM file_locks WHERE owner = ? AND kind = 'write' "
+                              "AND granted = 1 AND pid = ?", (owner, os.getpid())).fetchall()
+            db.executemany('DELETE FROM file_locks WHERE id = ?', [(row[0],) for row in rows])
+        if self.observer is not None:
+            for _, filename, since in rows:
+                self.observer.lock_held('write', filename, now - since)
+        return [row[1] for row in rows]
+
+    def holder(self, filename):
+        """Owner of the write lock on ``filename``, or None."""
+        row = self._db.connection().execute(
+            "SELECT owner FROM file_locks WHERE filename = ? AND kind = 'write' AND granted = 1 "
+            "AND (expires IS NULL OR expires > ?)", (filename, time.time())).fetchone()
+        return row[0] if row else None
+
+    def write_locks(self):
+        """Map of filename -> owner for every live write lock."""
+        return dict(self._db.connection().execute(
+            "SELECT filename, owner FROM file_locks WHERE kind = 'write' AND granted = 1 "
+            "AND (expires IS NULL OR expires > ?)", (time.time(),)))
+
+    def reader_counts(self):
+        """Map of filename -> number of active readers."""
+        return dict(self._db.connection().execute(
+            "SELECT filename, COUNT(*) FROM file_locks WHERE kind = 'read' AND granted = 1 GROUP BY filename"))
+
+
+class SqliteRequestStore:
+    """``RequestStore`` kept in a SQLite table, shared by all processes on the host.
+
+    The full record is stored as JSON next to one column per indexed field
+    (and the timestamp), which carry the table's indexes, so filtered
+    listings and bulk selections are answered by SQLite. Conditional claims
+    (``update_many(if_status=...)``) run in one write transaction, so two
+    workers never handle the same request. Commits are synced when
+    ``durability`` syncs.
+    """
+
+    def __init__(self, path=STATE_DB, table='requests', indexed_fields=INDEXED_FIELDS, durability=None):
+        self.table = table
+        self.indexed_fields = tuple(indexed_fields)
+        for name in (table,) + self.indexed_fields:
+            if not name.isidentifier():
+                raise ValueError(f"Invalid table or field name '{name}'")
+        durability = durability or Durability()
+        self._db = _Database(path, synchronous='FULL' if durability.syncs else 'NORMAL')
+        self._columns = self.indexed_fields + ('timestamp',)
+        with self._db.transaction() as db:
+            columns = ''.join(f', {field}' for field in self._columns)
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       f'record TEXT NOT NULL{columns})')
+            for field in self._columns:
+                db.execute(f'CREATE INDEX IF NOT EXISTS {table}_{field} ON {table} ({field}, id)')
+
+    def _row_values(self, record):
+        fields = {key: value for key, value in record.items() if key != 'id'}
+        return (json.dumps(fields),) + tuple(record.get(field) for field in self._columns)
+
+    @staticmethod
+    def _record(row):
+        return {'id': row[0], **json.loads(row[1])}
+
+    def _insert(self, db, record):
+        columns = ''.join(f', {field}' for field in self._columns)
+        placeholders = ', ?' * (len(self._columns) + 1)
+        return db.execute(f'INSERT INTO {self.table} (id, record{columns}) VALUES (?{placeholders})',
+                          (record.get('id'),) + self._row_values(record)).lastrowid
+
+    def _replace(self, db, record):
+        assignments = ''.join(f', {field} = ?' for field in self._columns)
+        db.execute(f'UPDATE {self.table} SET record = ?{assignments} WHERE id = ?',
+                   self._row_values(record) + (record['id'],))
+
+    def import_records(self, records):
+        """Load ``records`` (e.g. from a ``RequestStore``) if the table is still empty; returns how many."""
+        with self._db.transaction() as db:
+            if db.execute(f'SELECT 1 FROM {self.table} LIMIT 1').fetchone():
+                return 0
+            for record in records:
+                self._insert(db, record)
+            return len(records)
+
+    def close(self):
+        self._db.close()
+
+    def add(self, **fields):
+        """Store a new request, assigning it the next id, and return it."""
+        with self._db.transaction() as db:
+            request_id = self._insert(db, fields)
+        return {'id': request_id, **fields}
+
+    def _get(self, db, request_id):
+        row = db.execute(f'SELECT id, record FROM {self.table} WHERE id = ?', (request_id,)).fetchone()
+        return self._record(row) if row else None
+
+    def update(self, request_id, **changes):
+        """Apply ``changes`` to a request; returns the new record or None if unknown."""
+        with self._db.transaction() as db:
+            record = self._get(db, request_id)
+            if record is None:
+                return None
+            record = {**record, **changes}
+            self._replace(db, record)
+        return record
+
+    def update_many(self, request_ids, if_status=None, **changes):
+        """Apply the same ``changes`` to many requests in one transaction (see ``RequestStore.update_many``)."""
+        with self._db.transaction() as db:
+            updated = []
+            for request_id in request_ids:
+                record = self._get(db, request_id)
+                if record is None or (if_status is not None and record.get('status') not in if_status):
+                    continue
+                record = {**record, **changes}
+                self._replace(db, record)
+                updated.append(record)
+        return updated
+
+    def release_orphaned(self):
+        """Put requests left "queued" by processes that are gone back to "pending"; returns them.
+
+        Claims record the pid of the process whose apply queue holds them;
+        those of live processes (including this one) are left alone.
+        """
+        released = []
+        with self._db.transaction() as db:
+            rows = db.execute(f"SELECT id, record FROM {self.table} WHERE status = 'queued'").fetchall()
+            for row in rows:
+                record = self._record(row)
+                pid = record.get('queued_by')
+                if pid == os.getpid() or (pid is not None and _process_alive(pid)):
+                    continue
+                record = {**record, 'status': 'pending', 'queued_by': None}
+                self._replace(db, record)
+                released.append(record)
+        return released
+
+    def get(self, request_id):
+        return self._get(self._db.connection(), request_id)
+
+    def all(self):
+        rows = self._db.connection().execute(f'SELECT id, record FROM {self.table} ORDER BY id')
+        return [self._record(row) for row in rows]
+
+    def _select(self, filters, cursor, limit):
+        filters = dict(filters or {})
+        since = filters.pop('since', None)
+        until = filters.pop('until', None)
+        clauses = []
+        params = []
+        for field, value in filters.items():
+            if field not in self.indexed_fields:
+                raise ValueError(f"Unknown filter '{field}'")
+            clauses.append(f'{field} = ?')
+            params.append(value)
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('timestamp < ?')
+            params.append(until)
+        if cursor is not None:
+            clauses.append('id > ?')
+            params.append(cursor)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        sql = f'SELECT id, record FROM {self.table}{where} ORDER BY id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self._db.connection().execute(sql, params)
+
+    def query(self, filters=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """Return one page of requests matching ``filters``, oldest first (see ``RequestStore.query``)."""
+        page = [self._record(row) for row in self._select(filters, cursor, limit + 1)]
+        if len(page) > limit:
+            return page[:limit], page[limit - 1]['id']
+        return page, None
+
+    def matching_ids(self, filters=None, limit=None):
+        """Ids of up to ``limit`` requests matching ``filters`` (as for ``query``), oldest first."""
+        return [row[0] for row in self._select(filters, None, limit)]
+
+    def __len__(self):
+        return self._db.connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+class SqliteUsedCodes:
+    """``UsedCodes`` in SQLite, so a TOTP code accepted by one process is refused by all."""
+
+    def __init__(self, path=STATE_DB):
+        self._db = _Database(path)
+        with self._db.transaction() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS used_codes (
+                user TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                PRIMARY KEY (user, step))''')
+            db.execute('CREATE INDEX IF NOT EXISTS used_codes_expires ON used_codes (expires)')
+
+    def claim(self, user, step, expires, now):
+        """Mark a code as used until ``expires``; False if it already was."""
+        with self._db.transaction() as db:
+            db.execute('DELETE FROM used_codes WHERE expires <= ?', (now,))
+            return db.execute('INSERT OR IGNORE INTO used_codes VALUES (?, ?, ?)',
+                              (user, step, expires)).rowcount == 1
+
+
+class SqliteRevocationList:
+    """``RevocationList`` in SQLite, so a logout is honoured by every process.
+
+    Only a digest of each token is stored.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self._db = _Database(path)
+        with self._db.transaction() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS revoked_tokens (
+                digest TEXT PRIMARY KEY,
+                expires REAL NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS revoked_tokens_expires ON revoked_tokens (expires)')
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def revoke(self, token, expires, now):
+        with self._db.transaction() as db:
+            db.execute('DELETE FROM revoked_tokens WHERE expires <= ?', (now,))
+            db.execute('INSERT OR REPLACE INTO revoked_tokens VALUES (?, ?)', (self._digest(token), expires))
+
+    def is_revoked(self, token, now):
+        return self._db.connection().execute(
+            'SELECT 1 FROM revoked_tokens WHERE digest = ? AND expires > ?',
+            (self._digest(token), now)).fetchone() is not None
+
+
+class SqliteEventLog:
+    """Change events written to SQLite and read back by the other processes sharing it.
+
+    ``EventBus`` relays through it, so subscribers see changes made by any
+    backend worker or by web_server.py. Events are kept for ``retention``
+    seconds.
+    """
+
+    def __init__(self, path=STATE_DB, retention=EVENT_RETENTION):
+        self.retention = retention
+        # Events are notifications, not state: losing the last few in a crash is harmless
+        self._db = _Database(path, synchronous='OFF')
+        with self._db.transaction() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pid INTEGER NOT NULL,
+                created REAL NOT NULL,
+                event TEXT NOT NULL)''')
+            db.execute('CREATE INDEX IF NOT EXISTS events_created ON events (created)')
+
+    def latest(self):
+        """Id of the newest event; read after it to follow events from now on."""
+        return self._db.connection().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def append(self, events):
+        if not events:
+            return
+        now = time.time()
+        with self._db.transaction() as db:
+            db.execute('DELETE FROM events WHERE created < ?', (now - self.retention,))
+            db.executemany('INSERT INTO events (pid, created, event) VALUES (?, ?, ?)',
+                           [(os.getpid(), now, json.dumps(event)) for event in events])
+
+    def exchange(self, events, after):
+        """Append this process's ``events``, then read other processes' events after id ``after``.
+
+        Returns ``(their events, the id to read after next time)``.
+        """
+        self.append(events)
+        rows = self._db.connection().execute(
+            'SELECT id, pid, event FROM events WHERE id > ? ORDER BY id', (after,)).fetchall()
+        if rows:
+            after = rows[-1][0]
+        pid = os.getpid()
+        return [json.loads(event) for _, origin, event in rows if origin != pid], after
+
+
+def _check_backend(kind):
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND '{kind}', expected one of {', '.join(BACKENDS)}")
+
+
+def open_lock_manager(kind=STATE_BACKEND, observer=None):
+    """The file lock table for this process: private, or shared through STATE_DB."""
+    _check_backend(kind)
+    if kind == 'sqlite':
+        return SqliteLockManager(STATE_DB, observer=observer)
+    return LockManager(observer=observer)
+
+
+def open_request_store(kind=STATE_BACKEND, snapshot_path=SNAPSHOT_FILE, journal_path=JOURNAL_FILE,
+                       table='requests', indexed_fields=INDEXED_FIELDS, durability=None):
+    """The request store for this process: journalled in memory, or a table in STATE_DB.
+
+    A new SQLite table starts from the requests in ``snapshot_path`` and its
+    journal, so switching backends keeps the request history.
+    """
+    _check_backend(kind)
+    if kind == 'memory':
+        return RequestStore(snapshot_path, journal_path, indexed_fields=indexed_fields, durability=durability)
+    store = SqliteRequestStore(STATE_DB, table, indexed_fields, durability=durability)
+    if snapshot_path is not None and os.path.exists(snapshot_path) and not len(store):
+        previous = RequestStore(snapshot_path, journal_path, indexed_fields=indexed_fields)
+        store.import_records(previous.all())
+        previous.close()
+    return store
+
+
+def open_used_codes(kind=STATE_BACKEND):
+    """TOTP codes already accepted: remembered by this process, or shared through STATE_DB."""
+    _check_backend(kind)
+    return SqliteUsedCodes(STATE_DB) if kind == 'sqlite' else UsedCodes()
+
+
+def open_revocations(kind=STATE_BACKEND):
+    """Session tokens logged out early: remembered by this process, or shared through STATE_DB."""
+    _check_backend(kind)
+    return SqliteRevocationList(STATE_DB) if kind == 'sqlite' else RevocationList()
+
+
+def open_event_log(kind=STATE_BACKEND):
+    """The log change events are relayed through between processes, or None to keep them local."""
+    _check_backend(kind)
+    return SqliteEventLog(STATE_DB) if kind == 'sqlite' else None
@@ -1,5 +1,12 @@
 let currentRole = null;
 let currentUsername = null;
+let sessionToken = null;  // Issued by /auth, sent with every request
+
+function authHeaders(extra = {}) {
+    return { 'Authorization': `Bearer ${sessionToken}`, ...extra };
+}
+let requestsCursor = null;  // next_cursor of the last LIST_REQUESTS page
+const PREVIEW_BYTES = 64 * 1024;  // How much of a large file READ displays
 
 // Function to format lock information
 function formatLockInfo(files, lockedFiles, readers) {
@@ -44,13 +51,11 @@ async function sendCommand() {
     try {
         const response = await fetch('/command', {
             method: 'POST',
-            headers: {
+            headers: authHeaders({
                 'Content-Type': 'application/json'
-            },
+            }),
             body: JSON.stringify({
-                command: command,
-                username: currentUsername,
-                role: currentRole
+                command: command
             })
         });
         
@@ -84,13 +89,11 @@ async function toggleLock(action) {
     try {
         const response = await fetch('/command', {
             method: 'POST',
-            headers: {
+            headers: authHeaders({
                 'Content-Type': 'application/json'
-            },
+            }),
             body: JSON.stringify({
-                command: command,
-                username: currentUsername,
-                role: currentRole
+                command: command
             })
         });
         
@@ -126,6 +129,7 @@ async function login() {
             document.getElementById('commandForm').style.display = 'block';
             currentRole = data.role;
             currentUsername = username;
+            sessionToken = data.token;
             document.getElementById('output').value = `Logged in as ${username} (${data.role})`;
             
             // Show/hide admin-specific actions
@@ -166,6 +170,7 @@ document.getElementById('login-btn').addEventListener('click', async () => {
         if (result.status === 'success') {
             currentRole = result.role;
             currentUsername = username;
+            sessionToken = result.token;
             document.getElementById('login-section').classList.add('hidden');
             document.getElementById('main-section').classList.remove('hidden');
             document.getElementById(result.role === 'admin' ? 'admin-controls' : 'user-controls').classList.remove('hidden');
@@ -200,6 +205,10 @@ async function executeCommand(action, filename = '', content = '') {
                 document.getElementById('output').textContent = 'Invalid request action';
                 return;
             }
+        } else if (action === 'LIST_REQUESTS') {
+            // Pending requests only, one page at a time; repeat to load the next page
+            command = `${action}::status=pending::limit=50`;
+            if (requestsCursor !== null) command += `::cursor=${requestsCursor}`;
         } else if (action === 'HANDLE_REQUEST') {
             const requestId = prompt('Enter request ID:');
             if (!requestId) return;
@@ -210,12 +219,8 @@ async function executeCommand(action, filename = '', content = '') {
 
         const response = await fetch('/command', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ 
-                command,
-                username: currentUsername,
-                role: currentRole
-            })
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
+            body: JSON.stringify({ command })
         });
         
         const result = await response.json();
@@ -228,9 +233,23 @@ async function executeCommand(action, filename = '', content = '') {
                     result.readers || {}
                 );
             } else if (action === 'READ') {
-                document.getElementById('output').textContent = result.content;
+                if (result.stream) {
+                    // Large file: fetch only the first part through the streaming endpoint
+                    const preview = await fetch(result.stream, {
+                        headers: authHeaders({ 'Range': `bytes=0-${PREVIEW_BYTES - 1}` })
+                    });
+                    document.getElementById('output').textContent = await preview.text() +
+                        `\n\n[Showing the first ${PREVIEW_BYTES} of ${result.size} bytes]`;
+                } else {
+                    document.getElementById('output').textContent = result.content;
+                }
             } else if (action === 'LIST_REQUESTS') {
-                document.getElementById('output').textContent = JSON.stringify(result.requests, null, 2);
+                requestsCursor = result.next_cursor;
+                let text = JSON.stringify(result.requests, null, 2);
+                if (requestsCursor !== null) {
+                    text += '\n\nMore requests available - run List Requests again for the next page.';
+                }
+                document.getElementById('output').textContent = text;
             } else {
                 document.getElementById('output').textContent = result.message;
                 if (['CREATE', 'EDIT', 'DELETE'].includes(action)) {
@@ -272,8 +291,10 @@ document.getElementById('execute-btn').addEventListener('click', async () => {
 });
 
 document.getElementById('logout-btn').addEventListener('click', () => {
+    fetch('/logout', { method: 'POST', headers: authHeaders() });
     currentRole = null;
     currentUsername = null;
+    sessionToken = null;
     document.getElementById('output').textContent = 'Logged out successfully';
     document.getElementById('main-section').classList.add('hidden');
     document.getElementById('admin-controls').classList.add('hidden');
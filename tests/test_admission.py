@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from admission import AdmissionController, Overloaded, TokenBucket, is_heavy
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(10, 5)
+    start = bucket.updated
+    bucket.take(5)
+    assert bucket.shortfall(1, start) == pytest.approx(0.1)
+    assert bucket.shortfall(1, start + 0.11) == 0.0
+
+
+def test_rate_limit_rejects_with_retry_after():
+    admission = AdmissionController(limits={'user': {'total': (1, 2)}})
+    for _ in range(2):
+        admission.leave(admission.enter('bob', 'user', 'LIST'))
+    with pytest.raises(Overloaded) as e:
+        admission.enter('bob', 'user', 'LIST')
+    assert e.value.reason == 'rate_limited'
+    assert 0 < e.value.retry_after <= 1
+    admission.leave(admission.enter('alice', 'user', 'LIST'))  # Buckets are per user
+
+
+def test_queued_command_times_out_when_no_slot_frees():
+    admission = AdmissionController(limits={}, max_in_flight=1, queue_timeout=0.05)
+    ticket = admission.enter('bob', 'user', 'LIST')
+    with pytest.raises(Overloaded) as e:
+        admission.enter('bob', 'user', 'LIST')
+    assert e.value.reason == 'overloaded'
+    assert admission.queued == 0
+    admission.leave(ticket)
+    assert admission.in_flight == 0
+
+
+def test_freed_slot_goes_to_highest_priority_waiter():
+    admission = AdmissionController(limits={}, max_in_flight=1, queue_timeout=5)
+    ticket = admission.enter('bob', 'user', 'LIST')
+    order = []
+
+    def run(username, role, command):
+        with admission.admitted(username, role, command):
+            order.append(command)
+    read = threading.Thread(target=run, args=('bob', 'user', 'READ'))
+    read.start()
+    while admission.queued < 1:
+        pass
+    lock = threading.Thread(target=run, args=('root', 'admin', 'LOCK'))
+    lock.start()
+    while admission.queued < 2:
+        pass
+    admission.leave(ticket)
+    read.join(5)
+    lock.join(5)
+    assert order == ['LOCK', 'READ']
+
+
+def test_single_request_approval_is_not_heavy():
+    assert not is_heavy('HANDLE_REQUEST', [1, 'approve'], None)
+    assert is_heavy('HANDLE_REQUESTS', ['approve', []], None)
@@ -0,0 +1,33 @@
+import threading
+
+from apply_queue import ApplyQueue
+
+
+def blocked_queue():
+    """A one-worker queue held busy until the returned event is set."""
+    queue = ApplyQueue(workers=1)
+    gate = threading.Event()
+    queue.submit('busy', gate.wait)
+    return queue, gate
+
+
+def test_jobs_for_one_key_run_in_order():
+    queue, gate = blocked_queue()
+    ran = []
+    futures = [queue.submit('a.txt', ran.append, i) for i in range(5)]
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert ran == [0, 1, 2, 3, 4]
+
+
+def test_urgent_job_overtakes_other_keys_but_not_its_own():
+    queue, gate = blocked_queue()
+    ran = []
+    for i in range(3):
+        queue.submit(f'bulk-{i}.txt', ran.append, f'bulk-{i}')
+    queue.submit('f.txt', ran.append, 'f-earlier')
+    urgent = queue.submit('f.txt', ran.append, 'f-urgent', urgent=True)
+    gate.set()
+    urgent.result(timeout=5)
+    assert ran[:2] == ['f-earlier', 'f-urgent']
@@ -0,0 +1,97 @@
+import asyncio
+import importlib
+import os
+import shutil
+
+import pytest
+import websockets
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def backend(tmp_path_factory):
+    # The server keeps its files, users and state relative to the working directory
+    workdir = tmp_path_factory.mktemp('backend')
+    shutil.copy(os.path.join(REPO, 'users.json'), workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        yield importlib.import_module('backend')
+    finally:
+        os.chdir(cwd)
+
+
+def text(message):
+    return message.decode() if isinstance(message, bytes) else message
+
+
+def converse(backend, script):
+    """Run ``script(websocket)`` against a logged-in admin connection; returns its result"""
+    async def scenario():
+        async with websockets.serve(backend.handle_client, '127.0.0.1', 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f'ws://127.0.0.1:{port}') as ws:
+                await ws.send('admin::admin123')
+                assert (await ws.recv()).startswith('Authentication successful')
+                return await asyncio.wait_for(script(ws), 10)
+
+    return asyncio.run(scenario())
+
+
+def test_pipelined_replies_carry_their_tags(backend):
+    async def script(ws):
+        await ws.send('CREATE::pipe.txt::hello')
+        await ws.recv()
+        await ws.recv()  # Listing sent after a CREATE
+        await ws.send('#a::READ::pipe.txt')
+        await ws.send('#b::NOPE')
+        await ws.send('#c::READ_RANGE::pipe.txt::1::3')
+        return sorted([text(await ws.recv()) for _ in range(3)])
+
+    replies = converse(backend, script)
+    assert replies[0] == '#a::hello'
+    assert replies[1] == '#b::Unknown command or insufficient permissions'
+    assert replies[2] == '#c::ell'
+
+
+def test_failing_pipelined_command_still_gets_a_tagged_reply(backend, monkeypatch):
+    def broken():
+        raise RuntimeError("listing failed")
+    monkeypatch.setattr(backend, 'get_file_list', broken)
+
+    async def script(ws):
+        await ws.send('#x::LIST')
+        await ws.send('#y::READ_RANGE::pipe.txt::0::1')
+        return sorted([text(await ws.recv()) for _ in range(2)])
+
+    assert converse(backend, script) == ['#x::Error: listing failed', '#y::h']
+
+
+def test_metrics_need_an_admin_token(backend):
+    async def scrape(token=None):
+        async with websockets.serve(backend.handle_client, '127.0.0.1', 0,
+                                    process_request=backend.process_request) as server:
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            auth = f'Authorization: Bearer {token}\r\n' if token else ''
+            writer.write(f'GET /metrics HTTP/1.1\r\nHost: localhost\r\n{auth}\r\n'.encode())
+            status = await reader.readline()
+            body = await reader.read()
+            writer.close()
+            return int(status.split()[1]), body
+
+    assert asyncio.run(scrape())[0] == 401
+    assert asyncio.run(scrape(backend.sessions.issue('user', 'user')))[0] == 403
+    status, body = asyncio.run(scrape(backend.sessions.issue('admin', 'admin')))
+    assert status == 200
+    assert b'fms_file_readers ' in body
+    assert b'file=' not in body
+
+
+def test_non_numeric_offset_gets_an_error_reply(backend):
+    async def script(ws):
+        await ws.send('#r::READ_RANGE::pipe.txt::abc')
+        return text(await ws.recv())
+
+    assert converse(backend, script) == '#r::Error: offset must be a number'
@@ -0,0 +1,108 @@
+import pytest
+
+from commands import (FRAME_HEADER, FRAME_MAGIC, TAG_OPCODE, CommandError, Dispatcher,
+                      PermissionDenied, command_name, decode_frame, encode_frame, split_tag)
+
+DENIED = "Unknown command or insufficient permissions"
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(DENIED)
+    for name in ('READ', 'READ_RANGE', 'CREATE', 'MAKE_REQUEST', 'LIST_REQUESTS', 'UPLOAD_CHUNK'):
+        dispatcher.handler(name)(lambda *args: args)
+    return dispatcher
+
+
+def test_text_arguments_are_bound_to_the_schema(dispatcher):
+    spec, _, values = dispatcher.parse('READ_RANGE::a.txt::10::5', 'user')
+    assert spec.name == 'READ_RANGE'
+    assert values == ['a.txt', 10, 5]
+    assert dispatcher.parse('READ_RANGE::a.txt::10', 'user')[2] == ['a.txt', 10, None]
+    assert dispatcher.parse('READ::a.txt', 'user')[2] == ['a.txt', None]
+
+
+def test_rest_argument_keeps_separators(dispatcher):
+    assert dispatcher.parse('CREATE::a.txt::x::y', 'admin')[2] == ['a.txt', 'x::y']
+
+
+def test_variadic_argument_takes_remaining_fields(dispatcher):
+    assert dispatcher.parse('LIST_REQUESTS::status=pending::limit=5', 'admin')[2] == [['status=pending', 'limit=5']]
+    assert dispatcher.parse('LIST_REQUESTS', 'admin')[2] == [[]]
+
+
+@pytest.mark.parametrize('message, error', [
+    ('READ', "Usage: READ::filename::[etag]"),
+    ('READ::a.txt::etag::extra', "Usage: READ::filename::[etag]"),
+    ('READ_RANGE::a.txt::ten', "offset must be a number"),
+    ('MAKE_REQUEST::RENAME::a.txt::x', "action must be one of CREATE, EDIT, DELETE"),
+])
+def test_arguments_that_do_not_fit_are_refused(dispatcher, message, error):
+    with pytest.raises(CommandError) as raised:
+        dispatcher.parse(message, 'user')
+    assert str(raised.value) == error
+
+
+def test_roles_are_checked(dispatcher):
+    with pytest.raises(PermissionDenied, match=DENIED):
+        dispatcher.parse('CREATE::a.txt::x', 'user')
+    with pytest.raises(PermissionDenied, match=DENIED):
+        dispatcher.parse('MAKE_REQUEST::CREATE::a.txt::x', 'admin')
+    assert dispatcher.parse('MAKE_REQUEST::CREATE::a.txt::x', 'user')[2] == ['CREATE', 'a.txt', 'x']
+
+
+def test_unknown_and_unhandled_commands_are_denied(dispatcher):
+    with pytest.raises(PermissionDenied):
+        dispatcher.parse('NOPE::a.txt', 'admin')
+    # Registered, but this server has no handler for it
+    with pytest.raises(PermissionDenied):
+        dispatcher.parse('DELETE::a.txt', 'admin')
+
+
+def test_binary_frame_round_trip():
+    frame = encode_frame(3, ['a.txt', 10, b'\x00\xff'])
+    assert frame[0] == FRAME_MAGIC
+    assert decode_frame(frame) == (3, [b'a.txt', b'10', b'\x00\xff'])
+    assert decode_frame(encode_frame(12, [])) == (12, [])
+
+
+def test_binary_frame_is_bound_without_joining(dispatcher):
+    frame = encode_frame(3, ['a.txt', '10'])
+    assert dispatcher.parse(frame, 'user')[2] == ['a.txt', 10, None]
+    # Content is one field, so the separator is not special
+    frame = encode_frame(4, ['a.txt', 'x::y'])
+    assert dispatcher.parse(frame, 'admin')[2] == ['a.txt', 'x::y']
+    assert dispatcher.parse(encode_frame(17, [b'\x00\x01']), 'admin')[2] == [b'\x00\x01']
+
+
+def test_bad_opcode_is_denied(dispatcher):
+    with pytest.raises(PermissionDenied):
+        dispatcher.parse(encode_frame(200, ['a.txt']), 'admin')
+
+
+@pytest.mark.parametrize('frame, error', [
+    (b'\xfb\x02', "Truncated frame"),
+    (FRAME_HEADER.pack(FRAME_MAGIC, 2, 1), "Truncated frame"),
+    (encode_frame(2, ['a.txt'])[:-1], "Truncated frame"),
+    (encode_frame(2, ['a.txt']) + b'x', "Trailing bytes after frame"),
+    (FRAME_HEADER.pack(0x00, 2, 0), "Not a command frame"),
+])
+def test_malformed_frames_are_refused(frame, error):
+    with pytest.raises(CommandError, match=error):
+        decode_frame(frame)
+
+
+def test_split_tag():
+    assert split_tag('#7::READ::a.txt') == ('7', 'READ::a.txt')
+    assert split_tag('READ::a.txt') == (None, 'READ::a.txt')
+    inner = encode_frame(2, ['a.txt'])
+    assert split_tag(encode_frame(TAG_OPCODE, ['7', inner])) == ('7', inner)
+    assert split_tag(inner) == (None, inner)
+    with pytest.raises(CommandError):
+        split_tag(encode_frame(TAG_OPCODE, ['7']))
+
+
+def test_command_name():
+    assert command_name('READ::a.txt') == 'READ'
+    assert command_name(encode_frame(2, ['a.txt'])) == 'READ'
+    assert command_name(encode_frame(200, [])) is None
@@ -0,0 +1,40 @@
+from content_cache import ContentCache
+
+
+def test_entry_is_returned_only_for_its_version():
+    cache = ContentCache()
+    cache.put('a.txt', (4, 1.0, 1), 'aaaa', 'etag-1')
+    assert cache.get('a.txt', (4, 1.0, 1)).content == 'aaaa'
+    assert cache.get('a.txt', (4, 1.0, 2)) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_invalidate_drops_entry():
+    cache = ContentCache()
+    cache.put('a.txt', 1, 'aaaa', 'etag')
+    cache.invalidate('a.txt')
+    cache.invalidate('missing.txt')
+    assert cache.get('a.txt', 1) is None
+    assert len(cache) == 0
+    assert cache.bytes == 0
+
+
+def test_least_recently_used_is_evicted_first():
+    first = ContentCache()
+    cost = first.put('a.txt', 1, 'x' * 100, 'etag').cost
+    cache = ContentCache(max_bytes=cost * 2)
+    cache.put('a.txt', 1, 'x' * 100, 'etag')
+    cache.put('b.txt', 1, 'y' * 100, 'etag')
+    cache.get('a.txt', 1)
+    cache.put('c.txt', 1, 'z' * 100, 'etag')
+    assert cache.get('b.txt', 1) is None
+    assert cache.get('a.txt', 1) is not None
+    assert cache.bytes <= cache.max_bytes
+
+
+def test_oversized_content_is_not_kept():
+    cache = ContentCache(max_bytes=10)
+    entry = cache.put('big.txt', 1, 'x' * 100, 'etag')
+    assert entry.content == 'x' * 100
+    assert len(cache) == 0
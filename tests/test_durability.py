@@ -0,0 +1,122 @@
+import os
+import threading
+
+import pytest
+
+import durability
+from durability import MODES, Durability
+
+
+def listing(directory):
+    return sorted(os.listdir(directory))
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_write_replaces_content_and_leaves_no_temp_file(tmp_path, mode):
+    dest = tmp_path / 'a.txt'
+    dest.write_text('old')
+    store = Durability(mode)
+    store.write(str(dest), 'new')
+    store.write(str(tmp_path / 'b.bin'), b'\x00\x01')
+    assert dest.read_text() == 'new'
+    assert (tmp_path / 'b.bin').read_bytes() == b'\x00\x01'
+    assert listing(tmp_path) == ['a.txt', 'b.bin']
+
+
+def test_unknown_mode_is_refused():
+    with pytest.raises(ValueError, match="Unknown DURABILITY 'later'"):
+        Durability('later')
+
+
+def test_none_mode_never_fsyncs(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'fsync', lambda fd: pytest.fail("fsync called"))
+    Durability('none').write(str(tmp_path / 'a.txt'), 'x')
+
+
+def test_fsync_mode_syncs_file_before_rename_and_directory_after(tmp_path, monkeypatch):
+    events = []
+    real_fsync, real_replace = os.fsync, os.replace
+
+    def fsync(fd):
+        events.append('dir' if os.path.isdir(f'/proc/self/fd/{fd}') else 'file')
+        real_fsync(fd)
+
+    def replace(src, dst):
+        events.append('rename')
+        real_replace(src, dst)
+
+    monkeypatch.setattr(os, 'fsync', fsync)
+    monkeypatch.setattr(os, 'replace', replace)
+    Durability('fsync').write(str(tmp_path / 'a.txt'), 'x')
+    assert events == ['file', 'rename', 'dir']
+
+
+def test_group_commit_acknowledges_only_after_rename_is_flushed(tmp_path, monkeypatch):
+    events = []
+    real_flush, real_replace = durability._flush, os.replace
+
+    def flush(targets):
+        events.append(('flush', set(targets)))
+        real_flush(targets)
+
+    def replace(src, dst):
+        events.append(('rename', dst))
+        real_replace(src, dst)
+
+    monkeypatch.setattr(durability, '_flush', flush)
+    monkeypatch.setattr(os, 'replace', replace)
+    dest = str(tmp_path / 'a.txt')
+    Durability('group').write(dest, 'x')
+
+    renamed = events.index(('rename', dest))
+    assert events[renamed - 1][0] == 'flush'  # Content made durable first
+    assert any(kind == 'flush' and str(tmp_path) in targets for kind, targets in events[renamed + 1:])
+
+
+def test_group_commit_serves_concurrent_writers(tmp_path):
+    store = Durability('group')
+    writers = 20
+    start = threading.Barrier(writers)
+
+    def write(index):
+        start.wait()
+        store.write(str(tmp_path / f'{index}.txt'), str(index))
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert listing(tmp_path) == sorted(f'{i}.txt' for i in range(writers))
+    assert all((tmp_path / f'{i}.txt').read_text() == str(i) for i in range(writers))
+    stats = store.stats()
+    assert stats['commits'] == writers
+    assert 1 <= stats['batches'] <= writers + 1
+
+
+@pytest.mark.parametrize('mode', MODES)
+def test_failed_write_keeps_old_file_and_removes_temp(tmp_path, monkeypatch, mode):
+    dest = tmp_path / 'a.txt'
+    dest.write_text('old')
+
+    def broken(*args):
+        raise OSError("disk on fire")
+    monkeypatch.setattr(durability, '_flush', broken)
+    monkeypatch.setattr(durability, '_fsync', broken)
+    if mode == 'none':
+        monkeypatch.setattr(os, 'replace', broken)
+
+    with pytest.raises(OSError, match="disk on fire"):
+        Durability(mode).write(str(dest), 'new')
+    assert dest.read_text() == 'old'
+    assert listing(tmp_path) == ['a.txt']
+
+
+def test_group_sync_returns_once_flushed(tmp_path):
+    store = Durability('group')
+    with open(tmp_path / 'log', 'ab') as f:
+        f.write(b'entry\n')
+        f.flush()
+        store.sync(f.fileno())
+    assert store.stats()['commits'] == 1
@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+from event_bus import EventBus
+
+
+class Socket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+
+def deliver(publish):
+    async def scenario():
+        bus = EventBus()
+        socket = Socket()
+        bus.subscribe(socket)
+        publish(bus)
+        await asyncio.sleep(0.01)
+        return socket.sent
+
+    return asyncio.run(scenario())
+
+
+def test_requests_on_the_same_file_are_all_delivered():
+    sent = deliver(lambda bus: [
+        bus.publish("request_submitted", id=1, filename="same.txt"),
+        bus.publish("request_submitted", id=2, filename="same.txt"),
+    ])
+    assert [event['id'] for event in sent] == [1, 2]
+
+
+def test_pending_events_about_one_file_are_coalesced():
+    sent = deliver(lambda bus: [
+        bus.publish("file_edited", filename="a.txt", user="u"),
+        bus.publish("file_edited", filename="b.txt", user="u"),
+        bus.publish("file_deleted", filename="a.txt", user="u"),
+    ])
+    assert [(event['event'], event['filename']) for event in sent] == [
+        ("file_deleted", "a.txt"), ("file_edited", "b.txt")]
@@ -0,0 +1,66 @@
+import os
+
+from content_cache import ContentCache
+from file_catalog import FileCatalog
+from file_store import PlainStore
+
+
+def make_catalog(tmp_path):
+    store = PlainStore(str(tmp_path))
+    return store, FileCatalog(store, watch=False)
+
+
+def rewrite_keeping_stat(path, content):
+    """Replace a file's content without changing its size or mtime, as on a coarse-timestamp filesystem."""
+    st = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(content)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def test_written_refresh_drops_hash_and_bumps_version(tmp_path):
+    store, catalog = make_catalog(tmp_path)
+    store.write_text('a.txt', 'aaaa')
+    catalog.refresh('a.txt', written=True)
+    old_hash = catalog.sha256('a.txt')
+    old_info = catalog.info('a.txt')
+    old_etag, old_tag = catalog.etag, catalog.entry_tag('a.txt')
+
+    rewrite_keeping_stat(tmp_path / 'a.txt', b'bbbb')
+    catalog.refresh('a.txt', written=True)
+    assert catalog.sha256('a.txt') != old_hash
+    assert catalog.info('a.txt').version != old_info.version
+    assert catalog.etag != old_etag
+    assert catalog.entry_tag('a.txt') != old_tag
+
+
+def test_unchanged_refresh_keeps_version(tmp_path):
+    store, catalog = make_catalog(tmp_path)
+    store.write_text('a.txt', 'aaaa')
+    catalog.refresh('a.txt', written=True)
+    etag = catalog.etag
+    catalog.refresh('a.txt')  # e.g. an inotify event for a change already recorded
+    assert catalog.etag == etag
+
+
+def test_content_cache_misses_after_same_stat_write(tmp_path):
+    store, catalog = make_catalog(tmp_path)
+    cache = ContentCache()
+    store.write_text('a.txt', 'aaaa')
+    catalog.refresh('a.txt', written=True)
+    cache.put('a.txt', catalog.info('a.txt').version, 'aaaa', catalog.sha256('a.txt'))
+    assert cache.get('a.txt', catalog.info('a.txt').version).content == 'aaaa'
+
+    rewrite_keeping_stat(tmp_path / 'a.txt', b'bbbb')
+    catalog.refresh('a.txt', written=True)
+    assert cache.get('a.txt', catalog.info('a.txt').version) is None
+
+
+def test_rescan_tracks_files_added_and_removed_behind_its_back(tmp_path):
+    store, catalog = make_catalog(tmp_path)
+    (tmp_path / 'x.txt').write_text('x')
+    catalog.rescan()
+    assert catalog.names() == ['x.txt']
+    os.remove(tmp_path / 'x.txt')
+    catalog.rescan()
+    assert catalog.names() == []
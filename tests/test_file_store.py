@@ -0,0 +1,79 @@
+import os
+import random
+from functools import partial
+
+import pytest
+
+import file_store
+from file_store import CHUNK_MAX, split_chunks
+
+
+def cut_points(find_cut, size):
+    cuts = []
+    pos = 0
+    while pos < size:
+        pos = find_cut(pos, size)
+        cuts.append(pos)
+    return cuts
+
+
+@pytest.mark.parametrize('data', [
+    os.urandom(300_000),
+    bytes(100_000),
+    b'lorem ipsum dolor sit amet ' * 10_000,
+    bytes(random.Random(1).choice(b'ab\n') for _ in range(100_000)),
+], ids=['random', 'zeros', 'text', 'low-entropy'])
+@pytest.mark.parametrize('block', [file_store.SCAN_BLOCK, 4096, 40])
+def test_vectorised_cuts_match_rolling_hash(data, block):
+    pytest.importorskip('numpy')
+    expected = cut_points(partial(file_store._find_cut, data), len(data))
+    assert cut_points(file_store._GearScanner(data, block).find_cut, len(data)) == expected
+
+
+def test_large_files_get_fixed_chunks_without_numpy(monkeypatch):
+    monkeypatch.setattr(file_store, 'numpy', None)
+    monkeypatch.setattr(file_store, 'CHUNK_SCAN_LIMIT', 64 * 1024)
+    data = bytearray(os.urandom(10 * CHUNK_MAX + 100))
+    chunks = split_chunks(data)
+    assert [end - start for _, start, end in chunks] == [CHUNK_MAX] * 10 + [100]
+
+    # An edit in place still reuses every chunk it does not touch
+    previous = [(digest, end - start) for digest, start, end in chunks]
+    data[5 * CHUNK_MAX + 10] ^= 0xFF
+    edited = split_chunks(data, previous)
+    changed = [i for i, (old, new) in enumerate(zip(chunks, edited)) if old[0] != new[0]]
+    assert changed == [5]
+    assert len(edited) == len(chunks)
+
+
+@pytest.mark.parametrize('kind', ['chunked', 'compressed'])
+def test_plain_files_are_only_imported_on_request(tmp_path, kind, capsys):
+    (tmp_path / 'a.txt').write_text('alpha' * 500)
+    (tmp_path / 'b.txt').write_text('beta')
+
+    store = file_store.open_store(str(tmp_path), kind)
+    assert 'python file_store.py import' in capsys.readouterr().out
+    assert sorted(os.listdir(tmp_path)) == sorted(['a.txt', 'b.txt', f'.{kind}' if kind == 'compressed' else '.chunks'])
+    assert not store.exists('a.txt')
+
+    assert file_store.import_plain_files(store) == ['a.txt', 'b.txt']
+    assert store.read_text('a.txt') == 'alpha' * 500
+    assert (tmp_path / 'a.txt').exists()  # Originals kept by default
+    assert file_store.plain_files(store) == []
+
+    (tmp_path / 'c.txt').write_text('gamma')
+    assert file_store.import_plain_files(store, remove=True) == ['c.txt']
+    assert store.read_text('c.txt') == 'gamma'
+    assert [name for name in os.listdir(tmp_path) if not name.startswith('.')] == []
+
+
+def test_remove_keeps_originals_that_differ_from_the_stored_copy(tmp_path):
+    (tmp_path / 'a.txt').write_text('one')
+    (tmp_path / 'b.txt').write_text('two')
+    store = file_store.CompressedStore(str(tmp_path))
+    file_store.import_plain_files(store)
+    store.write_text('b.txt', 'edited since')
+
+    assert file_store.import_plain_files(store, remove=True) == []
+    assert not (tmp_path / 'a.txt').exists()
+    assert (tmp_path / 'b.txt').read_text() == 'two'
@@ -0,0 +1,49 @@
+import pytest
+
+from file_stream import ReleasingFile, decode_text_chunks, iter_file_range, resolve_range
+
+
+@pytest.mark.parametrize('size, offset, length, expected', [
+    (100, 0, None, (0, 100)),
+    (100, 10, 20, (10, 30)),
+    (100, 90, 50, (90, 100)),
+    (0, 0, None, (0, 0)),
+    (0, 0, 10, (0, 0)),
+])
+def test_resolve_range(size, offset, length, expected):
+    assert resolve_range(size, offset, length) == expected
+
+
+@pytest.mark.parametrize('size, offset, length', [
+    (100, 100, None),
+    (100, -1, None),
+    (100, 0, 0),
+    (0, 1, None),
+])
+def test_resolve_range_rejects_ranges_outside_the_file(size, offset, length):
+    with pytest.raises(ValueError):
+        resolve_range(size, offset, length)
+
+
+def test_iter_file_range(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(bytes(range(256)) * 10)
+    assert b''.join(iter_file_range(str(path), 5, 1000, chunk_size=64)) == (bytes(range(256)) * 10)[5:1000]
+    assert list(iter_file_range(str(path), 10, 10)) == []
+
+
+def test_decode_text_chunks_keeps_split_characters_whole():
+    data = 'héllo wörld'.encode()
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert ''.join(decode_text_chunks(chunks)) == 'héllo wörld'
+
+
+def test_releasing_file_calls_back_once(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'content')
+    closed = []
+    f = ReleasingFile(str(path), lambda: closed.append(True))
+    assert f.read() == b'content'
+    f.close()
+    f.close()
+    assert closed == [True]
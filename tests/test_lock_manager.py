@@ -0,0 +1,112 @@
+import threading
+import time
+
+from lock_manager import LockManager
+
+
+def waiting(locks, filename, count):
+    """Block until ``count`` callers are queued on ``filename``"""
+    stripe = locks._stripe(filename)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with stripe.cond:
+            state = stripe.files.get(filename)
+            if state is not None and len(state.queue) == count:
+                return
+        time.sleep(0.001)
+    raise AssertionError(f"{count} waiters never queued on {filename}")
+
+
+def test_readers_share_and_writer_excludes():
+    locks = LockManager()
+    assert locks.acquire_read('a.txt') == (True, None)
+    assert locks.acquire_read('a.txt') == (True, None)
+    assert locks.reader_counts() == {'a.txt': 2}
+    assert locks.acquire_write('a.txt', 'alice', timeout=0) == (False, "File is currently being read by 2 users")
+
+    locks.release_read('a.txt')
+    locks.release_read('a.txt')
+    assert locks.acquire_write('a.txt', 'alice', timeout=0) == (True, None)
+    assert locks.acquire_read('a.txt', timeout=0) == (False, "File is being edited by alice")
+    assert locks.holder('a.txt') == 'alice'
+
+
+def test_release_write_only_by_owner():
+    locks = LockManager()
+    locks.acquire_write('a.txt', 'alice')
+    assert not locks.release_write('a.txt', 'bob')
+    assert locks.release_write('a.txt', 'alice')
+    assert locks.holder('a.txt') is None
+    assert not locks._stripe('a.txt').files
+
+
+def test_release_all_drops_every_lock_of_owner():
+    locks = LockManager()
+    locks.acquire_write('a.txt', 'alice')
+    locks.acquire_write('b.txt', 'alice')
+    locks.acquire_write('c.txt', 'bob')
+    assert sorted(locks.release_all('alice')) == ['a.txt', 'b.txt']
+    assert locks.write_locks() == {'c.txt': 'bob'}
+
+
+def test_queued_writer_is_not_overtaken_by_readers():
+    locks = LockManager()
+    locks.acquire_read('a.txt')
+    results = []
+    writer = threading.Thread(target=lambda: results.append(locks.acquire_write('a.txt', 'alice', timeout=5)))
+    writer.start()
+    waiting(locks, 'a.txt', 1)
+
+    # The file is only being read, but a new reader must queue behind the writer
+    assert locks.acquire_read('a.txt', timeout=0) == (False, "File is currently being read by 1 users")
+    locks.release_read('a.txt')
+    writer.join()
+    assert results == [(True, None)]
+    assert locks.holder('a.txt') == 'alice'
+
+
+def test_waiters_are_woken_in_arrival_order():
+    locks = LockManager()
+    locks.acquire_write('a.txt', 'first')
+    order = []
+
+    def writer(name):
+        assert locks.acquire_write('a.txt', name, timeout=5) == (True, None)
+        order.append(name)
+        locks.release_write('a.txt', name)
+
+    threads = []
+    for count, name in enumerate(['second', 'third', 'fourth'], 1):
+        thread = threading.Thread(target=writer, args=(name,))
+        thread.start()
+        threads.append(thread)
+        waiting(locks, 'a.txt', count)
+
+    locks.release_write('a.txt', 'first')
+    for thread in threads:
+        thread.join()
+    assert order == ['second', 'third', 'fourth']
+    assert not locks._stripe('a.txt').files
+
+
+def test_expired_lease_frees_the_file():
+    locks = LockManager()
+    locks.acquire_write('a.txt', 'alice', lease=0.05)
+    assert locks.acquire_write('a.txt', 'bob', timeout=0)[0] is False
+
+    # A waiter is let in once the lease runs out, without anyone releasing
+    assert locks.acquire_write('a.txt', 'bob', timeout=2) == (True, None)
+    assert locks.holder('a.txt') == 'bob'
+    assert not locks.release_write('a.txt', 'alice')
+
+
+def test_expiry_seen_by_queries_drops_idle_state():
+    locks = LockManager()
+    locks.acquire_write('a.txt', 'alice', lease=0.01)
+    locks.acquire_write('b.txt', 'bob', lease=0.01)
+    time.sleep(0.05)
+
+    assert locks.holder('a.txt') is None
+    assert locks.write_locks() == {}
+    assert not any(stripe.files for stripe in locks._stripes)
+    assert not locks.renew('b.txt', 'bob')
@@ -0,0 +1,140 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from request_store import RequestStore, parse_query
+from state_backend import SqliteRequestStore
+
+
+def open_store(tmp_path, **kwargs):
+    return RequestStore(str(tmp_path / 'requests.json'), str(tmp_path / 'requests.log'), **kwargs)
+
+
+def test_replays_journal_after_restart(tmp_path):
+    store = open_store(tmp_path)
+    first = store.add(username='user', status='pending')
+    store.add(username='user', status='pending')
+    store.update(first['id'], status='approved')
+    store.close()
+
+    store = open_store(tmp_path)
+    assert [record['status'] for record in store.all()] == ['approved', 'pending']
+    assert store.add(status='pending')['id'] == 3
+
+
+def test_torn_tail_is_cut_before_new_appends(tmp_path):
+    store = open_store(tmp_path)
+    store.add(status='pending')
+    store.add(status='pending')
+    store.close()
+    with open(tmp_path / 'requests.log', 'a') as f:
+        f.write('{"op":"add","request":{"id":3,"sta')  # Crash mid-append
+
+    store = open_store(tmp_path)
+    assert [record['id'] for record in store.all()] == [1, 2]
+    store.add(status='pending')
+    store.add(status='pending')
+    store.close()
+
+    store = open_store(tmp_path)
+    assert [record['id'] for record in store.all()] == [1, 2, 3, 4]
+    with open(tmp_path / 'requests.log') as f:
+        for line in f:
+            json.loads(line)
+
+
+def test_line_missing_its_newline_is_torn(tmp_path):
+    store = open_store(tmp_path)
+    store.add(status='pending')
+    store.close()
+    with open(tmp_path / 'requests.log', 'a') as f:
+        f.write(json.dumps({'op': 'add', 'request': {'id': 2, 'status': 'pending'}}))
+
+    store = open_store(tmp_path)
+    store.add(status='pending')
+    store.close()
+    assert [record['id'] for record in open_store(tmp_path).all()] == [1, 2]
+
+
+def test_compaction_folds_journal_into_snapshot(tmp_path):
+    store = open_store(tmp_path, compact_threshold=10**6)
+    for _ in range(5):
+        store.add(status='pending')
+    store.update_many([1, 2], status='approved')
+    store.compact()
+    store.add(status='pending')
+    store.close()
+
+    with open(tmp_path / 'requests.json') as f:
+        assert len(json.load(f)) == 5
+    store = open_store(tmp_path)
+    assert len(store) == 6
+    assert store.get(2)['status'] == 'approved'
+
+
+def test_update_many_claims_each_request_once(tmp_path):
+    store = open_store(tmp_path)
+    for _ in range(3):
+        store.add(status='pending')
+    claimed = store.update_many([1, 2, 3], if_status=('pending',), status='queued')
+    assert [record['id'] for record in claimed] == [1, 2, 3]
+    assert store.update_many([1, 2, 3], if_status=('pending',), status='queued') == []
+
+
+def test_requests_queued_by_a_stopped_run_go_back_to_pending(tmp_path):
+    store = open_store(tmp_path)
+    for _ in range(3):
+        store.add(status='pending')
+    store.update_many([1, 2], if_status=('pending', 'failed'), status='queued', queued_by=os.getpid())
+    store.close()
+    assert open_store(tmp_path).release_orphaned() == []  # Still this process's apply queue
+
+    with open(tmp_path / 'requests.log', 'a') as f:
+        f.write(json.dumps({'op': 'update', 'id': 2, 'changes': {'queued_by': 1}}) + '\n')
+    store = open_store(tmp_path)
+    assert [record['id'] for record in store.release_orphaned()] == [2]
+    assert store.get(2)['status'] == 'pending'
+    assert store.update_many([2], if_status=('pending', 'failed'), status='queued') != []
+
+
+def test_sqlite_releases_claims_of_dead_processes_only(tmp_path):
+    store = SqliteRequestStore(str(tmp_path / 'state.db'))
+    for _ in range(3):
+        store.add(status='pending')
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    store.update_many([1], status='queued', queued_by=exited.pid)
+    store.update_many([2], status='queued', queued_by=os.getpid())
+    store.update_many([3], status='queued')
+
+    assert [record['id'] for record in store.release_orphaned()] == [1, 3]
+    assert [store.get(i)['status'] for i in (1, 2, 3)] == ['pending', 'queued', 'pending']
+    store.close()
+
+
+def test_pages_follow_the_cursor_through_index_changes():
+    store = RequestStore(None, None)
+    for _ in range(10):
+        store.add(status='pending')
+    # Approve out of id order, so the "approved" index is filled by insertion
+    for request_id in (7, 2, 9, 4):
+        store.update(request_id, status='approved')
+
+    page, cursor = store.query({'status': 'approved'}, limit=3)
+    assert [r['id'] for r in page] == [2, 4, 7] and cursor == 7
+    page, cursor = store.query({'status': 'approved'}, cursor=cursor, limit=3)
+    assert [r['id'] for r in page] == [9] and cursor is None
+    page, _ = store.query({'status': 'pending'}, cursor=3, limit=10)
+    assert [r['id'] for r in page] == [5, 6, 8, 10]
+    page, _ = store.query(None, cursor=8, limit=10)
+    assert [r['id'] for r in page] == [9, 10]
+    assert store.matching_ids({'status': 'rejected'}) == []
+
+
+@pytest.mark.parametrize('arg', ['cursor=abc', 'limit=ten'])
+def test_parse_query_rejects_non_numeric_paging(arg):
+    with pytest.raises(ValueError, match=f"{arg.split('=')[0]} must be an integer"):
+        parse_query([arg])
@@ -0,0 +1,131 @@
+import math
+
+import pytest
+
+from durability import Durability
+from file_catalog import FileCatalog
+from file_store import PlainStore
+from search_index import BM25_B, BM25_K1, SearchIndex, parse_page, parse_search
+
+
+def open_index(tmp_path):
+    store = PlainStore(str(tmp_path / 'files'), Durability('none'))
+    catalog = FileCatalog(store, watch=False)
+    return SearchIndex(catalog, path=str(tmp_path / 'index.json'), save_interval=3600)
+
+
+def write(index, name, content):
+    index.catalog.store.write_text(name, content)
+    index.catalog.refresh(name, written=True)
+    index.changed(name)
+
+
+def names(results):
+    return [result['filename'] for result in results[0]]
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'files').mkdir()
+    return tmp_path
+
+
+def test_bm25_ranks_by_frequency_and_length(files):
+    index = open_index(files)
+    write(index, 'often.txt', 'apple apple banana')
+    write(index, 'once.txt', 'apple banana')
+    write(index, 'long.txt', 'apple banana cherry cherry cherry cherry')
+    write(index, 'none.txt', 'cherry')
+
+    results = index.search('apple')
+    assert names(results) == ['often.txt', 'once.txt', 'long.txt']
+    assert results[2] == 3
+
+    # The score is BM25 over the four documents
+    average = (3 + 2 + 6 + 1) / 4
+    idf = math.log(1 + (4 - 3 + 0.5) / (3 + 0.5))
+    expected = idf * 2 * (BM25_K1 + 1) / (2 + BM25_K1 * (1 - BM25_B + BM25_B * 3 / average))
+    assert results[0][0] == {"filename": "often.txt", "score": round(expected, 4), "hits": 2}
+
+
+def test_every_clause_must_match(files):
+    index = open_index(files)
+    write(index, 'a.txt', 'red green blue')
+    write(index, 'b.txt', 'green red')
+    assert names(index.search('red blue')) == ['a.txt']
+    assert names(index.search('"green red"')) == ['b.txt']
+    assert names(index.search('red name:b')) == ['b.txt']
+    assert index.search('purple') == ([], None, 0)
+
+
+def test_pages_follow_the_cursor(files):
+    index = open_index(files)
+    for i in range(5):
+        write(index, f'{i}.txt', 'word')
+    first = index.search('word', **parse_page(['limit=2']))
+    assert names(first) == ['0.txt', '1.txt'] and first[1] == 2
+    last = index.search('word', **parse_page(['cursor=4', 'limit=2']))
+    assert names(last) == ['4.txt'] and last[1] is None
+
+
+def test_edit_and_delete_reindex_only_that_file(files):
+    index = open_index(files)
+    write(index, 'a.txt', 'apple')
+    write(index, 'b.txt', 'banana')
+    index.search('apple')
+    indexed = index.indexed
+
+    write(index, 'a.txt', 'cherry')
+    assert index.search('apple')[2] == 0
+    assert names(index.search('cherry')) == ['a.txt']
+    assert index.indexed == indexed + 1
+
+    index.catalog.store.delete('b.txt')
+    index.catalog.refresh('b.txt')
+    index.changed('b.txt')
+    assert index.search('banana')[2] == 0
+    assert index.stats()['files'] == 1
+
+
+def test_change_made_elsewhere_is_picked_up_from_the_catalog(files):
+    index = open_index(files)
+    write(index, 'a.txt', 'apple')
+    index.search('apple')
+    with open(files / 'files' / 'a.txt', 'w') as f:
+        f.write('a longer banana')
+    index.catalog.rescan()
+    assert names(index.search('banana')) == ['a.txt']
+
+
+def test_saved_index_is_reloaded_without_reindexing(files):
+    index = open_index(files)
+    write(index, 'a.txt', 'apple banana')
+    write(index, 'b.txt', 'banana')
+    expected = index.search('banana')
+    index.save()
+
+    reloaded = open_index(files)
+    assert reloaded.search('banana') == expected
+    assert reloaded.indexed == 0
+
+    # A file changed while the server was down is re-read on start
+    with open(files / 'files' / 'b.txt', 'w') as f:
+        f.write('cherry only')
+    restarted = open_index(files)
+    assert names(restarted.search('cherry')) == ['b.txt']
+    assert names(restarted.search('banana')) == ['a.txt']
+    assert restarted.indexed == 1
+
+
+def test_unreadable_index_file_is_rebuilt(files):
+    (files / 'files' / 'a.txt').write_text('apple')
+    (files / 'index.json').write_text('{not json')
+    assert names(open_index(files).search('apple')) == ['a.txt']
+
+
+def test_query_and_page_errors():
+    with pytest.raises(ValueError, match="Empty search query"):
+        parse_search('  ')
+    with pytest.raises(ValueError, match="Unknown option"):
+        parse_page(['sort=name'])
+    assert parse_page(['limit=100000']) == {'offset': 0, 'limit': 200}
@@ -0,0 +1,71 @@
+import time
+
+from sessions import SessionManager, hash_password, verify_password
+
+
+def test_issued_token_validates():
+    sessions = SessionManager(b'secret')
+    token = sessions.issue('alice', 'admin')
+    assert sessions.validate(token) == ('alice', 'admin')
+    # Another process holding the same secret has nothing cached but agrees
+    assert SessionManager(b'secret').validate(token) == ('alice', 'admin')
+
+
+def test_token_signed_with_other_secret_is_refused():
+    token = SessionManager(b'other').issue('alice', 'admin')
+    assert SessionManager(b'secret').validate(token) is None
+
+
+def test_tampered_token_is_refused():
+    sessions = SessionManager(b'secret')
+    token = sessions.issue('alice', 'user')
+    payload, _, signature = token.partition('.')
+    forged = SessionManager(b'forger').issue('alice', 'admin').partition('.')[0]
+
+    fresh = SessionManager(b'secret')
+    assert fresh.validate(f"{forged}.{signature}") is None
+    assert fresh.validate(f"{payload}.{signature[:-2]}xx") is None
+    assert fresh.validate(payload) is None
+    assert fresh.validate('') is None
+    assert fresh.validate('not.a-token') is None
+
+
+def test_expired_token_is_refused(monkeypatch):
+    sessions = SessionManager(b'secret', ttl=60)
+    token = sessions.issue('alice', 'user')
+    later = time.time() + 61
+    monkeypatch.setattr(time, 'time', lambda: later)
+    # Both from the cache and when checked from scratch
+    assert sessions.validate(token) is None
+    assert SessionManager(b'secret').validate(token) is None
+
+
+def test_revoked_token_is_refused():
+    sessions = SessionManager(b'secret')
+    token = sessions.issue('alice', 'user')
+    other = sessions.issue('alice', 'user')
+    sessions.revoke(token)
+    assert sessions.validate(token) is None
+    assert sessions.validate(other) == ('alice', 'user')
+    sessions.revoke(None)
+
+
+def test_verify_password_against_pbkdf2_hash():
+    user = {'password_hash': hash_password('hunter2', iterations=1000)}
+    assert user['password_hash'].startswith('pbkdf2_sha256$1000$')
+    assert verify_password(user, 'hunter2')
+    assert not verify_password(user, 'hunter3')
+    assert not verify_password(user, None)
+    # Each hash gets its own salt
+    assert hash_password('hunter2', iterations=1000) != user['password_hash']
+
+
+def test_verify_password_rejects_malformed_hashes():
+    assert not verify_password({'password_hash': 'garbage'}, 'x')
+    assert not verify_password({'password_hash': 'md5$1$abc$def'}, 'x')
+
+
+def test_verify_password_accepts_legacy_plaintext():
+    assert verify_password({'password': 'admin123'}, 'admin123')
+    assert not verify_password({'password': 'admin123'}, 'admin124')
+    assert not verify_password({}, 'admin123')
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+import time
+
+from event_bus import EventBus
+from sessions import SessionManager
+from state_backend import SqliteEventLog, SqliteRevocationList, SqliteUsedCodes
+from two_fa import TOTPVerifier, _decode_secret, _hotp
+
+SECRET = 'JBSWY3DPEHPK3PXP'
+
+
+def test_used_code_is_refused_by_every_process(tmp_path):
+    path = str(tmp_path / 'state.db')
+    now = 1_700_000_000
+    code = _hotp(_decode_secret(SECRET), now // 30, 6)
+    first = TOTPVerifier(used_codes=SqliteUsedCodes(path))
+    second = TOTPVerifier(used_codes=SqliteUsedCodes(path))
+
+    assert first.verify('alice', SECRET, code, now=now)
+    assert not second.verify('alice', SECRET, code, now=now)
+    assert not first.verify('alice', SECRET, code, now=now)
+
+
+def test_logout_is_honoured_by_every_process(tmp_path):
+    path = str(tmp_path / 'state.db')
+    web = SessionManager(b'secret', revocations=SqliteRevocationList(path))
+    backend = SessionManager(b'secret', revocations=SqliteRevocationList(path))
+    token = web.issue('alice', 'user')
+    assert backend.validate(token) == ('alice', 'user')
+
+    web.revoke(token)
+    assert web.validate(token) is None
+    assert backend.validate(token) is None
+
+
+def add_foreign_event(log, event):
+    """Append an event as another process would"""
+    with log._db.transaction() as db:
+        db.execute('INSERT INTO events (pid, created, event) VALUES (?, ?, ?)',
+                   (os.getpid() + 1, time.time(), json.dumps(event)))
+
+
+def test_event_log_returns_only_other_processes_events(tmp_path):
+    log = SqliteEventLog(str(tmp_path / 'state.db'))
+    after = log.latest()
+    add_foreign_event(log, {"event": "file_deleted", "filename": "theirs.txt"})
+
+    received, after = log.exchange([{"event": "file_created", "filename": "mine.txt"}], after)
+    assert received == [{"event": "file_deleted", "filename": "theirs.txt"}]
+    assert log.exchange([], after) == ([], after)
+
+
+def test_event_bus_relays_through_log(tmp_path):
+    path = str(tmp_path / 'state.db')
+
+    class Socket:
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, message):
+            self.sent.append(message)
+
+    async def run(func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    async def scenario():
+        log = SqliteEventLog(path)
+        bus = EventBus(log, relay_interval=0.01)
+        socket = Socket()
+        bus.subscribe(socket, ('file',))
+        bus.start(run)
+        await asyncio.sleep(0.05)
+        add_foreign_event(log, {"event": "file_edited", "filename": "a.txt"})
+        bus.publish("file_created", filename="b.txt")
+        await asyncio.sleep(0.1)
+        return socket.sent
+
+    sent = asyncio.run(scenario())
+    assert '{"event": "file_created", "filename": "b.txt"}' in sent
+    assert '{"event": "file_edited", "filename": "a.txt"}' in sent
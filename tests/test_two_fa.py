@@ -0,0 +1,81 @@
+import pytest
+
+from two_fa import TOTPVerifier, UsedCodes, _decode_secret, _hotp
+
+# RFC 6238 appendix B, SHA-1: the ASCII secret "12345678901234567890"
+RFC_SECRET = 'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ'
+RFC_VECTORS = [
+    (59, '94287082'),
+    (1111111109, '07081804'),
+    (1111111111, '14050471'),
+    (1234567890, '89005924'),
+    (2000000000, '69279037'),
+    (20000000000, '65353130'),
+]
+SECRET = 'JBSWY3DPEHPK3PXP'
+NOW = 1_700_000_000
+
+
+def code_at(now, secret=SECRET):
+    return _hotp(_decode_secret(secret), int(now // 30), 6)
+
+
+@pytest.mark.parametrize('now, expected', RFC_VECTORS)
+def test_rfc6238_vectors(now, expected):
+    assert _hotp(_decode_secret(RFC_SECRET), now // 30, 8) == expected
+    verifier = TOTPVerifier(digits=8, window=0)
+    assert verifier.verify('rfc', RFC_SECRET, expected, now=now)
+
+
+def test_matches_pyotp():
+    pyotp = pytest.importorskip('pyotp')
+    for now in (0, 59, NOW, NOW + 29, NOW + 30):
+        assert code_at(now) == pyotp.TOTP(SECRET).at(now)
+
+
+def test_replayed_code_is_rejected():
+    verifier = TOTPVerifier()
+    code = code_at(NOW)
+    assert verifier.verify('alice', SECRET, code, now=NOW)
+    assert not verifier.verify('alice', SECRET, code, now=NOW + 1)
+    # Still refused from the next step, where it is accepted as clock drift
+    assert not verifier.verify('alice', SECRET, code, now=NOW + 30)
+    # The same code for another user is a different claim
+    assert verifier.verify('bob', SECRET, code, now=NOW)
+
+
+def test_previous_and_next_window_are_accepted():
+    verifier = TOTPVerifier()
+    assert verifier.verify('alice', SECRET, code_at(NOW - 30), now=NOW)
+    assert verifier.verify('alice', SECRET, code_at(NOW + 30), now=NOW)
+    assert not verifier.verify('alice', SECRET, code_at(NOW - 60), now=NOW)
+    assert not verifier.verify('alice', SECRET, code_at(NOW + 60), now=NOW)
+
+
+def test_malformed_input_is_rejected():
+    verifier = TOTPVerifier()
+    assert not verifier.verify('alice', SECRET, '', now=NOW)
+    assert not verifier.verify('alice', SECRET, None, now=NOW)
+    assert not verifier.verify('alice', SECRET, '12345', now=NOW)
+    assert not verifier.verify('alice', 'not base32!', '123456', now=NOW)
+    code = code_at(NOW)
+    assert verifier.verify('alice', SECRET, f" {code[:3]} {code[3:]} ", now=NOW)
+
+
+def test_verify_batch():
+    verifier = TOTPVerifier()
+    code = code_at(NOW)
+    attempts = [('alice', SECRET, code), ('alice', SECRET, code), ('bob', SECRET, '000000')]
+    expected = [True, False, code == '000000']
+    assert verifier.verify_batch(attempts, now=NOW) == expected
+
+
+def test_used_codes_forget_expired_entries():
+    used = UsedCodes(limit=2)
+    assert used.claim('alice', 1, expires=10, now=0)
+    assert not used.claim('alice', 1, expires=10, now=5)
+    assert used.claim('alice', 1, expires=20, now=10)
+    # Over the limit the oldest claim is dropped first
+    assert used.claim('bob', 1, expires=30, now=10)
+    assert used.claim('carol', 1, expires=30, now=10)
+    assert used.claim('alice', 1, expires=30, now=10)
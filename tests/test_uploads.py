@@ -0,0 +1,29 @@
+import hashlib
+import io
+import os
+import stat
+
+from durability import Durability
+from uploads import receive_stream
+
+
+def test_committed_upload_has_the_same_mode_as_written_files(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        upload = receive_stream(io.BytesIO(b'uploaded'), str(tmp_path), chunk_size=3)
+        upload.commit(str(tmp_path / 'up.txt'), Durability('fsync'))
+        Durability('fsync').write(str(tmp_path / 'written.txt'), b'written')
+    finally:
+        os.umask(umask)
+
+    assert (tmp_path / 'up.txt').read_bytes() == b'uploaded'
+    assert upload.sha256 == hashlib.sha256(b'uploaded').hexdigest() and upload.size == 8
+    assert stat.S_IMODE(os.stat(tmp_path / 'up.txt').st_mode) == 0o644
+    assert stat.S_IMODE(os.stat(tmp_path / 'written.txt').st_mode) == 0o644
+    assert sorted(os.listdir(tmp_path)) == ['up.txt', 'written.txt']
+
+
+def test_aborted_upload_leaves_nothing_behind(tmp_path):
+    upload = receive_stream(io.BytesIO(b'partial'), str(tmp_path))
+    upload.abort()
+    assert os.listdir(tmp_path) == []
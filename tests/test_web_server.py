@@ -0,0 +1,203 @@
+import importlib
+import os
+import shutil
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    # The server keeps its files, users and state relative to the working directory
+    workdir = tmp_path_factory.mktemp('web')
+    shutil.copy(os.path.join(REPO, 'users.json'), workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        web_server = importlib.import_module('web_server')
+        client = web_server.app.test_client()
+        token = client.post('/auth', json={'username': 'admin', 'password': 'admin123'}).get_json()['token']
+        client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        yield web_server, client
+    finally:
+        os.chdir(cwd)
+
+
+def command(client, text):
+    return client.post('/command', json={'command': text}).get_json()
+
+
+def test_range_request_returns_partial_content(server):
+    web_server, client = server
+    assert command(client, 'CREATE::range.txt::0123456789')['status'] == 'success'
+
+    response = client.get('/files/range.txt', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    response.close()
+
+    response = client.get('/files/range.txt?offset=8')
+    assert response.status_code == 206
+    assert response.data == b'89'
+    response.close()
+    assert web_server.locks.reader_counts() == {}
+
+
+def test_etag_changes_on_same_size_rewrite(server):
+    web_server, client = server
+    command(client, 'CREATE::etag.txt::aaaa')
+    response = client.get('/files/etag.txt')
+    etag = response.headers['ETag']
+    response.close()
+
+    response = client.get('/files/etag.txt', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response.close()
+
+    # Same size and, as on a filesystem with coarse timestamps, the same mtime
+    path = web_server.store.path('etag.txt')
+    before = os.stat(path)
+    command(client, 'EDIT::etag.txt::bbbb')
+    os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+    response = client.get('/files/etag.txt', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == b'bbbb'
+    assert response.headers['ETag'] != etag
+    response.close()
+    assert web_server.locks.reader_counts() == {}
+
+
+def test_empty_file_reads_as_empty(server):
+    web_server, client = server
+    web_server.store.write_text('empty.txt', '')
+    web_server.file_changed('empty.txt')
+
+    response = client.get('/files/empty.txt?offset=0')
+    assert response.status_code == 200
+    assert response.data == b''
+    response.close()
+
+    response = client.get('/files/empty.txt?offset=1')
+    assert response.status_code == 416
+    response.close()
+    assert web_server.locks.reader_counts() == {}
+
+
+def test_atomic_batch_rolls_back_earlier_writes(server):
+    web_server, client = server
+    command(client, 'CREATE::kept.txt::original')
+    response = client.post('/batch', json={'atomic': True, 'commands': [
+        'EDIT::kept.txt::changed',
+        'CREATE::added.txt::new',
+        'EDIT::missing.txt::fails',
+        'CREATE::never.txt::x',
+    ]})
+    result = response.get_json()
+    assert result['status'] == 'error'
+    assert result['message'].startswith('Command 2 failed, batch rolled back')
+
+    assert web_server.store.read_text('kept.txt') == 'original'
+    assert not web_server.store.exists('added.txt')
+    assert not web_server.store.exists('never.txt')
+    assert not web_server.locks.write_locks()
+    assert web_server.locks.reader_counts() == {}
+
+
+def test_plain_batch_runs_every_command(server):
+    web_server, client = server
+    response = client.post('/batch', json={'commands': [
+        'CREATE::batch.txt::one',
+        'EDIT::nothere.txt::x',
+        'READ::batch.txt',
+    ]})
+    results = response.get_json()['results']
+    assert [r['status'] for r in results] == ['success', 'error', 'success']
+    assert results[2]['content'] == 'one'
+
+
+def test_request_of_unknown_type_is_refused(server):
+    web_server, admin = server
+    client = web_server.app.test_client()
+    token = client.post('/auth', json={'username': 'user', 'password': 'user123'}).get_json()['token']
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+
+    result = command(client, 'MAKE_REQUEST::FOO::x.txt::y')
+    assert result == {'status': 'error', 'message': 'action must be one of CREATE, EDIT, DELETE'}
+    assert command(client, 'MAKE_REQUEST::CREATE::x.txt::y')['status'] == 'success'
+
+    # One stored before types were checked fails with a useful error when approved
+    stored = web_server.request_store.add(username='user', type='FOO', filename='x.txt', content='y',
+                                          status='pending', timestamp='2026-01-01 00:00:00')
+    result = command(admin, f"HANDLE_REQUEST::{stored['id']}::approve")
+    assert result['message'] == f"Request #{stored['id']} failed: Unknown request type 'FOO'"
+
+
+def test_logout_revokes_the_token(server):
+    web_server, _ = server
+    client = web_server.app.test_client()
+    token = client.post('/auth', json={'username': 'user', 'password': 'user123'}).get_json()['token']
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    assert command(client, 'LIST')['status'] == 'success'
+
+    assert client.post('/logout').get_json()['status'] == 'success'
+    result = command(client, 'LIST')
+    assert result['status'] == 'error'
+    assert web_server.sessions.validate(token) is None
+
+
+def test_read_through_cache_sees_edits_and_answers_unchanged(server):
+    web_server, client = server
+    command(client, 'CREATE::cached.txt::first')
+    result = command(client, 'READ::cached.txt')
+    assert result['content'] == 'first'
+    etag = result['etag']
+    hits = web_server.content_cache.hits
+    assert command(client, 'READ::cached.txt') == result
+    assert web_server.content_cache.hits == hits + 1
+
+    response = client.post('/command', json={'command': f'READ::cached.txt::{etag}'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == f'"{etag}"'
+    response = client.post('/command', json={'command': 'READ::cached.txt'}, headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+
+    # The edit drops the cached copy, so the next read has new content and ETag
+    command(client, 'EDIT::cached.txt::second')
+    result = command(client, f'READ::cached.txt::{etag}')
+    assert result['content'] == 'second'
+    assert result['etag'] != etag
+    assert web_server.locks.reader_counts() == {}
+
+
+def test_metrics_need_an_admin_and_carry_no_file_names(server, monkeypatch):
+    web_server, admin = server
+    command(admin, 'CREATE::secret-plans.txt::x')
+    command(admin, 'READ::secret-plans.txt')
+
+    anonymous = web_server.app.test_client()
+    assert anonymous.get('/metrics').status_code == 401
+    user = web_server.app.test_client()
+    token = user.post('/auth', json={'username': 'user', 'password': 'user123'}).get_json()['token']
+    assert user.get('/metrics', headers={'Authorization': f'Bearer {token}'}).status_code == 403
+
+    response = admin.get('/metrics')
+    assert response.status_code == 200
+    assert b'fms_command_duration_seconds_count{command="READ"}' in response.data
+    assert b'secret-plans' not in response.data
+    assert b'admin' not in response.data
+
+    monkeypatch.setattr('metrics.METRICS_TOKEN', 'scrape-me')
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer scrape-me'}).status_code == 200
+    assert anonymous.get('/metrics', headers={'Authorization': 'Bearer scrape-you'}).status_code == 401
+
+
+def test_non_numeric_offset_is_refused(server):
+    web_server, client = server
+    command(client, 'CREATE::offsets.txt::0123456789')
+    for query in ('offset=abc', 'offset=2&length=x', 'length=1.5'):
+        response = client.get(f'/files/offsets.txt?{query}')
+        assert response.status_code == 400
+        assert response.get_json()['message'] == 'offset and length must be integers'
+    assert web_server.locks.reader_counts() == {}
@@ -1,11 +1,125 @@
-import pyotp
-import qrcode
+import base64
 import hashlib
-from getpass import getpass
+import hmac
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+TOTP_INTERVAL = 30  # Seconds per time step
+TOTP_DIGITS = 6
+VALID_WINDOW = 1  # Time steps of clock drift accepted either side of now
+USED_CODES_LIMIT = 100000  # Used codes remembered for replay protection
+
 
 def generate_2fa_secret() -> str:
+    import pyotp  # Enrollment only; kept off the login path
     return pyotp.random_base32()
 
-def verify_otp(secret: str, otp_input: str) -> bool:
-    totp = pyotp.TOTP(secret)
-    return totp.verify(otp_input)
+
+def provisioning_qr(username: str, secret: str, issuer: str = "File Management System"):
+    """QR code image of the otpauth:// URI for enrolling an authenticator app."""
+    import pyotp
+    import qrcode
+    return qrcode.make(pyotp.TOTP(secret).provisioning_uri(name=username, issuer_name=issuer))
+
+
+def _decode_secret(secret: str) -> bytes:
+    secret = secret.replace(' ', '').upper()
+    return base64.b32decode(secret + '=' * (-len(secret) % 8))
+
+
+def _hotp(key: bytes, counter: int, digits: int) -> str:
+    digest = hmac.new(key, struct.pack('>Q', counter), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    code = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(code % 10 ** digits).zfill(digits)
+
+
+class UsedCodes:
+    """TOTP codes already accepted, as ``(user, time step)``, kept until they expire."""
+
+    def __init__(self, limit: int = USED_CODES_LIMIT):
+        self.limit = limit
+        self._used = OrderedDict()  # (user, step) -> time after which it can be forgotten
+        self._lock = threading.Lock()
+
+    def claim(self, user: str, step: int, expires: float, now: float) -> bool:
+        """Mark a code as used until ``expires``; False if it already was."""
+        with self._lock:
+            while self._used:
+                entry, entry_expires = next(iter(self._used.items()))
+                if entry_expires > now and len(self._used) < self.limit:
+                    break
+                del self._used[entry]
+            if (user, step) in self._used:
+                return False
+            self._used[(user, step)] = expires
+            return True
+
+
+class TOTPVerifier:
+    """Verifies TOTP codes (RFC 6238) with per-user caching and replay protection.
+
+    Each user's decoded secret is cached, and the codes accepted for the
+    current time step (plus ``window`` steps either side) are computed once
+    per step, so checking a code is a dict lookup. A code that has been
+    accepted once is rejected for as long as it could still be valid; pass
+    a shared ``used_codes`` (see state_backend.py) so that holds across processes.
+    """
+
+    def __init__(self, interval: int = TOTP_INTERVAL, digits: int = TOTP_DIGITS,
+                 window: int = VALID_WINDOW, used_codes=None):
+        self.interval = interval
+        self.digits = digits
+        self.window = window
+        self.used_codes = used_codes if used_codes is not None else UsedCodes()
+        self._keys = {}  # user -> (secret, decoded key)
+        self._codes = {}  # user -> (time step, {code: step it belongs to})
+        self._lock = threading.Lock()
+
+    def _valid_codes(self, user: str, secret: str, step: int) -> dict:
+        cached = self._keys.get(user)
+        if cached is None or cached[0] != secret:
+            cached = self._keys[user] = (secret, _decode_secret(secret))
+            self._codes.pop(user, None)
+        codes = self._codes.get(user)
+        if codes is None or codes[0] != step:
+            key = cached[1]
+            codes = self._codes[user] = (step, {
+                _hotp(key, s, self.digits): s
+                for s in range(step - self.window, step + self.window + 1)
+            })
+        return codes[1]
+
+    def _verify(self, user: str, secret: str, code: str, now: float) -> bool:
+        code = (code or '').strip().replace(' ', '')
+        if len(code) != self.digits:
+            return False
+        step = int(now // self.interval)
+        try:
+            matched_step = self._valid_codes(user, secret, step).get(code)
+        except (ValueError, TypeError):
+            return False  # Malformed secret
+        if matched_step is None:
+            return False
+        # Remember the code until it drops out of every acceptance window
+        return self.used_codes.claim(user, matched_step, (matched_step + self.window + 1) * self.interval, now)
+
+    def verify(self, user: str, secret: str, code: str, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._verify(user, secret, code, now)
+
+    def verify_batch(self, attempts, now: float = None) -> list:
+        """Verify many ``(user, secret, code)`` attempts against one clock reading."""
+        now = time.time() if now is None else now
+        with self._lock:
+            return [self._verify(user, secret, code, now) for user, secret, code in attempts]
+
+
+_default_verifier = TOTPVerifier()
+
+
+def verify_otp(secret: str, otp_input: str, user: str = None) -> bool:
+    return _default_verifier.verify(user or secret, secret, otp_input)
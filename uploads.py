@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+from durability import open_temp
+
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Bytes read from the client per iteration
+
+
+class Upload:
+    """File content being received into a temporary file in the destination directory.
+
+    Chunks are hashed and counted as they arrive, so the whole content is never
+    held in memory. ``commit`` renames the temporary file over the destination,
+    which is atomic because both live in the same directory, after making it
+    durable as ``durability`` (see durability.py) requires.
+    """
+
+    def __init__(self, directory):
+        # Created like every other written file (0666 less the umask), not mkstemp's
+        # 0600, since the rename makes it the stored file itself
+        self._file, self.tmp_path = open_temp(directory)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        """Finish writing; the content stays in ``tmp_path`` until commit or abort."""
+        self._file.close()
+
+    def commit(self, dest_path, durability=None):
+        if durability is None:
+            self.close()
+            os.replace(self.tmp_path, dest_path)
+            return
+        self._file.flush()
+        durability.replace(self.tmp_path, dest_path, self._file.fileno())
+        self.close()
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def receive_stream(stream, directory, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Copy a readable binary stream into a new Upload in ``directory``."""
+    upload = Upload(directory)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            upload.write(chunk)
+    except Exception:
+        upload.abort()
+        raise
+    return upload
@@ -1,9 +1,28 @@
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Flask, send_from_directory, send_file, request, jsonify, Response
 import json
+import mimetypes
+import gzip
 import os
-from threading import Lock, RLock
-from collections import defaultdict
-from two_fa import verify_otp
+import threading
+import time
+import zlib
+from urllib.parse import quote
+from two_fa import TOTPVerifier
+from datetime import datetime
+from request_store import parse_query, parse_selection
+from apply_queue import ApplyQueue
+from file_stream import READ_INLINE_LIMIT, ReleasingFile, resolve_range
+from file_store import open_store
+from durability import Durability
+from uploads import receive_stream
+from state_backend import open_lock_manager, open_request_store, open_used_codes, open_revocations, open_event_log
+from file_catalog import FileCatalog
+from content_cache import ContentCache
+from search_index import SearchIndex, parse_page
+from admission import AdmissionController, Overloaded, command_class, is_heavy
+from sessions import SessionManager, load_secret, verify_password
+from metrics import ServerMetrics, CONTENT_TYPE, scrape_allowed
+from commands import Dispatcher, FRAME_MIMETYPE
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
@@ -11,45 +30,167 @@ app = Flask(__name__, static_folder='static', template_folder='templates')
 with open('users.json', 'r') as f:
     USERS = json.load(f)
 
+# Signed session tokens, shared with backend.py through the same secret; with
+# STATE_BACKEND=sqlite logouts and used 2FA codes are shared by every process too
+sessions = SessionManager(load_secret(), revocations=open_revocations())
+otp_verifier = TOTPVerifier(used_codes=open_used_codes())
+
+# File and lock changes made here reach backend.py's SUBSCRIBEd sessions through STATE_DB
+event_log = open_event_log()
+
 # Ensure files directory exists
 FILES_DIR = 'files'
 if not os.path.exists(FILES_DIR):
     os.makedirs(FILES_DIR)
 
-# File locking mechanism
-file_locks = {}  # Dictionary to store file locks
-readers_count = defaultdict(int)  # Count of readers per file
-lock_manager = RLock()  # Global lock for managing reader/writer access
+# How far writes are pushed to disk before they are acknowledged (DURABILITY, see durability.py)
+durability = Durability()
+
+# Plain files, content-addressed chunks with FILE_STORAGE=chunked, or per-file
+# compression with FILE_STORAGE=compressed (file_store.py)
+store = open_store(FILES_DIR, durability=durability)
+COMPRESS_RESPONSE_BYTES = 1024  # JSON and text replies at least this large are gzipped for clients that accept it
+
+# Directory index kept current from our own writes and inotify, so LIST does no syscalls
+catalog = FileCatalog(store)
+
+# Contents of recently read small files, checked against the catalog before use
+content_cache = ContentCache()
+
+# Full-text index behind SEARCH, saved to search_index.json
+search_index = SearchIndex(catalog, durability=durability)
+
+# Per-user rate limits and a prioritised cap on commands running at once
+admission = AdmissionController()
+BATCH_HEAVY = 100  # Commands that make a batch count as heavy
+
+# User requests: in-memory index backed by requests.json plus an append-only journal
+request_store = open_request_store(durability=durability)
+# Approvals a stopped process had queued but not applied can be handled again
+for _req in request_store.release_orphaned():
+    print(f"[REQUESTS] Request #{_req['id']} was queued by a stopped process, back to pending")
+OPEN_REQUEST_STATUSES = ('pending', 'failed')  # Requests that may still be approved or rejected
+BULK_REQUEST_LIMIT = int(os.environ.get('BULK_REQUEST_LIMIT', 10000))  # Requests per HANDLE_REQUESTS
+
+# Approved requests are applied by background workers, in order per file
+apply_queue = ApplyQueue()
+
+# Command latency, bytes and lock timings, scraped from /metrics
+metrics = ServerMetrics()
+
+# File locking mechanism: per-file reader/writer locks with queueing and write leases
+locks = open_lock_manager(observer=metrics)
+metrics.registry.gauge('fms_write_locks_held', 'Files currently write-locked',
+                       func=lambda: len(locks.write_locks()))
+metrics.registry.gauge('fms_file_readers', 'Active file readers',
+                       func=lambda: sum(locks.reader_counts().values()))
+metrics.registry.gauge('fms_content_cache_bytes', 'Memory held by cached file contents',
+                       func=lambda: content_cache.bytes)
+metrics.registry.gauge('fms_admission_in_flight', 'Admitted commands running', ('kind',),
+                       func=lambda: {'all': admission.in_flight, 'heavy': admission.heavy})
+metrics.registry.gauge('fms_admission_queued', 'Commands waiting for admission', func=lambda: admission.queued)
+metrics.registry.counter('fms_admission_rejected_total', 'Commands turned away by admission control', ('reason',),
+                         func=lambda: {'rate_limited': admission.rate_limited, 'overloaded': admission.rejected})
+metrics.registry.counter('fms_content_cache_lookups_total', 'Content cache lookups', ('result',),
+                         func=lambda: {'hit': content_cache.hits, 'miss': content_cache.misses})
+
+# Files whose locks (write, or read for files it only reads) an atomic batch running
+# on this thread already holds; the commands inside the batch treat those locks as theirs
+batch_locks = threading.local()
+
+def held_by_batch(filename):
+    return filename in getattr(batch_locks, 'files', ())
+
+def publish(event_type, **fields):
+    """Pass a change event on to backend.py's subscribers, when they share STATE_DB"""
+    if event_log is None:
+        return
+    try:
+        event_log.append([{"event": event_type, **fields}])
+    except Exception as e:
+        print(f"[EVENTS] Could not share {event_type}: {e}")
+
+def file_changed(filename, sha256=None, event='file_edited', user=None):
+    """Record a write to filename: drop any cached copy, refresh its catalog entry, re-index it and publish it"""
+    content_cache.invalidate(filename)
+    catalog.refresh(filename, sha256, written=True)
+    search_index.changed(filename)
+    publish(event, filename=filename, user=user, **({'sha256': sha256} if sha256 else {}))
 
 def acquire_read_lock(filename, username):
-    with lock_manager:
-        if filename in file_locks and file_locks[filename]['type'] == 'write':
-            return False, f"File is being edited by {file_locks[filename]['user']}"
-        readers_count[filename] += 1
+    if held_by_batch(filename):
         return True, None
+    return locks.acquire_read(filename, username)
 
 def release_read_lock(filename):
-    with lock_manager:
-        if readers_count[filename] > 0:
-            readers_count[filename] -= 1
-        if readers_count[filename] == 0:
-            readers_count.pop(filename, None)
+    if not held_by_batch(filename):
+        locks.release_read(filename)
 
 def acquire_write_lock(filename, username):
-    with lock_manager:
-        if filename in file_locks:
-            return False, f"File is locked by {file_locks[filename]['user']}"
-        if readers_count.get(filename, 0) > 0:
-            return False, f"File is currently being read by {readers_count[filename]} users"
-        file_locks[filename] = {'type': 'write', 'user': username}
+    if held_by_batch(filename):
         return True, None
+    return locks.acquire_write(filename, username)
 
 def release_write_lock(filename, username):
-    with lock_manager:
-        if filename in file_locks and file_locks[filename]['user'] == username:
-            del file_locks[filename]
-            return True
-        return False
+    if held_by_batch(filename):
+        return True
+    return locks.release_write(filename, username)
+
+def request_token():
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        return auth_header[len('Bearer '):]
+    if request.args.get('token'):
+        return request.args['token']
+    if request.is_json:
+        return (request.get_json(silent=True) or {}).get('token', '')
+    return ''
+
+def current_identity():
+    """(username, role) of the session token sent with the request, or None"""
+    return sessions.validate(request_token())
+
+def not_authenticated():
+    return jsonify({"status": "error", "message": "Not authenticated"}), 401
+
+@app.errorhandler(Overloaded)
+def too_many_requests(e):
+    response = jsonify({"status": "error", **e.to_dict()})
+    response.status_code = 429
+    response.headers['Retry-After'] = e.retry_after_header
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Gzip larger JSON and text replies for clients that send Accept-Encoding: gzip.
+
+    Streamed responses (file downloads) are left alone: stored encodings are
+    negotiated in stream_file. The gzipped variant gets a weak ETag, since
+    its bytes differ from the identity one.
+    """
+    if (response.status_code != 200 or response.is_streamed or response.content_encoding
+            or not (response.mimetype == 'application/json' or response.mimetype.startswith('text/'))):
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0 or (response.content_length or 0) < COMPRESS_RESPONSE_BYTES:
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.content_encoding = 'gzip'
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics, for admins or a scraper sending METRICS_TOKEN"""
+    token = request_token()
+    identity = sessions.validate(token)
+    if not scrape_allowed(token, identity[1] if identity else None):
+        if identity is None:
+            return not_authenticated()
+        return jsonify({"status": "error", "message": "Admin access required"}), 403
+    return Response(metrics.render(), mimetype=CONTENT_TYPE)
 
 @app.route('/')
 def index():
@@ -62,255 +203,656 @@ def auth():
     password = data.get('password')
     otp = data.get('otp', '')
 
-    if username in USERS and USERS[username]["password"] == password:
-        if otp and not verify_otp(USERS[username]["2fa_secret"], otp):
+    if username in USERS and verify_password(USERS[username], password):
+        if otp and not otp_verifier.verify(username, USERS[username]["2fa_secret"], otp):
             return jsonify({
                 "status": "error",
                 "message": "Invalid OTP"
             })
+        role = USERS[username]["role"]
         return jsonify({
             "status": "success",
-            "role": USERS[username]["role"]
+            "role": role,
+            "token": sessions.issue(username, role),
+            "expires_in": sessions.ttl
         })
     return jsonify({
         "status": "error",
         "message": "Invalid credentials"
     })
 
-@app.route('/command', methods=['POST'])
-def command():
-    data = request.json
-    command = data.get('command', '')
-    username = data.get('username', '')
-    role = data.get('role', '')
+@app.route('/logout', methods=['POST'])
+def logout():
+    sessions.revoke(request_token())
+    return jsonify({"status": "success", "message": "Logged out"})
+
+@app.route('/files/<filename>', methods=['GET'])
+def stream_file(filename):
+    """Stream a file from disk, honouring HTTP Range or ?offset=&length= requests.
+
+    The read lock is held until the response has been fully sent.
+    """
+    identity = current_identity()
+    if identity is None:
+        return not_authenticated()
+    username = identity[0]
     
-    if not command:
-        return jsonify({"status": "error", "message": "No command provided"})
-        
-    parts = command.split("::")
-    action = parts[0]
+    try:
+        offset = int(request.args.get('offset', 0))
+        length = int(request.args['length']) if 'length' in request.args else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "offset and length must be integers"}), 400
+    
+    info = catalog.info(filename)
+    if info is None and not store.exists(filename):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    
+    # Admitted (and a read lock taken) until the response has been sent
+    ticket = admission.enter(username, identity[1], 'READ', heavy=info is None or info.size > READ_INLINE_LIMIT)
+    success, message = acquire_read_lock(filename, username)
+    if not success:
+        admission.leave(ticket)
+        return jsonify({"status": "error", "message": message}), 423
+    
+    released = []
+    
+    def finished():
+        # Runs once, from whichever closes first: the response or the file it sends
+        if not released:
+            released.append(True)
+            release_read_lock(filename)
+            admission.leave(ticket)
     
     try:
-        if action == "LOCK" and role == "admin":
-            if len(parts) < 2:
-                return jsonify({"status": "error", "message": "Filename required"})
-            filename = parts[1]
-            
-            success, message = acquire_write_lock(filename, username)
-            if success:
-                return jsonify({"status": "success", "message": f"File {filename} locked"})
-            return jsonify({"status": "error", "message": message})
-            
-        elif action == "UNLOCK" and role == "admin":
-            if len(parts) < 2:
-                return jsonify({"status": "error", "message": "Filename required"})
-            filename = parts[1]
-            
-            if release_write_lock(filename, username):
-                return jsonify({"status": "success", "message": f"File {filename} unlocked"})
-            return jsonify({"status": "error", "message": "You don't have the lock for this file"})
-            
-        elif action == "LIST":
-            files = [f for f in os.listdir(FILES_DIR) 
-                    if os.path.isfile(os.path.join(FILES_DIR, f))]
-            # Include lock information in response
-            lock_info = {
-                'files': files,
-                'locked_files': {
-                    filename: {
-                        'type': info['type'],
-                        'user': info['user']
-                    } for filename, info in file_locks.items()
-                },
-                'readers': {
-                    filename: count for filename, count in readers_count.items() if count > 0
-                }
-            }
-            return jsonify({"status": "success", **lock_info})
-            
-        elif action == "READ":
-            if len(parts) < 2:
-                return jsonify({"status": "error", "message": "Filename required"})
-            filename = parts[1]
-            file_path = os.path.join(FILES_DIR, filename)
-            
-            if not os.path.exists(file_path):
-                return jsonify({"status": "error", "message": "File not found"})
-            
-            # Check if file is locked
-            if filename in file_locks:
-                return jsonify({"status": "error", "message": f"File is locked by {file_locks[filename]['user']}"})
-                
-            # Try to acquire read lock
-            success, message = acquire_read_lock(filename, username)
-            if not success:
-                return jsonify({"status": "error", "message": message})
-                
+        if 'offset' in request.args or 'length' in request.args:
+            size = store.size(filename) or 0
             try:
-                with open(file_path, 'r') as f:
-                    content = f.read()
-                return jsonify({"status": "success", "content": content})
-            finally:
-                release_read_lock(filename)
-            
-        elif action == "CREATE" and role == "admin":
-            if len(parts) < 3:
-                return jsonify({"status": "error", "message": "Filename and content required"})
-            filename = parts[1]
-            content = parts[2]
-            file_path = os.path.join(FILES_DIR, filename)
-            
-            if os.path.exists(file_path):
-                return jsonify({"status": "error", "message": "File already exists"})
-            
-            # Check if file is locked
-            if filename in file_locks:
-                return jsonify({"status": "error", "message": f"File is locked by {file_locks[filename]['user']}"})
-                
-            # Try to acquire write lock
+                start, end = resolve_range(size, offset, length)
+            except ValueError as e:
+                finished()
+                return jsonify({"status": "error", "message": str(e)}), 416
+            metrics.bytes_read.inc(end - start)
+            if start == end:
+                # An empty file: there is no byte range to describe, so the whole (empty) file
+                response = Response(b'', mimetype='application/octet-stream')
+            else:
+                response = Response(store.iter_range(filename, start, end),
+                                    status=206, mimetype='application/octet-stream')
+                response.headers['Content-Length'] = str(end - start)
+                response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+            response.headers['Accept-Ranges'] = 'bytes'
+        else:
+            file_path = store.path(filename)
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            # A compressed file goes out as stored to clients that accept its codec
+            encoded = None if request.range else store.open_encoded(filename)
+            negotiated = encoded is not None
+            if negotiated and request.accept_encodings[encoded[0]] <= 0:
+                encoded[2].close()
+                encoded = None
+            if encoded is not None:
+                codec, length, chunks = encoded
+                response = Response(chunks, mimetype=mimetype)
+                response.content_length = length
+                response.content_encoding = codec
+                response.set_etag(f"{catalog.sha256(filename) or catalog.etag}-{codec}")
+                response.make_conditional(request)
+            elif file_path is not None:
+                # send_file hands the file to the server's file wrapper (sendfile where
+                # available). The server closes a passed-through body itself, without
+                # running call_on_close, so closing the file releases the read lock.
+                file_path = os.path.abspath(file_path)
+                f = ReleasingFile(file_path, finished)
+                try:
+                    st = os.fstat(f.fileno())
+                    # The catalog tag changes on every write, even one that keeps size and mtime
+                    tag = catalog.entry_tag(filename) or zlib.adler32(file_path.encode())
+                    response = send_file(f, mimetype=mimetype, conditional=False, last_modified=st.st_mtime,
+                                         etag=f"{st.st_mtime}-{st.st_size}-{tag}")
+                    response.content_length = st.st_size
+                    response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+                except BaseException:
+                    f.close()
+                    raise
+            else:
+                # Reassembled from chunks or decompressed; werkzeug cuts Range requests out of the stream
+                size = store.size(filename) or 0
+                response = Response(store.iter_range(filename, 0, size), mimetype=mimetype)
+                response.content_length = size
+                response.set_etag(catalog.sha256(filename) or catalog.etag)
+                response.make_conditional(request, accept_ranges=True, complete_length=size)
+            if negotiated:
+                response.vary.add('Accept-Encoding')
+            if response.status_code in (200, 206):
+                metrics.bytes_read.inc(response.content_length or 0)
+    except Exception:
+        finished()
+        raise
+    
+    response.call_on_close(finished)
+    return response
+
+@app.route('/upload/<filename>', methods=['PUT', 'POST'])
+def upload_file(filename):
+    """CREATE or EDIT a file from a raw (PUT) or multipart (POST, field "file") body.
+
+    The body is streamed into a temporary file in FILES_DIR and committed to
+    the store while holding the write lock, so readers never see a partial file.
+    """
+    identity = current_identity()
+    if identity is None:
+        return not_authenticated()
+    username, role = identity
+    action = request.args.get('action', 'CREATE').upper()
+    
+    if role != "admin" or action not in ("CREATE", "EDIT"):
+        return jsonify({"status": "error", "message": "Invalid command or insufficient permissions"}), 403
+    if filename.startswith('.'):
+        return jsonify({"status": "error", "message": "Invalid filename"}), 400
+    
+    if action == "CREATE" and store.exists(filename):
+        return jsonify({"status": "error", "message": "File already exists"}), 409
+    
+    with admission.admitted(username, role, 'UPLOAD', heavy=True):
+        return receive_upload(username, filename, action)
+
+def receive_upload(username, filename, action):
+    """Receive the body of an admitted upload and commit it under the write lock"""
+    if request.method == 'POST':
+        if 'file' not in request.files:
+            return jsonify({"status": "error", "message": "Multipart field 'file' required"}), 400
+        stream = request.files['file'].stream
+    else:
+        stream = request.stream
+    
+    upload = receive_stream(stream, FILES_DIR)
+    try:
+        # Re-check now that the body has arrived
+        if action == "CREATE" and store.exists(filename):
+            upload.abort()
+            return jsonify({"status": "error", "message": "File already exists"}), 409
+        if action == "EDIT" and not store.exists(filename):
+            upload.abort()
+            return jsonify({"status": "error", "message": "File not found"}), 404
+        
+        # An admin may upload over a file they have locked themselves
+        holds_lock = locks.holder(filename) == username
+        if not holds_lock:
             success, message = acquire_write_lock(filename, username)
             if not success:
-                return jsonify({"status": "error", "message": message})
-                
-            try:
-                with open(file_path, 'w') as f:
-                    f.write(content)
-                return jsonify({"status": "success", "message": f"File {filename} created"})
-            finally:
+                upload.abort()
+                return jsonify({"status": "error", "message": message}), 423
+        try:
+            store.commit_upload(upload, filename)
+            file_changed(filename, sha256=upload.sha256,
+                         event='file_created' if action == 'CREATE' else 'file_edited', user=username)
+            metrics.bytes_written.inc(upload.size)
+        finally:
+            if not holds_lock:
                 release_write_lock(filename, username)
-            
-        elif action == "EDIT" and role == "admin":
-            if len(parts) < 3:
-                return jsonify({"status": "error", "message": "Filename and content required"})
-            filename = parts[1]
-            content = parts[2]
-            file_path = os.path.join(FILES_DIR, filename)
-            
-            if not os.path.exists(file_path):
-                return jsonify({"status": "error", "message": "File not found"})
-            
-            # Check if file is locked by someone else
-            if filename in file_locks and file_locks[filename]['user'] != username:
-                return jsonify({"status": "error", "message": f"File is locked by {file_locks[filename]['user']}"})
-            
-            # If file is not locked by current user, try to acquire write lock
-            if filename not in file_locks:
-                success, message = acquire_write_lock(filename, username)
-                if not success:
-                    return jsonify({"status": "error", "message": message})
-                
-            try:
-                with open(file_path, 'w') as f:
-                    f.write(content)
-                return jsonify({"status": "success", "message": f"File {filename} updated"})
-            finally:
-                if filename not in file_locks:
-                    release_write_lock(filename, username)
-            
-        elif action == "DELETE" and role == "admin":
-            if len(parts) < 2:
-                return jsonify({"status": "error", "message": "Filename required"})
-            filename = parts[1]
-            file_path = os.path.join(FILES_DIR, filename)
-            
-            if not os.path.exists(file_path):
-                return jsonify({"status": "error", "message": "File not found"})
-            
-            # Check if file is locked
-            if filename in file_locks:
-                return jsonify({"status": "error", "message": f"File is locked by {file_locks[filename]['user']}"})
-                
-            # Try to acquire write lock
-            success, message = acquire_write_lock(filename, username)
+    except Exception:
+        upload.abort()
+        raise
+    
+    return jsonify({
+        "status": "success",
+        "message": f"File {filename} {'created' if action == 'CREATE' else 'updated'}",
+        "size": upload.size,
+        "sha256": upload.sha256
+    })
+
+def json_error(message):
+    return jsonify({"status": "error", "message": message})
+
+def json_success(message):
+    return jsonify({"status": "success", "message": message})
+
+# Handlers for /command, looked up in the command table shared with backend.py.
+# Arguments arrive already checked and converted per commands.py.
+dispatcher = Dispatcher("Invalid command or insufficient permissions")
+
+@dispatcher.handler('LOCK')
+def lock_command(username, filename):
+    # Locking a file again renews the lease on it
+    if locks.renew(filename, username):
+        return json_success(f"File {filename} lock renewed")
+    success, message = acquire_write_lock(filename, username)
+    if success:
+        publish("lock_acquired", filename=filename, user=username)
+        return json_success(f"File {filename} locked")
+    return json_error(message)
+
+@dispatcher.handler('UNLOCK')
+def unlock_command(username, filename):
+    if release_write_lock(filename, username):
+        publish("lock_released", filename=filename, user=username)
+        return json_success(f"File {filename} unlocked")
+    return json_error("You don't have the lock for this file")
+
+@dispatcher.handler('LIST')
+def list_command(username, option):
+    # Include lock information in response
+    lock_info = {
+        'files': catalog.names(),
+        'locked_files': {
+            filename: {
+                'type': 'write',
+                'user': user
+            } for filename, user in locks.write_locks().items()
+        },
+        'readers': locks.reader_counts()
+    }
+    # LIST::details adds size, mtime and sha256 per file
+    if option == "details":
+        lock_info['details'] = catalog.details()
+    
+    # The ETag covers the directory version and the lock state, so an
+    # unchanged listing is answered with an empty 304
+    lock_state = json.dumps([lock_info['locked_files'], lock_info['readers']], sort_keys=True)
+    etag = f"{catalog.etag}-{zlib.crc32(lock_state.encode()):08x}{'-d' if 'details' in lock_info else ''}"
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    response = jsonify({"status": "success", **lock_info})
+    response.set_etag(etag)
+    return response
+
+@dispatcher.handler('READ')
+def read_command(username, filename, etag_seen):
+    info = catalog.info(filename)
+    if info is None:
+        return json_error("File not found")
+    
+    # Large files are not inlined in JSON; point the client at the stream endpoint
+    if info.size > READ_INLINE_LIMIT:
+        return jsonify({"status": "success", "stream": f"/files/{quote(filename)}", "size": info.size})
+        
+    success, message = acquire_read_lock(filename, username)
+    if not success:
+        return json_error(message)
+        
+    try:
+        entry = cached_content(filename)
+    finally:
+        release_read_lock(filename)
+    if entry is None:
+        return json_error("File not found")
+    
+    # READ::name::<etag> or If-None-Match: unchanged content is answered with an empty 304
+    if entry.etag is not None and (etag_seen == entry.etag or request.if_none_match.contains_weak(entry.etag)):
+        return Response(status=304, headers={'ETag': f'"{entry.etag}"'})
+    metrics.bytes_read.inc(len(entry.content))
+    response = jsonify({"status": "success", "content": entry.content, "etag": entry.etag})
+    response.set_etag(entry.etag)
+    return response
+
+def cached_content(filename):
+    """Content and ETag of a small file, from the content cache or read through it; call with the read lock held"""
+    info = catalog.info(filename)
+    if info is None:
+        return None
+    version = info.version
+    entry = content_cache.get(filename, version)
+    if entry is None:
+        content = store.read_text(filename)
+        entry = content_cache.put(filename, version, content, catalog.sha256(filename))
+    return entry
+
+@dispatcher.handler('CREATE')
+def create_command(username, filename, content):
+    if store.exists(filename):
+        return json_error("File already exists")
+    
+    # Try to acquire write lock
+    success, message = acquire_write_lock(filename, username)
+    if not success:
+        return json_error(message)
+        
+    try:
+        store.write_text(filename, content)
+        file_changed(filename, event='file_created', user=username)
+        metrics.bytes_written.inc(len(content))
+        return json_success(f"File {filename} created")
+    finally:
+        release_write_lock(filename, username)
+
+@dispatcher.handler('EDIT')
+def edit_command(username, filename, content):
+    if not store.exists(filename):
+        return json_error("File not found")
+    
+    # If file is not locked by current user, wait for the write lock
+    holds_lock = locks.holder(filename) == username
+    if not holds_lock:
+        success, message = acquire_write_lock(filename, username)
+        if not success:
+            return json_error(message)
+        
+    try:
+        store.write_text(filename, content)
+        file_changed(filename, user=username)
+        metrics.bytes_written.inc(len(content))
+        return json_success(f"File {filename} updated")
+    finally:
+        if not holds_lock:
+            release_write_lock(filename, username)
+
+@dispatcher.handler('DELETE')
+def delete_command(username, filename):
+    if not store.exists(filename):
+        return json_error("File not found")
+    
+    # Try to acquire write lock
+    success, message = acquire_write_lock(filename, username)
+    if not success:
+        return json_error(message)
+        
+    try:
+        store.delete(filename)
+        file_changed(filename, event='file_deleted', user=username)
+        return json_success(f"File {filename} deleted")
+    finally:
+        release_write_lock(filename, username)
+
+@dispatcher.handler('MAKE_REQUEST')
+def make_request_command(username, request_type, filename, content):
+    new_request = request_store.add(
+        username=username,
+        type=request_type,
+        filename=filename,
+        content=content,
+        status="pending",
+        timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    return json_success(f"Request #{new_request['id']} submitted")
+
+@dispatcher.handler('LIST_REQUESTS')
+def list_requests_command(username, query):
+    # Optional key=value arguments, e.g. LIST_REQUESTS::status=pending::cursor=120
+    try:
+        query = parse_query(query)
+    except ValueError as e:
+        return json_error(str(e))
+    requests_page, next_cursor = request_store.query(**query)
+    return jsonify({"status": "success", "requests": requests_page, "next_cursor": next_cursor})
+
+@dispatcher.handler('SEARCH')
+def search_command(username, query, options):
+    # SEARCH::<query>[::cursor=N][::limit=N]; the query takes words, "exact phrases" and name:<prefix>
+    try:
+        results, next_cursor, total = search_index.search(query, **parse_page(options))
+    except ValueError as e:
+        return json_error(str(e))
+    return jsonify({"status": "success", "results": results, "total": total, "next_cursor": next_cursor})
+
+REQUEST_EVENTS = {'CREATE': 'file_created', 'EDIT': 'file_edited', 'DELETE': 'file_deleted'}
+
+def apply_request(req, username):
+    """Carry out an approved request's file operation; runs on an apply worker."""
+    if req['type'] not in REQUEST_EVENTS:
+        # Only stored before MAKE_REQUEST checked the type
+        raise ValueError(f"Unknown request type '{req['type']}'")
+    filename = req['filename']
+    holds_lock = locks.holder(filename) == username
+    if not holds_lock:
+        success, message = acquire_write_lock(filename, username)
+        if not success:
+            raise RuntimeError(message)
+    try:
+        if req['type'] in ('CREATE', 'EDIT'):
+            store.write_text(filename, req['content'])
+            metrics.bytes_written.inc(len(req['content']))
+        elif req['type'] == 'DELETE':
+            if store.exists(filename):
+                store.delete(filename)
+        file_changed(filename, event=REQUEST_EVENTS[req['type']], user=username)
+    finally:
+        if not holds_lock:
+            release_write_lock(filename, username)
+
+def apply_and_record(request_id, username):
+    req = request_store.get(request_id)
+    try:
+        apply_request(req, username)
+    except Exception as e:
+        return request_store.update(request_id, status='failed', error=str(e))
+    # Drop the error left by an earlier failed attempt
+    cleared = {'error': None} if req.get('error') else {}
+    return request_store.update(request_id, status='approved', **cleared)
+
+def queue_requests(requests_to_apply, username, urgent=False):
+    """Hand claimed requests to the apply workers; returns their futures."""
+    return [apply_queue.submit(req['filename'], apply_and_record, req['id'], username, urgent=urgent)
+            for req in requests_to_apply]
+
+@dispatcher.handler('HANDLE_REQUEST')
+def handle_request_command(username, request_id, decision):
+    req = request_store.get(request_id)
+    if req is None:
+        return json_error("Request not found")
+
+    approve = decision == 'approve'
+    claimed = request_store.update_many([request_id], if_status=OPEN_REQUEST_STATUSES,
+                                        status='queued' if approve else 'rejected',
+                                        queued_by=os.getpid() if approve else None)
+    if not claimed:
+        return json_error(f"Request #{request_id} is already {req['status']}")
+    if approve:
+        # Served ahead of bulk approvals, after any already queued for the same file
+        record = queue_requests(claimed, username, urgent=True)[0].result()
+        if record['status'] == 'failed':
+            return json_error(f"Request #{request_id} failed: {record['error']}")
+
+    return json_success(f"Request #{request_id} {'approved' if approve else 'rejected'}")
+
+@dispatcher.handler('HANDLE_REQUESTS')
+def handle_requests_command(username, decision, selector):
+    # HANDLE_REQUESTS::approve::ids=1,2,3 or HANDLE_REQUESTS::reject::username=bob::type=DELETE
+    if decision not in ('approve', 'reject'):
+        return json_error("Decision must be approve or reject")
+    try:
+        ids, filters = parse_selection(selector)
+    except ValueError as e:
+        return json_error(str(e))
+    if ids is None:
+        if filters.get('status', 'pending') not in OPEN_REQUEST_STATUSES:
+            return json_error("Only pending or failed requests can be handled")
+        ids = request_store.matching_ids({'status': 'pending', **filters}, BULK_REQUEST_LIMIT)
+    elif len(ids) > BULK_REQUEST_LIMIT:
+        return json_error(f"At most {BULK_REQUEST_LIMIT} requests can be handled at once")
+
+    if decision == 'reject':
+        rejected = request_store.update_many(ids, if_status=OPEN_REQUEST_STATUSES, status='rejected')
+        handled = [req['id'] for req in rejected]
+        return jsonify({"status": "success", "message": f"{len(handled)} requests rejected",
+                        "rejected": handled})
+
+    # Approved requests are applied in the background; poll LIST_REQUESTS::status=queued
+    # (or ::ids) to follow them through to approved or failed
+    claimed = request_store.update_many(ids, if_status=OPEN_REQUEST_STATUSES, status='queued',
+                                        queued_by=os.getpid())
+    queue_requests(claimed, username)
+    handled = [req['id'] for req in claimed]
+    return jsonify({"status": "success", "message": f"{len(handled)} requests queued",
+                    "queued": handled})
+
+@app.route('/command', methods=['POST'])
+def command():
+    """Run one command, sent as JSON {"command": "NAME::arg::..."} or as a binary frame.
+
+    A binary frame (Content-Type application/x-fms-frame, see commands.py)
+    carries each argument length-prefixed, so content needs no escaping.
+    """
+    # Identity and role come from the session token, never from the request body
+    identity = current_identity()
+    if identity is None:
+        return not_authenticated()
+    username, role = identity
+    
+    if request.mimetype == FRAME_MIMETYPE:
+        message = request.get_data()
+    else:
+        message = (request.get_json(silent=True) or {}).get('command', '')
+    if not message:
+        return json_error("No command provided")
+    
+    started = time.perf_counter()
+    name = None
+    try:
+        spec, handler, args = dispatcher.parse(message, role)
+        name = spec.name
+        with admission.admitted(username, role, name, is_heavy(name, args, catalog)):
+            return handler(username, *args)
+    except Overloaded:
+        raise
+    except Exception as e:
+        # Includes CommandError for unknown commands and malformed arguments
+        return json_error(str(e))
+    finally:
+        metrics.observe_command(name, time.perf_counter() - started)
+
+# Commands allowed in an all-or-nothing batch; each names its file first
+ATOMIC_COMMANDS = {'LIST', 'READ', 'CREATE', 'EDIT', 'DELETE'}
+BATCH_LIMIT = int(os.environ.get('BATCH_LIMIT', 5000))
+
+def run_command(username, spec, handler, args):
+    """Run one parsed command and return its JSON result as a dict"""
+    started = time.perf_counter()
+    try:
+        response = handler(username, *args)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+    finally:
+        metrics.observe_command(spec.name, time.perf_counter() - started)
+    if response.status_code == 304:
+        return {"status": "success", "not_modified": True}
+    return response.get_json()
+
+def backup_files(filenames):
+    """Set each file's content aside so an atomic batch can be undone; None marks a missing file"""
+    backups = {}
+    try:
+        for filename in filenames:
+            backups[filename] = store.backup(filename)
+    except Exception:
+        discard_backups(backups)
+        raise
+    return backups
+
+def restore_backups(backups):
+    for filename, backup in backups.items():
+        store.restore(filename, backup)
+        file_changed(filename, event='file_edited' if backup is not None else 'file_deleted')
+
+def discard_backups(backups):
+    for backup in backups.values():
+        store.discard(backup)
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Run an ordered list of commands in one request.
+
+    Body: {"commands": ["LOCK::a.txt", "EDIT::a.txt::...", ...], "atomic": false}.
+    Every command runs and gets its own result. With "atomic": true the
+    commands (LIST, READ, CREATE, EDIT, DELETE only) run as a unit: locks
+    on every file they touch are taken up front in sorted order (write
+    locks on files the batch changes, read locks on files it only reads),
+    so concurrent batches cannot deadlock, and if any command fails the
+    changed files are restored and nothing is kept.
+    """
+    identity = current_identity()
+    if identity is None:
+        return not_authenticated()
+    username, role = identity
+    
+    data = request.get_json(silent=True) or {}
+    messages = data.get('commands')
+    atomic = bool(data.get('atomic'))
+    if not isinstance(messages, list) or not all(isinstance(m, str) for m in messages):
+        return json_error("commands must be a list of command strings")
+    if len(messages) > BATCH_LIMIT:
+        return json_error(f"At most {BATCH_LIMIT} commands per batch")
+    
+    parsed = []
+    for index, message in enumerate(messages):
+        try:
+            parsed.append(dispatcher.parse(message, role))
+        except Exception as e:
+            parsed.append(e)
+    
+    # Charged as one command per entry, to the write limits if any entry writes
+    commands = [item for item in parsed if not isinstance(item, Exception)]
+    writes = any(command_class(spec.name) == 'write' for spec, handler, args in commands)
+    heavy = len(commands) > BATCH_HEAVY or any(is_heavy(spec.name, args, catalog) for spec, handler, args in commands)
+    with admission.admitted(username, role, 'EDIT' if writes else 'READ', heavy, cost=max(len(commands), 1)):
+        return run_batch(username, role, parsed, atomic)
+
+def run_batch(username, role, parsed, atomic):
+    """Run a batch's parsed commands (or the parse errors in their place) and build the response"""
+    if not atomic:
+        results = [
+            {"status": "error", "message": str(item)} if isinstance(item, Exception)
+            else run_command(username, *item)
+            for item in parsed
+        ]
+        return jsonify({"status": "success", "results": results})
+    
+    # All-or-nothing: validate everything before touching anything
+    for index, item in enumerate(parsed):
+        if isinstance(item, Exception):
+            return json_error(f"Command {index}: {item}")
+        if item[0].name not in ATOMIC_COMMANDS:
+            return json_error(f"Command {index}: {item[0].name} is not allowed in an atomic batch")
+        if not item[0].allows(role):
+            return json_error(f"Command {index}: Invalid command or insufficient permissions")
+    filenames = sorted({args[0] for spec, handler, args in parsed if spec.name != 'LIST'})
+    written = {args[0] for spec, handler, args in parsed if spec.name in ('CREATE', 'EDIT', 'DELETE')}
+    if any(filename.startswith('.') or '/' in filename for filename in filenames):
+        return json_error("Invalid filename")
+    
+    held = []  # (filename, kind)
+    try:
+        for filename in filenames:
+            if locks.holder(filename) == username:
+                continue  # Already locked by this admin through LOCK
+            if filename in written:
+                success, message = locks.acquire_write(filename, username)
+            else:
+                success, message = locks.acquire_read(filename, username)
             if not success:
-                return jsonify({"status": "error", "message": message})
-                
-            try:
-                os.remove(file_path)
-                return jsonify({"status": "success", "message": f"File {filename} deleted"})
-            finally:
-                release_write_lock(filename, username)
-            
-        elif action == "MAKE_REQUEST" and role == "user":
-            if len(parts) < 4:
-                return jsonify({"status": "error", "message": "Invalid request format"})
-            request_type = parts[1]
-            filename = parts[2]
-            content = parts[3] if len(parts) > 3 else ""
-            
-            # Store request in a JSON file
-            requests_file = 'requests.json'
-            requests_data = []
-            if os.path.exists(requests_file):
-                with open(requests_file, 'r') as f:
-                    requests_data = json.load(f)
-            
-            new_request = {
-                "id": len(requests_data) + 1,
-                "username": username,
-                "type": request_type,
-                "filename": filename,
-                "content": content,
-                "status": "pending"
-            }
-            requests_data.append(new_request)
-            
-            with open(requests_file, 'w') as f:
-                json.dump(requests_data, f, indent=2)
-            
-            return jsonify({"status": "success", "message": f"Request #{new_request['id']} submitted"})
-            
-        elif action == "LIST_REQUESTS" and role == "admin":
-            if not os.path.exists('requests.json'):
-                return jsonify({"status": "success", "requests": []})
-            with open('requests.json', 'r') as f:
-                requests_data = json.load(f)
-            return jsonify({"status": "success", "requests": requests_data})
-            
-        elif action == "HANDLE_REQUEST" and role == "admin":
-            if len(parts) < 3:
-                return jsonify({"status": "error", "message": "Request ID and decision required"})
-            request_id = int(parts[1])
-            decision = parts[2]
-            
-            if not os.path.exists('requests.json'):
-                return jsonify({"status": "error", "message": "No requests found"})
-                
-            with open('requests.json', 'r') as f:
-                requests_data = json.load(f)
-            
-            for req in requests_data:
-                if req['id'] == request_id:
-                    req['status'] = 'approved' if decision == 'approve' else 'rejected'
-                    if decision == 'approve':
-                        file_path = os.path.join(FILES_DIR, req['filename'])
-                        if req['type'] == 'CREATE':
-                            with open(file_path, 'w') as f:
-                                f.write(req['content'])
-                        elif req['type'] == 'EDIT':
-                            with open(file_path, 'w') as f:
-                                f.write(req['content'])
-                        elif req['type'] == 'DELETE':
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
+                return json_error(f"{filename}: {message}")
+            held.append((filename, 'write' if filename in written else 'read'))
+        
+        backups = backup_files(sorted(written))
+        batch_locks.files = set(filenames)
+        results = []
+        try:
+            for item in parsed:
+                results.append(run_command(username, *item))
+                if results[-1].get('status') != 'success':
                     break
-            
-            with open('requests.json', 'w') as f:
-                json.dump(requests_data, f, indent=2)
-            
+        except Exception:
+            restore_backups(backups)
+            raise
+        finally:
+            batch_locks.files = ()
+        
+        if results[-1].get('status') != 'success':
+            restore_backups(backups)
             return jsonify({
-                "status": "success", 
-                "message": f"Request #{request_id} {decision}d"
+                "status": "error",
+                "message": f"Command {len(results) - 1} failed, batch rolled back: {results[-1].get('message')}",
+                "results": results
             })
-            
-        return jsonify({"status": "error", "message": "Invalid command or insufficient permissions"})
-        
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)})
+        discard_backups(backups)
+        return jsonify({"status": "success", "results": results})
+    finally:
+        for filename, kind in held:
+            if kind == 'write':
+                locks.release_write(filename, username)
+            else:
+                locks.release_read(filename)
 
 if __name__ == '__main__':
-    # Create requests.json if it doesn't exist
-    if not os.path.exists('requests.json'):
-        with open('requests.json', 'w') as f:
-            json.dump([], f)
+    # Development server, one process. With STATE_BACKEND=sqlite the app can
+    # run under several workers instead, e.g. gunicorn -w 4 -b 0.0.0.0:8000 web_server:app
     app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file